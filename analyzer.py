@@ -0,0 +1,226 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import re
+import sys
+import time
+import argparse
+
+
+# The words are the maximal sequences of the letters A-Z and a-z, lowercased.
+WORD_PATTERN = re.compile("[A-Za-z]+")
+LOWER_WORD_PATTERN = re.compile("[a-z]+")
+
+# The flags for the stages of an analyzer, as stored in an index.
+STOPWORDS = 1
+STEMMING = 2
+
+# Frequent English words that are removed by the stopword stage.
+STOPWORD_LIST = frozenset("""
+    a about after all also an and any are as at be been but by can could did
+    do does for from had has have he her his how i if in into is it its just
+    more most no not of on one or other our out she so some such than that the
+    their them then there these they this to up was we were what when which
+    who will with would you your
+    """.split())
+
+
+def tokenize(text):
+    """
+    Split the given text into words: the maximal sequences of the letters A-Z
+    and a-z, lowercased. This is the same as splitting the text with
+    re.split("[^A-Za-z]+", text), lowercasing the parts and ignoring empty
+    parts, but about twice as fast.
+
+    >>> tokenize("Short film\\tA  non-animated film, 1990s.")
+    ['short', 'film', 'a', 'non', 'animated', 'film', 's']
+
+    Lowercasing the whole text first is fastest, but only for ASCII texts:
+    some other characters are lowercased to the letters a-z.
+
+    >>> tokenize("\\u212aelvin \\u0130stanbul")
+    ['elvin', 'stanbul']
+    """
+    if text.isascii():
+        return LOWER_WORD_PATTERN.findall(text.lower())
+    return list(map(str.lower, WORD_PATTERN.findall(text)))
+
+
+def stem(word):
+    """
+    Reduce the given word to its stem with the S-stemmer (Harman, 1991),
+    which only removes the plural forms of English words.
+
+    >>> [stem(x) for x in ["films", "heroes", "business", "series"]]
+    ['film', 'heroe', 'business', 'sery']
+    >>> [stem(x) for x in ["stories", "toes", "bus"]]
+    ['story', 'toe', 'bus']
+    """
+    if word.endswith("ies") and not word.endswith(("eies", "aies")):
+        return word[:-3] + "y"
+    if word.endswith("es") and not word.endswith(("aes", "ees", "oes")):
+        return word[:-1]
+    if word.endswith("s") and not word.endswith(("us", "ss")):
+        return word[:-1]
+    return word
+
+
+def unstem(term):
+    """
+    Return the words that stem (the S-stemmer) may reduce to the given term,
+    and possibly some more words (which are reduced to other terms).
+
+    >>> unstem("film"), unstem("story")
+    (['film', 'films'], ['story', 'storys', 'stories'])
+    >>> all(stem(x) == "heroe" for x in unstem("heroe"))
+    True
+    """
+    words = [term, term + "s"]
+    if term.endswith("y"):
+        words.append(term[:-1] + "ies")
+    return words
+
+
+class TermCache(dict):
+    """
+    A dictionary from words to terms, where missing terms are computed by the
+    given function and interned. An empty term means that the word is removed.
+    """
+
+    def __init__(self, analyze_word):
+        self.analyze_word = analyze_word
+
+    def __missing__(self, word):
+        term = self[word] = sys.intern(self.analyze_word(word))
+        return term
+
+
+class Analyzer:
+    """
+    Splits texts into the terms used in the index: the words of the text (see
+    tokenize), optionally without stopwords (see STOPWORD_LIST) and reduced to
+    their stems (see stem). The same analyzer has to be used for the docs and
+    for the queries, so the index stores it (see InvertedIndex.analyzer).
+
+    The terms of the words are cached, so the stopword and stemming stages
+    are computed only once per distinct word.
+
+    >>> Analyzer().analyze("The Movies of the 1990s")
+    ['the', 'movies', 'of', 'the', 's']
+    >>> Analyzer(stopwords=True, stemming=True).analyze("The Films of the")
+    ['film']
+    >>> Analyzer.from_flags(Analyzer(stemming=True).flags).stemming
+    True
+    """
+
+    def __init__(self, stopwords=False, stemming=False):
+        """
+        Creates an analyzer with the given stages.
+        """
+        self.stopwords = stopwords
+        self.stemming = stemming
+        self.terms = TermCache(self.analyze_word)
+
+    @classmethod
+    def from_flags(cls, flags):
+        """
+        Creates an analyzer with the stages given by flags (see flags).
+        """
+        return cls(stopwords=bool(flags & STOPWORDS),
+                   stemming=bool(flags & STEMMING))
+
+    @property
+    def flags(self):
+        """
+        The stages of the analyzer, as combination of the flags STOPWORDS and
+        STEMMING.
+        """
+        return ((STOPWORDS if self.stopwords else 0)
+                | (STEMMING if self.stemming else 0))
+
+    def __getstate__(self):
+        # Do not pickle the cached terms.
+        return {"stopwords": self.stopwords, "stemming": self.stemming}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __eq__(self, other):
+        return isinstance(other, Analyzer) and self.flags == other.flags
+
+    def __repr__(self):
+        return "Analyzer(stopwords=%s, stemming=%s)" % (self.stopwords,
+                                                        self.stemming)
+
+    def analyze_word(self, word):
+        """
+        Return the term of the given (lowercased) word, or the empty string if
+        the word is removed.
+        """
+        if self.stopwords and word in STOPWORD_LIST:
+            return ""
+        if self.stemming:
+            return stem(word)
+        return word
+
+    def analyze(self, text):
+        """
+        Return the terms of the given text, in order.
+        """
+        words = tokenize(text)
+        if not self.stopwords and not self.stemming:
+            return words
+        return [x for x in map(self.terms.__getitem__, words) if x]
+
+
+def split_words_re(text):
+    """
+    Split the given text into words as done before this module existed, used
+    as baseline by main.
+    """
+    words = [x.lower().strip() for x in re.split("[^A-Za-z]+", text)]
+    return [x for x in words if len(x) > 0]
+
+
+def main(doc_file, repeat):
+    # Read the docs into memory, so that only the tokenization is timed.
+    print("Reading from file '%s'." % doc_file)
+    with open(doc_file, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    size = sum(map(len, lines)) / 2**20
+
+    print("%-40s %10s %10s %10s" % ("method", "terms", "MB/s", "speedup"))
+    baseline = None
+    for name, analyze in [
+            ("re.split + lower + strip", split_words_re),
+            ("tokenize", tokenize),
+            ("Analyzer()", Analyzer().analyze),
+            ("Analyzer(stopwords=True)", Analyzer(stopwords=True).analyze),
+            ("Analyzer(stemming=True)", Analyzer(stemming=True).analyze),
+            ("Analyzer(stopwords=True, stemming=True)",
+             Analyzer(stopwords=True, stemming=True).analyze)]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            num_terms = sum(len(analyze(line)) for line in lines)
+            best = min(best, time.perf_counter() - start)
+        baseline = baseline or best
+        print("%-40s %10d %10.1f %9.2fx"
+              % (name, num_terms, size / best, baseline / best))
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Benchmark the throughput
+            of the tokenization and of the analyzer stages on the given
+            file.""")
+    parser.add_argument("doc_file", type=str, help="""File to read from, with
+            one document per line.""")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="""Number
+            of runs per method, the fastest run is reported (default:
+            %(default)s)""")
+    args = parser.parse_args()
+    main(args.doc_file, args.repeat)
@@ -0,0 +1,237 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import time
+import random
+import argparse
+import resource
+from operator import itemgetter
+from functools import partial
+
+from inverted_index import InvertedIndex, MODES  # NOQA
+from index_format import load_index
+from analyzer import Analyzer
+
+
+def read_queries(file_name, analyzer=None):
+    """
+    Read the queries from the given file. The expected format of the file is
+    one query per line, optionally followed by a TAB and anything else (so a
+    benchmark file as read by 'evaluate.py' can be used). Return the queries
+    as lists of keywords, split by the given analyzer (by default,
+    Analyzer(), see analyzer.py).
+
+    >>> read_queries("example-benchmark.tsv")
+    [['animated', 'film'], ['short', 'film']]
+    """
+    analyzer = analyzer or Analyzer()
+    queries = []
+    with open(file_name, "r", encoding="utf-8") as f:
+        for line in f:
+            keywords = analyzer.analyze(line.split("\t")[0])
+            if keywords:
+                queries.append(keywords)
+    return queries
+
+
+def time_queries(ii, queries, k=None, repeat=3, mode="or"):
+    """
+    Process each of the given queries with the given inverted index in the
+    given query mode (only computing the top-k, if k is given). Repeat each
+    query the given number of times and take the fastest run. Return the
+    list of the results and the list of the times (in seconds).
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> results, times = time_queries(ii, [["short", "film"]], k=1)
+    >>> [[(id, "%.3f" % tf) for id, tf in result] for result in results]
+    [[(4, '2.176')]]
+    >>> len(times)
+    1
+    """
+    results = []
+    times = []
+    for keywords in queries:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = ii.process_query(keywords, k=k, mode=mode)
+            best = min(best, time.perf_counter() - start)
+        results.append(result)
+        times.append(best)
+    return results, times
+
+
+def benchmark_top_k(ii, queries, k, repeat=3, mode="or"):
+    """
+    Compare the exhaustive query processing with the top-k query processing
+    on the given queries (in the given query mode). Print the time of both
+    for each query and check that both return the same top-k.
+    """
+    exhaustive_results, exhaustive_times = time_queries(ii, queries, None,
+                                                        repeat, mode)
+    top_k_results, top_k_times = time_queries(ii, queries, k, repeat, mode)
+
+    print("%-30s %10s %12s %10s %8s" % ("query", "#postings", "exhaustive",
+                                        "top-k", "speedup"))
+    for i, keywords in enumerate(queries):
+        num_postings = sum(len(ii.inverted_lists.get(x, []))
+                           for x in keywords)
+        if exhaustive_results[i][:k] != top_k_results[i]:
+            print("WARNING: Different top-%d for query '%s'."
+                  % (k, " ".join(keywords)))
+        print("%-30s %10d %10.2fms %8.2fms %7.1fx"
+              % (" ".join(keywords)[:30], num_postings,
+                 1000 * exhaustive_times[i], 1000 * top_k_times[i],
+                 exhaustive_times[i] / max(top_k_times[i], 1e-9)))
+
+    total_exhaustive = sum(exhaustive_times)
+    total_top_k = sum(top_k_times)
+    print("%-30s %10s %10.2fms %8.2fms %7.1fx"
+          % ("total", "", 1000 * total_exhaustive, 1000 * total_top_k,
+             total_exhaustive / max(total_top_k, 1e-9)))
+
+
+def random_queries(ii, max_terms, num_queries, num_words=2000, seed=0):
+    """
+    Generate random queries with 1 to max_terms distinct keywords, each drawn
+    from the num_words words with the longest inverted lists. Return a list
+    of num_queries queries (lists of keywords) per number of keywords.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> random_queries(ii, 3, 1, num_words=2)
+    [[['animated']], [['animated', 'movie']], [['animated', 'film', 'movie']]]
+    """
+    rng = random.Random(seed)
+    words = sorted(ii.inverted_lists,
+                   key=lambda x: len(ii.inverted_lists[x]),
+                   reverse=True)[:max(num_words, max_terms)]
+    return [[rng.sample(words, m) for _ in range(num_queries)]
+            for m in range(1, max_terms + 1)]
+
+
+def pairwise_union(ii, lists, k=None):
+    """
+    Compute the union of the given inverted lists by merging them pairwise
+    (see InvertedIndex.merge), then filter the zero scores and sort all
+    postings. This is how the union was computed before
+    InvertedIndex.union, used as baseline by benchmark_union.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> lists = [ii.inverted_lists["short"], ii.inverted_lists["film"]]
+    >>> pairwise_union(ii, lists) == ii.union(lists)
+    True
+    """
+    union = lists[0]
+    for inverted_list in lists[1:]:
+        union = ii.merge(union, inverted_list)
+    return sorted(filter(itemgetter(1), union), key=itemgetter(1),
+                  reverse=True)[:k]
+
+
+def benchmark_union(ii, queries, k, repeat=3):
+    """
+    Compare the one-pass union (InvertedIndex.union) with the pairwise merge
+    (see pairwise_union) on the given queries, grouped by the number of
+    keywords (as returned by random_queries). For each number of keywords,
+    print the average number of postings and the average time of the
+    pairwise merge and of the one-pass union, for all results and for the
+    top-k, and check that all methods return the same results.
+    """
+    print("%-6s %10s %12s %10s %12s %10s %8s"
+          % ("#terms", "#postings", "pairwise", "union", "pairwise-k",
+             "union-k", "speedup"))
+    totals = [0, 0, 0, 0]
+    for group in queries:
+        times = [0, 0, 0, 0]
+        num_postings = 0
+        for keywords in group:
+            lists = [ii.inverted_lists[x] for x in keywords]
+            num_postings += sum(map(len, lists))
+            results = []
+            for i, (method, k_) in enumerate([
+                    (partial(pairwise_union, ii), None),
+                    (ii.union, None),
+                    (partial(pairwise_union, ii), k),
+                    (ii.union, k)]):
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    result = method(lists, k_)
+                    best = min(best, time.perf_counter() - start)
+                times[i] += best
+                results.append(result)
+            if results[0] != results[1] or results[2] != results[3]:
+                print("WARNING: Different results for query '%s'."
+                      % " ".join(keywords))
+        n = len(group)
+        print("%-6d %10d %10.2fms %8.2fms %10.2fms %8.2fms %7.1fx"
+              % (len(group[0]), num_postings / n, 1000 * times[0] / n,
+                 1000 * times[1] / n, 1000 * times[2] / n,
+                 1000 * times[3] / n, times[0] / max(times[1], 1e-9)))
+        totals = [x + y for x, y in zip(totals, times)]
+    print("%-6s %10s %10.2fms %8.2fms %10.2fms %8.2fms %7.1fx"
+          % ("total", "", *[1000 * x for x in totals],
+             totals[0] / max(totals[1], 1e-9)))
+
+
+def main(precomputed_file, query_file, k, union_terms=None, mode="or"):
+    # Read the precomputed inverted index and measure the time and the memory
+    # it takes (the increase of the maximum resident set size, in KB on
+    # Linux).
+    print("Reading from file '%s'." % precomputed_file)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    ii = load_index(precomputed_file)
+    print("Loaded the index in %.2fs, using %.1fMB of memory."
+          % (time.perf_counter() - start,
+             (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss)
+             / 1024))
+
+    if union_terms:
+        print("Comparing the one-pass union with the pairwise merge on "
+              "random queries with 1 to %d words.\n" % union_terms)
+        benchmark_union(ii, random_queries(ii, union_terms, 20), k)
+        return
+
+    print("Reading queries from file '%s'." % query_file)
+    queries = read_queries(query_file, ii.analyzer)
+
+    print("Comparing exhaustive and top-%d query processing (mode '%s').\n"
+          % (k, mode))
+    benchmark_top_k(ii, queries, k, mode=mode)
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Benchmark the query
+            processing of a precomputed inverted index. Compare the exhaustive
+            query processing with the top-k query processing.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            or as pickle. To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("query_file", type=str, nargs="?", help="""File
+            containing the queries, one per line. A benchmark file as used by
+            'evaluate.py' can be used as well. Not needed with --union.""")
+    parser.add_argument("-k", "--k", type=int, default=3, help="""Number of
+            results to compute in top-k mode (default: %(default)s)""")
+    parser.add_argument("-u", "--union", type=int, default=None,
+                        metavar="MAX_TERMS", help="""Instead of the queries
+            from the query file, benchmark the union of the inverted lists
+            (exhaustive query processing) on random queries with 1 to
+            MAX_TERMS frequent words, comparing the one-pass union with the
+            pairwise merge of the lists""")
+    parser.add_argument("-m", "--mode", type=str, default="or", choices=MODES,
+                        help="""Query mode of the queries from the query file:
+            the documents that contain any of the keywords, all keywords, or
+            the keywords as a phrase (default: %(default)s)""")
+    args = parser.parse_args()
+    if args.query_file is None and not args.union:
+        parser.error("the query_file is required without --union")
+    main(args.precomputed_file, args.query_file, args.k, args.union,
+         args.mode)
@@ -0,0 +1,429 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import struct
+import argparse
+import tempfile
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from inverted_index import InvertedIndex, PostingList, BLOCK_SIZE  # NOQA
+
+
+# The codecs for the posting blocks in the binary index format (see
+# index_format.py), by their number in the header. With "raw", the doc ids,
+# tf scores and BM25 scores are stored as they are. The other codecs store
+# the postings in blocks of BLOCK_SIZE postings, with the doc ids as gaps
+# (differences to the previous doc id) and the tf scores encoded with
+# variable-byte encoding or bit-packing, and the BM25 scores quantized to one
+# byte (see quantize).
+CODECS = ["raw", "varbyte", "bitpack"]
+
+# The header of a compressed inverted list: the scale of the quantized
+# scores (see quantize).
+LIST_HEADER = struct.Struct("<d")
+
+
+def encode_varbyte(values):
+    """
+    Encode the given non-negative integers with variable-byte encoding: 7
+    bits per byte, starting with the lowest bits, where the highest bit of a
+    byte is set if more bytes of the same integer follow.
+
+    >>> encode_varbyte([5, 127, 128, 300]).hex()
+    '057f8001ac02'
+    """
+    result = bytearray()
+    for value in values:
+        while value >= 128:
+            result.append(128 | (value & 127))
+            value >>= 7
+        result.append(value)
+    return bytes(result)
+
+
+def decode_varbyte(data, start, n):
+    """
+    Decode n integers encoded by encode_varbyte from the given bytes, starting
+    at the given position. Return the list of integers and the position after
+    them.
+
+    >>> decode_varbyte(bytes.fromhex("ff057f8001ac02"), 1, 4)
+    ([5, 127, 128, 300], 7)
+    """
+    # If none of the next n bytes has the highest bit set, each of them is an
+    # integer by itself. This is the common case for the doc id gaps of long
+    # lists and for tf scores.
+    values = data[start:start + n]
+    if len(values) == n and max(values, default=0) < 128:
+        return list(values), start + n
+
+    values = []
+    value = 0
+    shift = 0
+    end = start
+    while len(values) < n:
+        byte = data[end]
+        end += 1
+        if byte & 128:
+            value |= (byte & 127) << shift
+            shift += 7
+        else:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+    return values, end
+
+
+def encode_bitpack(values):
+    """
+    Encode the given non-negative integers with bit-packing: a byte with the
+    number of bits w of the largest integer, followed by the integers with w
+    bits each, starting with the lowest bits.
+
+    >>> encode_bitpack([5, 1, 7, 2]).hex()
+    '03cd05'
+    """
+    width = max(values, default=0).bit_length()
+    packed = 0
+    for i, value in enumerate(values):
+        packed |= value << (i * width)
+    return bytes([width]) + packed.to_bytes((len(values) * width + 7) // 8,
+                                            "little")
+
+
+def decode_bitpack(data, start, n):
+    """
+    Decode n integers encoded by encode_bitpack from the given bytes, starting
+    at the given position. Return the list of integers and the position after
+    them.
+
+    >>> decode_bitpack(bytes.fromhex("ff03cd05"), 1, 4)
+    ([5, 1, 7, 2], 4)
+    """
+    width = data[start]
+    end = start + 1 + (n * width + 7) // 8
+    packed = int.from_bytes(data[start + 1:end], "little")
+    mask = (1 << width) - 1
+    return [(packed >> i) & mask for i in range(0, n * width, width)], end
+
+
+ENCODERS = {"varbyte": encode_varbyte, "bitpack": encode_bitpack}
+DECODERS = {"varbyte": decode_varbyte, "bitpack": decode_bitpack}
+
+
+def quantize(scores):
+    """
+    Quantize the given (non-negative) scores to one byte each. Return the
+    scale and the bytes, where the score of a byte q is q * scale. Positive
+    scores are quantized to at least 1, so that they stay positive.
+
+    >>> scale, quantized = quantize([0.0, 0.5, 2.0, 0.001])
+    >>> list(quantized), [q * scale for q in quantized]
+    ([0, 64, 255, 1], [0.0, 0.5019607843137255, 2.0, 0.00784313725490196])
+    """
+    max_score = max(scores, default=0)
+    if max_score <= 0:
+        return 0.0, bytes(len(scores))
+    scale = max_score / 255
+    return scale, bytes(min(255, max(1, round(score / scale)))
+                        if score > 0 else 0 for score in scores)
+
+
+def encode_postings(inverted_list, codec):
+    """
+    Encode the postings of the given inverted list (with tf scores) with the
+    given codec (other than "raw"). The result consists of:
+
+    (1) the header (see LIST_HEADER), followed by
+    (2) the last doc id of each block (uint32),
+    (3) the position of each block in the block data (uint32, one per block
+        plus one),
+    (4) the maximal quantized score of each block (uint8),
+    (5) the block data: for each block, the quantized scores (one byte each),
+        followed by the doc id gaps and the tf scores, encoded with the codec.
+        The gap of the first doc id of a block is the difference to the last
+        doc id of the previous block (or 0).
+
+    >>> pl = PostingList([(1, 0.5), (3, 2.0), (300, 1.0)])
+    >>> pl.tfs = array("I", [1, 4, 2])
+    >>> encoded = encode_postings(pl, "varbyte")
+    >>> [encoded[i:j].hex() for i, j in [(8, 12), (12, 20), (20, 21),
+    ...                                   (21, 24), (24, 28), (28, 31)]]
+    ['2c010000', '000000000a000000', 'ff', '40ff80', '0102a902', '010402']
+    """
+    encode = ENCODERS[codec]
+    n = len(inverted_list)
+    doc_ids = inverted_list.doc_ids
+    tfs = inverted_list.tfs
+    scale, quantized = quantize(inverted_list.scores)
+
+    last_ids = array("I")
+    offsets = array("I", [0])
+    block_max_scores = bytearray()
+    data = bytearray()
+    previous_id = 0
+    for start in range(0, n, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, n)
+        gaps = [doc_ids[i] - (doc_ids[i - 1] if i > start else previous_id)
+                for i in range(start, end)]
+        previous_id = doc_ids[end - 1]
+        last_ids.append(previous_id)
+        block_max_scores.append(max(quantized[start:end]))
+        data += quantized[start:end]
+        data += encode(gaps)
+        data += encode(tfs[start:end])
+        offsets.append(len(data))
+
+    return b"".join([LIST_HEADER.pack(scale), last_ids.tobytes(),
+                     offsets.tobytes(), block_max_scores, data])
+
+
+class CompressedPostingList:
+    """
+    An inverted list encoded by encode_postings, with the same interface as
+    PostingList. Accessing doc_ids, scores or tfs decodes the whole list.
+    Top-k queries use views, which only decode the blocks they access.
+
+    >>> pl = PostingList([(i, i / 100) for i in range(1, 200, 2)])
+    >>> pl.tfs = array("I", range(100))
+    >>> for codec in ["varbyte", "bitpack"]:
+    ...     cpl = CompressedPostingList(encode_postings(pl, codec), 0, 100,
+    ...                                 codec)
+    ...     print(len(cpl), cpl[2][0], "%.3f" % cpl[2][1],
+    ...           list(cpl.doc_ids) == list(pl.doc_ids),
+    ...           list(cpl.tfs) == list(pl.tfs),
+    ...           ["%.3f" % x for x in cpl.block_max_scores()],
+    ...           cpl.last_doc_id())
+    100 5 0.047 True True ['1.272', '1.990'] 199
+    100 5 0.047 True True ['1.272', '1.990'] 199
+    """
+
+    # The binary index format has no positional postings, and compressed
+    # lists have no fields.
+    positions = title_tfs = None
+
+    def __init__(self, buffer, start, length, codec):
+        """
+        Creates the inverted list with the given number of postings, encoded
+        with the given codec in the given buffer (bytes or a memoryview),
+        starting at the given position.
+        """
+        self.length = length
+        self.codec = codec
+        self.decode = DECODERS[codec]
+        num_blocks = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        view = memoryview(buffer)
+        scale, = LIST_HEADER.unpack_from(view, start)
+        # The score of each quantized score.
+        self.table = [q * scale for q in range(256)]
+        start += LIST_HEADER.size
+        self.last_ids = view[start:start + 4 * num_blocks].cast("I")
+        start += 4 * num_blocks
+        self.offsets = view[start:start + 4 * (num_blocks + 1)].cast("I")
+        start += 4 * (num_blocks + 1)
+        self.block_max = view[start:start + num_blocks]
+        start += num_blocks
+        self.data = view[start:start + self.offsets[-1]]
+
+    def size(self):
+        """
+        Return the number of bytes of the encoded list.
+        """
+        return (LIST_HEADER.size + self.last_ids.nbytes + self.offsets.nbytes
+                + self.block_max.nbytes + self.data.nbytes)
+
+    def decode_block(self, b, with_tfs=False):
+        """
+        Decode the b-th block. Return the doc ids and the scores (and the tf
+        scores, if with_tfs is True), as lists.
+        """
+        start = self.offsets[b]
+        n = self.block_length(b)
+        scores = list(map(self.table.__getitem__, self.data[start:start + n]))
+        gaps, end = self.decode(self.data, start + n, n)
+        gaps[0] += self.last_ids[b - 1] if b > 0 else 0
+        doc_ids = list(accumulate(gaps))
+        if with_tfs:
+            return doc_ids, scores, self.decode(self.data, end, n)[0]
+        return doc_ids, scores
+
+    def block_max_scores(self):
+        """
+        Return the maximal score of each block.
+        """
+        return list(map(self.table.__getitem__, self.block_max))
+
+    def block_length(self, b):
+        """
+        Return the number of postings in the b-th block.
+        """
+        return min(BLOCK_SIZE, self.length - b * BLOCK_SIZE)
+
+    def last_doc_id(self):
+        """
+        Return the doc id of the last posting, the last doc id of the last
+        block (see PostingList.last_doc_id).
+        """
+        return self.last_ids[-1]
+
+    @property
+    def doc_ids(self):
+        doc_ids = array("I")
+        for b in range(len(self.last_ids)):
+            gaps, _ = self.decode(self.data,
+                                  self.offsets[b] + self.block_length(b),
+                                  self.block_length(b))
+            gaps[0] += self.last_ids[b - 1] if b > 0 else 0
+            doc_ids.extend(accumulate(gaps))
+        return doc_ids
+
+    @property
+    def scores(self):
+        quantized = bytearray()
+        for b in range(len(self.last_ids)):
+            start = self.offsets[b]
+            quantized += self.data[start:start + self.block_length(b)]
+        return array("d", map(self.table.__getitem__, quantized))
+
+    @property
+    def tfs(self):
+        tfs = array("I")
+        for b in range(len(self.last_ids)):
+            tfs.extend(self.decode_block(b, with_tfs=True)[2])
+        return tfs
+
+    def views(self):
+        """
+        Return the doc ids and the scores as sequences, together with a
+        function to find a doc id (see PostingList.views). The sequences
+        decode the block of the accessed position, the function first skips
+        to the block that can contain the doc id, using the last doc id of
+        each block.
+        """
+        block = BlockCache(self)
+        return block.doc_ids, block.scores, block.bisect
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        doc_ids, scores = self.decode_block(i // BLOCK_SIZE)
+        return (doc_ids[i % BLOCK_SIZE], scores[i % BLOCK_SIZE])
+
+    def __iter__(self):
+        return zip(self.doc_ids, self.scores)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "CompressedPostingList(%s)" % list(self)
+
+
+class BlockCache:
+    """
+    The block of a CompressedPostingList that was accessed last, decoded.
+    Used for the views of the list.
+    """
+
+    def __init__(self, inverted_list):
+        self.inverted_list = inverted_list
+        self.block = -1
+        self.block_doc_ids = self.block_scores = None
+        self.doc_ids = BlockView(self, 0)
+        self.scores = BlockView(self, 1)
+
+    def load(self, b):
+        if b != self.block:
+            self.block = b
+            self.block_doc_ids, self.block_scores = \
+                self.inverted_list.decode_block(b)
+
+    def bisect(self, doc_id, lo):
+        """
+        Return the position of the first posting at or after position lo
+        with a doc id >= the given doc id.
+        """
+        inverted_list = self.inverted_list
+        b = bisect_left(inverted_list.last_ids, doc_id, lo // BLOCK_SIZE)
+        if b == len(inverted_list.last_ids):
+            return len(inverted_list)
+        self.load(b)
+        start = b * BLOCK_SIZE
+        return start + bisect_left(self.block_doc_ids, doc_id,
+                                   max(lo - start, 0))
+
+
+class BlockView:
+    """
+    The doc ids (part 0) or the scores (part 1) of a CompressedPostingList,
+    as a sequence that decodes the block of the accessed position.
+    """
+
+    def __init__(self, cache, part):
+        self.cache = cache
+        self.part = part
+
+    def __len__(self):
+        return len(self.cache.inverted_list)
+
+    def __getitem__(self, i):
+        self.cache.load(i // BLOCK_SIZE)
+        if self.part == 0:
+            return self.cache.block_doc_ids[i % BLOCK_SIZE]
+        return self.cache.block_scores[i % BLOCK_SIZE]
+
+
+def main(precomputed_file, query_file, k, repeat):
+    # The modules are imported here, since they import this module.
+    from index_format import load_index, write_index
+    from benchmark import read_queries, time_queries
+
+    print("Reading from file '%s'." % precomputed_file)
+    ii = load_index(precomputed_file, in_memory=True)
+    queries = read_queries(query_file, ii.analyzer)
+    print("Comparing the codecs on %d queries.\n" % len(queries))
+
+    print("%-10s %10s %12s %12s" % ("codec", "size (MB)", "exhaustive",
+                                    "top-%d" % k))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec in CODECS:
+            file_name = os.path.join(tmp_dir, "%s.idx" % codec)
+            write_index(ii, file_name, codec)
+            # The fastest of the repeated runs does not include the I/O.
+            mapped = load_index(file_name)
+            _, exhaustive_times = time_queries(mapped, queries, None, repeat)
+            _, top_k_times = time_queries(mapped, queries, k, repeat)
+            print("%-10s %10.1f %10.2fms %10.2fms"
+                  % (codec, os.path.getsize(file_name) / 2**20,
+                     1000 * sum(exhaustive_times) / len(queries),
+                     1000 * sum(top_k_times) / len(queries)))
+            del mapped
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Compare the codecs for
+            the posting blocks of the binary index format: write the given
+            index with each codec and print the size of the file and the
+            average time per query, for the exhaustive and for the top-k
+            query processing.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            or as pickle. To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("query_file", type=str, help="""File containing the
+            queries, one per line. A benchmark file as used by 'evaluate.py'
+            can be used as well.""")
+    parser.add_argument("-k", "--k", type=int, default=3, help="""Number of
+            results to compute in top-k mode (default: %(default)s)""")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="""Number
+            of runs per query, the fastest run is taken (default:
+            %(default)s)""")
+    args = parser.parse_args()
+    main(args.precomputed_file, args.query_file, args.k, args.repeat)
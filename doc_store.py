@@ -0,0 +1,194 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import mmap
+import zlib
+from array import array
+from functools import lru_cache
+from collections.abc import Sequence
+
+
+# The number of decompressed blocks kept in the cache of a DocStore.
+BLOCK_CACHE_SIZE = 32
+
+
+class DocStore(Sequence):
+    """
+    The docs of a collection, each in form (title, description), read on
+    demand from a buffer (usually an mmap of a file). Only the offsets of the
+    docs are kept in memory (8 bytes per doc), a doc is only read (and
+    decoded) when it is accessed.
+
+    With a block size of 0, the buffer contains the text of each doc (as
+    <title>TAB<description>, in UTF-8), and offsets[i] is the position of
+    the i-th doc (with one more offset for the end of the last doc). The text
+    between two offsets is stripped, so the buffer can also be a TSV file
+    with one doc per line (see open_tsv).
+
+    With a block size n > 0, the docs are stored in blocks of n docs (see
+    DocStoreWriter), each compressed by zlib, and offsets[b] is the position
+    of the b-th block. The most recently used decompressed blocks are kept in
+    a cache.
+
+    >>> docs = [("Up", "An old man flies his house."), ("Cars", "Race cars.")]
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> writer = DocStoreWriter(f, block_size=0)
+    >>> for doc in docs:
+    ...     writer.add("\\t".join(doc))
+    >>> offsets = writer.finish()
+    >>> store = DocStore(f.getvalue(), offsets, len(docs))
+    >>> store[1], len(store), list(store) == docs
+    (('Cars', 'Race cars.'), 2, True)
+    >>> f = io.BytesIO()
+    >>> writer = DocStoreWriter(f, block_size=64)
+    >>> for doc in docs * 100:
+    ...     writer.add("\\t".join(doc))
+    >>> offsets = writer.finish()
+    >>> store = DocStore(f.getvalue(), offsets, 200, block_size=64)
+    >>> store[-1], store[64:66], list(store) == docs * 100
+    ... # doctest: +NORMALIZE_WHITESPACE
+    (('Cars', 'Race cars.'), [('Up', 'An old man flies his house.'), ('Cars',
+    'Race cars.')], True)
+    >>> len(f.getvalue()) < sum(len("\\t".join(doc)) for doc in docs * 100)
+    True
+    >>> store[200]
+    Traceback (most recent call last):
+        ...
+    IndexError: doc index out of range
+    """
+
+    def __init__(self, buffer, offsets, num_docs, block_size=0,
+                 cache_size=BLOCK_CACHE_SIZE):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.num_docs = num_docs
+        self.block_size = block_size
+        self.read_block = lru_cache(cache_size)(self.read_block)
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("doc index out of range")
+        if self.block_size:
+            block, doc_offsets = self.read_block(i // self.block_size)
+            j = i % self.block_size
+            text = block[doc_offsets[j]:doc_offsets[j + 1]]
+        else:
+            text = self.buffer[self.offsets[i]:self.offsets[i + 1]]
+        return tuple(bytes(text).decode("utf-8").strip().split("\t"))
+
+    def __reduce__(self):
+        # A DocStore is pickled as the list of its docs, since the buffer
+        # cannot be pickled.
+        return list, (list(self),)
+
+    def read_block(self, b):
+        """
+        Return the b-th block, decompressed, and the offsets of its docs in
+        the decompressed block.
+        """
+        block = zlib.decompress(
+            self.buffer[self.offsets[b]:self.offsets[b + 1]])
+        num_docs = min(self.block_size, self.num_docs - b * self.block_size)
+        header_size = 4 * (num_docs + 1)
+        doc_offsets = array("I", block[:header_size])
+        return memoryview(block)[header_size:], doc_offsets
+
+
+class DocStoreWriter:
+    """
+    Writes the texts of docs to a file (at its current position), in the
+    format read by DocStore. With a block size n > 0, the docs are written in
+    blocks of n docs: the offsets of the docs in the block (uint32, relative
+    to the first doc, one per doc plus one) followed by their texts,
+    compressed by zlib.
+    """
+
+    def __init__(self, f, block_size=0):
+        self.f = f
+        self.block_size = block_size
+        self.offsets = array("Q")
+        self.block = []
+
+    def add(self, text):
+        """
+        Write the given text of a doc (<title>TAB<description>).
+        """
+        text = text.encode("utf-8")
+        if not self.block_size:
+            self.offsets.append(self.f.tell())
+            self.f.write(text)
+            return
+        self.block.append(text)
+        if len(self.block) == self.block_size:
+            self.write_block()
+
+    def write_block(self):
+        """
+        Write the docs of the current block, compressed.
+        """
+        doc_offsets = array("I", [0])
+        for text in self.block:
+            doc_offsets.append(doc_offsets[-1] + len(text))
+        self.offsets.append(self.f.tell())
+        self.f.write(zlib.compress(doc_offsets.tobytes()
+                                   + b"".join(self.block)))
+        self.block = []
+
+    def finish(self):
+        """
+        Write the last (partial) block and return the offsets of the docs (or
+        of the blocks), with the end of the last one as the last offset.
+        """
+        if self.block:
+            self.write_block()
+        self.offsets.append(self.f.tell())
+        return self.offsets
+
+
+def tsv_offsets(file_name):
+    """
+    Return the position of each line of the given file, and the size of the
+    file at the end. Lines are separated as by inverted_index.read_lines,
+    that is, by LF, CR or CRLF.
+
+    >>> list(tsv_offsets("example.tsv"))
+    [0, 24, 51, 76, 111]
+    """
+    offsets = array("Q")
+    position = 0
+    with open(file_name, "rb") as f:
+        for raw_line in f:
+            for line in raw_line.splitlines(keepends=True):
+                offsets.append(position)
+                position += len(line)
+    offsets.append(position)
+    return offsets
+
+
+def open_tsv(file_name):
+    """
+    Return the docs of the given file (one doc per line, in the format
+    <title>TAB<description>) as a DocStore on an mmap of the file. Only the
+    offsets of the lines are read into memory.
+
+    >>> docs = open_tsv("example.tsv")
+    >>> len(docs), docs[3]
+    (4, ('Movie   Short animated short film.',))
+    """
+    offsets = tsv_offsets(file_name)
+    if offsets[-1] == 0:
+        return DocStore(b"", offsets, 0)
+    with open(file_name, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return DocStore(mm, offsets, len(offsets) - 1)
@@ -5,11 +5,14 @@ Claudius Korzen <korzen@cs.uni-freiburg.de>
 Theresa Klumpp <klumppt@cs.uni-freiburg.de>
 """
 
-import re
+import time
 import argparse
 import pickle
+import multiprocessing
 
-from inverted_index import InvertedIndex  # NOQA
+from inverted_index import InvertedIndex, MODES  # NOQA
+from index_format import load_index
+from profiling import Profiler
 
 
 def read_benchmark(file_name):
@@ -34,13 +37,23 @@ def read_benchmark(file_name):
     return benchmark
 
 
-def evaluate(ii, benchmark, verbose=True):
+def evaluate(ii, benchmark, verbose=True, workers=1, index_file=None,
+             mode="or"):
     """
     Evaluate the given inverted index against the given benchmark as
     follows. Process each query in the benchmark with the given inverted
-    index and compare the result list with the groundtruth in the
+    index (in the given query mode, see InvertedIndex.process_query) and
+    compare the result list with the groundtruth in the
     benchmark. For each query, compute and print (if verbose=True) the
     measure P@3, P@R and AP as well as mean P@3, mean P@R and mean AP.
+    Queries with the same keywords are processed only once. With several
+    workers, the queries are processed in parallel by worker processes,
+    which load the index from the given file of the index (see init_worker).
+    If verbose=True, also print the time for each query and for each phase
+    of the evaluation. If the index has a profiler (see profiling.py), the
+    phases of the queries are recorded by it (also those in the worker
+    processes), and the phases of the evaluation as "evaluate/queries" and
+    "evaluate/measures".
     Return a dictionary with one entry for each query and one entry for the
     mean. The keys are the keywords of the query (or "mean" for the mean) and
     values are dictionaries with an entry "precision", which contains lists of
@@ -60,6 +73,18 @@ def evaluate(ii, benchmark, verbose=True):
     [1, 3, 4]
     >>> [round(x, 3) for x in evaluation["animated film"]["precision"]]
     [0.667, 0.667, 0.389]
+    >>> import tempfile, os
+    >>> from index_format import write_index
+    >>> index_file = os.path.join(tempfile.mkdtemp(), "example.idx")
+    >>> write_index(ii, index_file)
+    >>> evaluate(ii, benchmark, verbose=False, workers=2,
+    ...          index_file=index_file) == evaluation
+    True
+    >>> evaluation = evaluate(ii, benchmark, verbose=False, mode="and")
+    >>> evaluation["animated film"]["result_ids"]
+    [2, 4]
+    >>> [round(x, 3) for x in evaluation["mean"]["precision"]]
+    [0.333, 0.417, 0.333]
     """
     evaluation = {}
     sum_p_at_3 = 0
@@ -68,36 +93,56 @@ def evaluate(ii, benchmark, verbose=True):
 
     num_queries = len(benchmark)
 
+    # Split the queries into keywords (like the docs of the index) and
+    # collect the distinct ones.
+    keywords = {query: tuple(ii.analyzer.analyze(query))
+                for query in benchmark}
+    distinct_keywords = list(dict.fromkeys(keywords.values()))
+
+    # Process the distinct queries by the index.
+    start = time.perf_counter()
+    if workers > 1 and index_file is None:
+        raise ValueError("The workers need the file of the index.")
+    if workers > 1 and ii.profiler.enabled:
+        # The workers send the report of their profiler with each result.
+        with multiprocessing.Pool(workers, init_worker,
+                                  (index_file, False, None, mode,
+                                   True)) as pool:
+            results = pool.map(process_profiled_query, distinct_keywords)
+        for _, _, report in results:
+            ii.profiler.merge(report)
+        results = [(result_ids, seconds) for result_ids, seconds, _ in results]
+    elif workers > 1:
+        with multiprocessing.Pool(workers, init_worker,
+                                  (index_file, False, None, mode)) as pool:
+            results = pool.map(process_benchmark_query, distinct_keywords)
+    else:
+        results = [process_benchmark_query(x, ii, mode)
+                   for x in distinct_keywords]
+    results = dict(zip(distinct_keywords, results))
+    query_time = time.perf_counter() - start
+
+    # Compute the measures for each query.
+    start = time.perf_counter()
     for query, relevant_ids in benchmark.items():
-        if verbose:
-            print("Processing query '%s' ..." % query)
-
-        # Process the query by the index and fetch only the document ids.
-        words = [x.lower().strip() for x in re.split("[^A-Za-z]+", query)]
-        result_ids = [x[0] for x in ii.process_query(words)]
-
-        # Compute P@3.
-        p_at_3 = precision_at_k(result_ids, relevant_ids, 3)
+        result_ids, seconds = results[keywords[query]]
+        p_at_3, p_at_r, ap = compute_measures(result_ids, relevant_ids)
         sum_p_at_3 += p_at_3
-        if verbose:
-            print("  P@3: %.2f" % p_at_3)
-
-        # Compute P@R.
-        r = len(relevant_ids)
-        p_at_r = precision_at_k(result_ids, relevant_ids, r)
         sum_p_at_r += p_at_r
-        if verbose:
-            print("  P@R: %.2f" % p_at_r)
-
-        # Compute AP.
-        ap = average_precision(result_ids, relevant_ids)
         sum_ap += ap
         if verbose:
+            print("Query '%s' (%d results in %.1fms):"
+                  % (query, len(result_ids), 1000 * seconds))
+            print("  P@3: %.2f" % p_at_3)
+            print("  P@R: %.2f" % p_at_r)
             print("  AP: %.2f" % ap)
 
         evaluation[query] = {"precision": [p_at_3, p_at_r, ap],
                              "result_ids": result_ids,
                              "relevant_ids": relevant_ids}
+    measure_time = time.perf_counter() - start
+    ii.profiler.add_time("evaluate/queries", query_time)
+    ii.profiler.add_time("evaluate/measures", measure_time)
 
     # Compute MP@3.
     mp_at_3 = sum_p_at_3 / num_queries
@@ -111,10 +156,110 @@ def evaluate(ii, benchmark, verbose=True):
         print("  MP@3: %s" % round(mp_at_3, 3))
         print("  MP@R: %s" % round(mp_at_r, 3))
         print("  MAP:  %s" % round(map_value, 3))
+        print("Processed %d distinct queries (of %d) in %.2fs with %d "
+              "worker(s), computed the measures in %.3fs."
+              % (len(distinct_keywords), num_queries, query_time, workers,
+                 measure_time))
 
     return evaluation
 
 
+# The index (and the benchmark and the query mode) used by the worker
+# processes of evaluate and sweep.
+worker_index = None
+worker_benchmark = None
+worker_mode = "or"
+
+
+def set_worker(ii, benchmark=None, mode="or", profile=False):
+    global worker_index, worker_benchmark, worker_mode
+    worker_index = ii
+    worker_benchmark = benchmark
+    worker_mode = mode
+    if profile:
+        # Each worker records its queries with its own profiler.
+        ii.profiler = Profiler()
+
+
+def init_worker(index_file, in_memory=False, benchmark=None, mode="or",
+                profile=False):
+    """
+    Load the index of a worker process from the given file (see
+    index_format.load_index). The index is not sent to the workers, so they
+    can be started by fork, spawn or forkserver alike, and the workers share
+    the pages of a memory-mapped index.
+    """
+    set_worker(load_index(index_file, in_memory=in_memory), benchmark, mode,
+               profile)
+
+
+def process_benchmark_query(keywords, ii=None, mode=None):
+    """
+    Process the query with the given keywords by the given index in the
+    given query mode (by default, the index and the mode of the worker).
+    Return the ids of the result documents (sorted by score) and the time it
+    took to process the query (in seconds).
+    """
+    if ii is None:
+        ii = worker_index
+    if mode is None:
+        mode = worker_mode
+    start = time.perf_counter()
+    result = ii.process_query(list(keywords), mode=mode)
+    return [x[0] for x in result], time.perf_counter() - start
+
+
+def process_profiled_query(keywords):
+    """
+    Same as process_benchmark_query with the index of the worker, but also
+    return the report of the profiler of the worker for the query (see
+    profiling.Profiler.pop_report).
+    """
+    result_ids, seconds = process_benchmark_query(keywords)
+    return result_ids, seconds, worker_index.profiler.pop_report()
+
+
+def compute_measures(result_ids, relevant_ids):
+    """
+    Compute the measures P@3, P@R and AP for the given list of result ids as
+    it was returned by the inverted index for a single query, and the given
+    set of relevant document ids, in one pass over the result ids (which
+    stops as soon as all relevant ids have been found). The values are the
+    same as computed by precision_at_k and average_precision.
+
+    >>> compute_measures([5, 3, 6, 1, 2], {1, 2, 5, 6, 7, 8})
+    (0.6666666666666666, 0.6666666666666666, 0.5361111111111111)
+    >>> compute_measures([7, 17, 9, 42, 5], {5, 7, 12, 42})
+    (0.3333333333333333, 0.5, 0.525)
+    >>> compute_measures([], {1})
+    (0.0, 0.0, 0.0)
+    """
+    r = len(relevant_ids)
+    num_relevant_result_ids = 0
+    num_relevant_at_3 = None
+    num_relevant_at_r = None
+    sum_ap = 0
+    for i, result_id in enumerate(result_ids, 1):
+        if result_id in relevant_ids:
+            num_relevant_result_ids += 1
+            sum_ap += num_relevant_result_ids / i
+        if i == 3:
+            num_relevant_at_3 = num_relevant_result_ids
+        if i == r:
+            num_relevant_at_r = num_relevant_result_ids
+        if num_relevant_result_ids == r and i >= 3:
+            break
+    # If the result list is shorter than k (or all relevant ids were found
+    # before position k), all relevant results are within the top-k.
+    if num_relevant_at_3 is None:
+        num_relevant_at_3 = num_relevant_result_ids
+    if num_relevant_at_r is None:
+        num_relevant_at_r = num_relevant_result_ids
+    return (num_relevant_at_3 / 3,
+            num_relevant_at_r / r if r > 0 else 0,
+            sum_ap / r)
+
+
 def precision_at_k(result_ids, relevant_ids, k):
     """
     Compute the measure P@k for the given list of result ids as it was
@@ -155,34 +300,222 @@ def average_precision(result_ids, relevant_ids):
     """
 
     sum_ap = 0
+    num_relevant_result_ids = 0
     for i in range(0, len(result_ids)):
         if result_ids[i] in relevant_ids:
-            sum_ap += precision_at_k(result_ids, relevant_ids, i + 1)
+            # This is P@(i+1), counted incrementally instead of calling
+            # precision_at_k, which would make the computation quadratic.
+            num_relevant_result_ids += 1
+            sum_ap += num_relevant_result_ids / (i + 1)
     return sum_ap / len(relevant_ids)
 
 
-def main(precomputed_file, benchmark_file):
+def parse_values(text):
+    """
+    Parse a comma-separated list of values, where each value is either a
+    number or a range of form <start>:<stop>:<step> (including the stop).
+
+    >>> parse_values("0.5,1.2")
+    [0.5, 1.2]
+    >>> parse_values("0:1:0.25,1.75")
+    [0.0, 0.25, 0.5, 0.75, 1.0, 1.75]
+    """
+    values = []
+    for part in text.split(","):
+        if ":" in part:
+            start, stop, step = (float(x) for x in part.split(":"))
+            num_steps = int(round((stop - start) / step))
+            values.extend(round(start + i * step, 10)
+                          for i in range(num_steps + 1))
+        else:
+            values.append(float(part))
+    return values
+
+
+def evaluate_setting(b, k, title_weight=None):
+    """
+    Re-compute the BM25 scores of the index of the sweep with the given b and
+    k (unless the index already has them) and evaluate it against the
+    benchmark of the sweep. With a title weight, the queries use it as the
+    weight of the title in the BM25F scores instead (see
+    InvertedIndex.set_query_field_weights), the scores of the index are not
+    re-computed for it. Return the mean measures.
+    """
+    if (b, k) != (worker_index.b, worker_index.k):
+        worker_index.rescore(b=b, k=k)
+    if title_weight is not None:
+        worker_index.set_query_field_weights(
+            (title_weight, *worker_index.field_weights[1:]))
+    evaluation = evaluate(worker_index, worker_benchmark, verbose=False,
+                          mode=worker_mode)
+    return evaluation["mean"]["precision"]
+
+
+def evaluate_profiled_setting(*setting):
+    """
+    Same as evaluate_setting, but also return the report of the profiler of
+    the worker for the setting (see profiling.Profiler.pop_report).
+    """
+    return evaluate_setting(*setting), worker_index.profiler.pop_report()
+
+
+def sweep(ii, benchmark, settings, workers=1, index_file=None, mode="or"):
+    """
+    Evaluate the given inverted index against the given benchmark (in the
+    given query mode) for each of the given settings (b, k) of the BM25
+    parameters, or (b, k, title weight) for an index with fields (see
+    evaluate_setting). The BM25 scores are re-computed for each b and k (see
+    InvertedIndex.rescore), so for several values of b and k the given index
+    has to be in memory and is changed. With several workers, the settings
+    are evaluated in parallel, each worker process opens the index from the
+    given file of the index (see init_worker; in memory, if the scores are
+    re-computed; with a profiler, the reports of the workers are merged into
+    the profiler of the given index). Return a list with the mean measures
+    [MP@3, MP@R, MAP] for each setting.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> benchmark = read_benchmark("example-benchmark.tsv")
+    >>> results = sweep(ii, benchmark, [(0.75, 1.75), (0, 0.5)])
+    >>> [[round(x, 3) for x in result] for result in results]
+    [[0.667, 0.833, 0.694], [0.667, 0.583, 0.611]]
+
+    The weight of the title is changed at query time only, so an index with
+    fields can be evaluated for many title weights without re-computing the
+    scores of the index.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example-fields.tsv", verbose=False, fields=True)
+    >>> benchmark = {"short film": {1, 3}}
+    >>> results = sweep(ii, benchmark, [(0.75, 1.75, 0), (0.75, 1.75, 3)])
+    >>> [[round(x, 3) for x in result] for result in results]
+    [[0.667, 0.5, 0.833], [0.667, 1.0, 1.0]]
+    >>> ii.field_weights, ii.query_field_weights
+    ((2.0, 1.0), (3.0, 1.0))
+    """
+    if workers > 1 and index_file is None:
+        raise ValueError("The workers need the file of the index.")
+    # The workers only need the index in memory to re-compute its scores.
+    in_memory = any((b, k) != (ii.b, ii.k) for b, k, *_ in settings)
+    if workers > 1 and ii.profiler.enabled:
+        with multiprocessing.Pool(workers, init_worker,
+                                  (index_file, in_memory, benchmark, mode,
+                                   True)) as pool:
+            results = pool.starmap(evaluate_profiled_setting, settings)
+        for _, report in results:
+            ii.profiler.merge(report)
+        return [result for result, _ in results]
+    if workers > 1:
+        with multiprocessing.Pool(workers, init_worker,
+                                  (index_file, in_memory, benchmark,
+                                   mode)) as pool:
+            return pool.starmap(evaluate_setting, settings)
+    set_worker(ii, benchmark, mode)
+    return [evaluate_setting(*setting) for setting in settings]
+
+
+def print_sweep(settings, results):
+    """
+    Print the results of a sweep as a table, with the best setting (by MAP)
+    marked with a '*'. Settings with a title weight get a column for it.
+
+    >>> print_sweep([(0.5, 1.0), (0.75, 1.75)],
+    ...             [[0.5, 0.4, 0.3], [0.6, 0.5, 0.4]])
+         b      k   MP@3   MP@R    MAP
+      0.50   1.00  0.500  0.400  0.300
+      0.75   1.75  0.600  0.500  0.400 *
+    >>> print_sweep([(0.75, 1.75, 1.0), (0.75, 1.75, 3.0)],
+    ...             [[0.6, 0.5, 0.4], [0.5, 0.4, 0.3]])
+         b      k  title   MP@3   MP@R    MAP
+      0.75   1.75   1.00  0.600  0.500  0.400 *
+      0.75   1.75   3.00  0.500  0.400  0.300
+    """
+    best = max(range(len(results)), key=lambda i: results[i][2])
+    columns = ["b", "k", "title"][:len(settings[0])]
+    print(" ".join("%6s" % x for x in columns + ["MP@3", "MP@R", "MAP"]))
+    for i, (setting, result) in enumerate(zip(settings, results)):
+        print(" ".join("%6.2f" % x for x in setting)
+              + " %6.3f %6.3f %6.3f%s"
+              % (*result, " *" if i == best else ""))
+
+
+def main(precomputed_file, benchmark_file, sweep_b=None, sweep_k=None,
+         workers=1, mode="or", profile_file=None, sweep_title_weight=None):
     """
     Evaluate a precomputed inverted index on a benchmark.
     Save the evaluation results in a pickle file in a dictionary (see
     "evaluate" for more information).
+    If values for b, k or the title weight (for an index with fields) are
+    given for a sweep, evaluate the index for each combination of the values
+    instead, and print the results as a table.
+    If a profile file is given, write the timings of the queries and of the
+    phases of the evaluation to it, as JSON (see profiling.py).
     """
+    if (sweep_b is not None or sweep_k is not None
+            or sweep_title_weight is not None):
+        # Read the index into memory if the scores are re-computed per
+        # setting (the title weights are only used by the queries).
+        print("Reading from file '%s'..." % precomputed_file)
+        index = load_index(precomputed_file, in_memory=(
+            sweep_b is not None or sweep_k is not None))
+        if sweep_title_weight is not None and index.field_weights is None:
+            raise ValueError("The index has no fields, it has to be built "
+                             "with 'inverted_index.py --fields'.")
+        if profile_file is not None:
+            index.profiler = Profiler()
+        print("Reading benchmark from file '%s'..." % benchmark_file)
+        benchmark = read_benchmark(benchmark_file)
+
+        settings = [(b, k) for b in (sweep_b or [index.b])
+                    for k in (sweep_k or [index.k])]
+        if sweep_title_weight is not None:
+            settings = [(b, k, w) for b, k in settings
+                        for w in sweep_title_weight]
+        print("Evaluating %d settings with %d worker(s)..."
+              % (len(settings), workers))
+        results = sweep(index, benchmark, settings, workers,
+                        precomputed_file, mode)
+        print_sweep(settings, results)
+        write_profile(index.profiler, profile_file, precomputed_file,
+                      benchmark_file, workers, mode)
+        return
+
     # Create the precomputed inverted index from the given file.
     print("Reading from file '%s'..." % precomputed_file)
-    index = pickle.load(open(precomputed_file, "rb"))
+    index = load_index(precomputed_file)
+    if profile_file is not None:
+        index.profiler = Profiler()
 
     # Read the benchmark.
     print("Reading benchmark from file '%s'..." % benchmark_file)
     benchmark = read_benchmark(benchmark_file)
 
     # Evaluate the the inverted index against the benchmark.
-    evaluation = evaluate(index, benchmark)
+    evaluation = evaluate(index, benchmark, workers=workers,
+                          index_file=precomputed_file, mode=mode)
 
     new_name = (benchmark_file.replace("input", "output")
                               .replace(".tsv", "_")) + "evaluation.pkl"
     print(f"Saving evaluation data as {new_name}.")
     pickle.dump(evaluation,
                 open(new_name, "wb"))
+    write_profile(index.profiler, profile_file, precomputed_file,
+                  benchmark_file, workers, mode)
+
+
+def write_profile(profiler, profile_file, precomputed_file, benchmark_file,
+                  workers, mode):
+    """
+    Write the report of the given profiler to the given profile file (see
+    profiling.Profiler.write), with the arguments of the evaluation. Do
+    nothing if the profile file is None.
+    """
+    if profile_file is None:
+        return
+    print("Saving profile as '%s'." % profile_file)
+    profiler.write(profile_file, program="evaluate.py",
+                   index_file=precomputed_file, benchmark_file=benchmark_file,
+                   workers=workers, mode=mode)
 
 
 if __name__ == "__main__":
@@ -191,14 +524,44 @@ if __name__ == "__main__":
             against a benchmark. Compute the measures precision at 3, precision
             at R and average precision. Save the data from the evaluation using
             pickle.""")
-    parser.add_argument("precomputed_file", type=str, help="""Pickle file
-            containing a precomputed inverted index. To generate such a file,
-            use 'inverted_index.py'.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            or as pickle. To generate such a file, use 'inverted_index.py'.""")
     parser.add_argument("benchmark_file", type=str, help="""File containing the
             benchmark. The expected format of the file is one query per line,
             with the ids of all documents relevant for that query, like:
             <query>TAB<id1>WHITESPACE<id2>WHITESPACE<id3> ...""")
+    parser.add_argument("--sweep-b", type=parse_values, default=None,
+                        help="""Values of the BM25 parameter b to evaluate,
+            comma-separated, each a number or a range <start>:<stop>:<step>
+            (e.g. '0:1:0.25'). If this or --sweep-k is given, the index is
+            evaluated for each combination of b and k and the results are
+            printed as a table instead of being saved.""")
+    parser.add_argument("--sweep-k", type=parse_values, default=None,
+                        help="""Values of the BM25 parameter k to evaluate,
+            in the same format as --sweep-b.""")
+    parser.add_argument("--sweep-title-weight", type=parse_values,
+                        default=None, metavar="VALUES", help="""Weights of
+            the title in the BM25F scores to evaluate, in the same format as
+            --sweep-b (only for an index with fields, see 'inverted_index.py
+            --fields'). The weights are only used by the queries, the scores
+            of the index are not re-computed for them, so an index in the
+            binary format is not read into memory unless --sweep-b or
+            --sweep-k is given as well.""")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="""Number of processes used to process the
+            queries (or to evaluate the settings of a sweep) in parallel
+            (default: %(default)s)""")
+    parser.add_argument("-m", "--mode", type=str, default="or", choices=MODES,
+                        help="""Query mode: the results are the documents
+            that contain any of the keywords, all keywords, or the keywords as
+            a phrase, in the given order (default: %(default)s)""")
+    parser.add_argument("--profile", type=str, default=None, metavar="FILE",
+                        help="""Write the timings of the queries (the time of
+            each query and of its phases, and the number of postings touched)
+            and of the phases of the evaluation to FILE, as JSON""")
     args = parser.parse_args()
     precomputed_file = args.precomputed_file
     benchmark_file = args.benchmark_file
-    main(precomputed_file, benchmark_file)
+    main(precomputed_file, benchmark_file, args.sweep_b, args.sweep_k,
+         args.workers, args.mode, args.profile, args.sweep_title_weight)
@@ -0,0 +1,643 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+
+from inverted_index import (InvertedIndex, PostingList, BLOCK_SIZE,
+                            impact_order)
+from analyzer import Analyzer
+from compression import (CODECS, CompressedPostingList, encode_postings,
+                         quantize)
+from doc_store import DocStore, DocStoreWriter
+from vocabulary import VocabularyIndex, build_qgram_index
+
+
+# The binary index format. All numbers are stored in little-endian byte
+# order. The file starts with a header, followed by these sections:
+#
+# (1) The doc store: the text of each doc, as <title>TAB<description>, in
+#     UTF-8. With a doc block size n > 0, the docs are stored in blocks of n
+#     docs, compressed by zlib instead (see doc_store.DocStoreWriter).
+# (2) The posting blocks: for each word, the doc ids (uint32), the tf scores
+#     (uint32), the tf scores in the titles (uint32, only for an index with
+#     fields), the BM25 scores (float32) and the maximal score of each block
+#     of BLOCK_SIZE postings (float32). With a codec other than "raw", the
+#     postings are compressed instead (see compression.encode_postings).
+# (3) The document lengths (uint32, one per doc), followed by the lengths of
+#     the titles (uint32, one per doc, only for an index with fields).
+# (4) The doc offsets (uint64, one per doc plus one): the position of the
+#     text of each doc in the file (with a doc block size n > 0, one per
+#     block plus one: the position of each block).
+# (5) The vocabulary: the words in sorted order (UTF-8), followed by the word
+#     offsets (uint64, one per word plus one): the position of each word in
+#     the file.
+# (6) The offset table: the position of the posting block of each word in the
+#     file (uint64), followed by the number of postings of each word (uint32).
+# (7) The impact orders (only with an impact size n > 0): the start of the
+#     impact order of each word in the following positions (uint64, one per
+#     word plus one), followed by the positions of the impact order of each
+#     word with more than n postings (uint32, see InvertedIndex.impact_size).
+# (8) The q-gram index of the vocabulary (see vocabulary.build_qgram_index):
+#     the start of the positions of each q-gram key (uint64, one per key plus
+#     one), followed by the keys in ascending order (uint32) and the
+#     positions of the words with each key (uint32).
+#
+# The header contains the magic bytes, the format version, the number of
+# docs, the number of words, the parameters b and k of the BM25 scores, the
+# positions of the sections (3) to (6), the stages of the analyzer that split
+# the docs into words (see Analyzer.flags), the codec of the posting blocks
+# (the position in compression.CODECS), the doc block size (0 for an
+# uncompressed doc store), the impact size, the position of section (7)
+# (0 without impact orders), the position of the title lengths in section
+# (3) (0 without fields), the weights of the title and the description (see
+# InvertedIndex.field_weights), the position of section (8) (0 without a
+# q-gram index) and the number of q-gram keys. Files of other versions
+# cannot be read, they have to be written again.
+MAGIC = b"IIDX"
+VERSION = 8
+HEADER = struct.Struct("<4sIII2d5QIIIIQQ2dQI")
+
+
+class MappedInvertedLists(Mapping):
+    """
+    The inverted lists of a MappedInvertedIndex, as a mapping from words to
+    PostingList. Words are looked up by binary search in the sorted
+    vocabulary. The doc ids and scores of a PostingList are memoryviews on
+    the file, so the postings are only read when they are accessed. With
+    another codec than "raw", the lists are CompressedPostingList, which
+    decode their blocks when they are accessed. With fields, the posting
+    blocks contain the tf scores in the titles as well (only for the codec
+    "raw").
+    """
+
+    def __init__(self, mm, word_offsets, posting_offsets, dfs, codec="raw",
+                 fields=False):
+        self.mm = mm
+        self.view = memoryview(mm)
+        self.word_offsets = word_offsets
+        self.posting_offsets = posting_offsets
+        self.dfs = dfs
+        self.codec = codec
+        self.fields = fields
+
+    def word(self, i):
+        """
+        Return the i-th word of the vocabulary, as bytes.
+        """
+        return self.mm[self.word_offsets[i]:self.word_offsets[i + 1]]
+
+    def find(self, word):
+        """
+        Return the position of the given word in the vocabulary, or -1 if the
+        word is not in the vocabulary.
+        """
+        if not isinstance(word, str):
+            return -1
+        key = word.encode("utf-8")
+        lo, hi = 0, len(self.dfs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.dfs) and self.word(lo) == key:
+            return lo
+        return -1
+
+    def block(self, i):
+        """
+        Return the posting block of the i-th word, as a tuple (doc ids, tf
+        scores, BM25 scores, block max scores, tf scores in the titles) of
+        memoryviews (the last is None without fields). Only for the codec
+        "raw".
+        """
+        df = self.dfs[i]
+        num_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+        start = self.posting_offsets[i]
+        doc_ids = self.view[start:start + 4 * df].cast("I")
+        start += 4 * df
+        tfs = self.view[start:start + 4 * df].cast("I")
+        start += 4 * df
+        title_tfs = None
+        if self.fields:
+            title_tfs = self.view[start:start + 4 * df].cast("I")
+            start += 4 * df
+        scores = self.view[start:start + 4 * df].cast("f")
+        start += 4 * df
+        block_max_scores = self.view[start:start + 4 * num_blocks].cast("f")
+        return doc_ids, tfs, scores, block_max_scores, title_tfs
+
+    def __getitem__(self, word):
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        if self.codec != "raw":
+            return CompressedPostingList(self.view, self.posting_offsets[i],
+                                         self.dfs[i], self.codec)
+        inverted_list = PostingList()
+        (inverted_list.doc_ids, inverted_list.tfs, inverted_list.scores,
+         _, title_tfs) = self.block(i)
+        if title_tfs is not None:
+            inverted_list.title_tfs = title_tfs
+        return inverted_list
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __iter__(self):
+        for i in range(len(self.dfs)):
+            yield self.word(i).decode("utf-8")
+
+    def __len__(self):
+        return len(self.dfs)
+
+
+class MappedWords(Sequence):
+    """
+    The words of the vocabulary of MappedInvertedLists, as strings, in
+    sorted order (see VocabularyIndex).
+    """
+
+    def __init__(self, inverted_lists):
+        self.word = inverted_lists.word
+        self.positions = range(len(inverted_lists.dfs))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in self.positions[i]]
+        # The range checks i and makes it non-negative.
+        return self.word(self.positions[i]).decode("utf-8")
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class MappedInvertedIndex(InvertedIndex):
+    """
+    An inverted index read from a file in the binary index format, using
+    mmap. Opening the index only reads the header. The posting lists and docs
+    are paged in by the operating system when a query accesses them, and the
+    pages are shared by all processes that open the same file. The docs are
+    a DocStore (see doc_store.py), which reads a doc when it is accessed.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", b=0.75, k=1.75, verbose=False)
+    >>> import tempfile, os
+    >>> file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+    >>> write_index(ii, file_name)
+    >>> mapped = MappedInvertedIndex(file_name)
+    >>> sorted(mapped.inverted_lists) == sorted(ii.inverted_lists)
+    True
+    >>> mapped.inverted_lists["film"] == ii.inverted_lists["film"]
+    True
+    >>> "foo" in mapped.inverted_lists, len(mapped.docs)
+    (False, 4)
+    >>> mapped.docs[1] == ii.docs[1], list(mapped.doc_lengths)
+    (True, [3, 4, 3, 5])
+    >>> result = mapped.process_query(["short", "film"], k=2)
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '2.176'), (3, '1.106')]
+    >>> mapped.get_score_bounds("short")[0] == ii.get_score_bounds("short")[0]
+    True
+    >>> mapped.qgram_index is not None, len(mapped.get_vocabulary())
+    (True, 6)
+    >>> mapped.analyze_query("anim* flim~ shrot")
+    [('animated', 'animation'), 'film', 'shrot']
+
+    The index cannot be changed. To re-compute the BM25 scores with other
+    values of b and k, or to add or delete docs, copy it into memory first.
+
+    >>> ii2 = mapped.copy()
+    >>> ii2.rescore(b=0, k=float("inf"))
+    >>> [(i, '%.3f' % tf) for i, tf in ii2.inverted_lists["short"]]
+    [(3, '1.000'), (4, '2.000')]
+    >>> list(ii2.docs) == ii.docs, (mapped.b, mapped.k)
+    (True, (0.75, 1.75))
+    """
+
+    def __init__(self, file_name):
+        """
+        Opens the inverted index in the given file.
+        """
+        super().__init__()
+        if sys.byteorder != "little":
+            raise ValueError("The binary index format can only be read on "
+                             "little-endian machines.")
+        with open(file_name, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("<4sI", self.mm)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a binary index file." % file_name)
+        if version != VERSION:
+            raise ValueError("'%s' has version %d of the binary index format, "
+                             "expected version %d."
+                             % (file_name, version, VERSION))
+        (_, _, num_docs, num_words, self.b, self.k, doc_lengths_offset,
+         doc_offsets_offset, word_offsets_offset, posting_offsets_offset,
+         dfs_offset, flags, codec, self.doc_block_size, self.impact_size,
+         impact_offsets_offset, title_lengths_offset, title_weight,
+         description_weight, qgram_offset, num_keys) = \
+            HEADER.unpack_from(self.mm)
+        self.analyzer = Analyzer.from_flags(flags)
+        self.codec = CODECS[codec]
+
+        def section(offset, typecode, length):
+            size = array(typecode).itemsize * length
+            return memoryview(self.mm)[offset:offset + size].cast(typecode)
+
+        self.doc_lengths = section(doc_lengths_offset, "I", num_docs)
+        if title_lengths_offset:
+            self.title_lengths = section(title_lengths_offset, "I", num_docs)
+            self.field_weights = (title_weight, description_weight)
+        num_blocks = num_docs
+        if self.doc_block_size:
+            num_blocks = -(-num_docs // self.doc_block_size)
+        self.docs = DocStore(self.mm, section(doc_offsets_offset, "Q",
+                                              num_blocks + 1),
+                             num_docs, self.doc_block_size)
+        self.inverted_lists = MappedInvertedLists(
+            self.mm,
+            section(word_offsets_offset, "Q", num_words + 1),
+            section(posting_offsets_offset, "Q", num_words),
+            section(dfs_offset, "I", num_words),
+            self.codec, self.title_lengths is not None)
+        if self.impact_size:
+            self.impact_offsets = section(impact_offsets_offset, "Q",
+                                          num_words + 1)
+            self.impact_positions = section(
+                impact_offsets_offset + 8 * (num_words + 1), "I",
+                self.impact_offsets[-1])
+        self.qgram_index = None
+        if qgram_offset:
+            offsets = section(qgram_offset, "Q", num_keys + 1)
+            keys_offset = qgram_offset + 8 * (num_keys + 1)
+            self.qgram_index = (
+                section(keys_offset, "I", num_keys), offsets,
+                section(keys_offset + 4 * num_keys, "I", offsets[-1]))
+
+    def get_vocabulary(self):
+        """
+        Return the index of the vocabulary (see
+        InvertedIndex.get_vocabulary), with the words, the numbers of
+        postings and the q-gram index as stored in the file (the q-gram index
+        is built on the first fuzzy search if the file has none).
+        """
+        if self.vocabulary is None:
+            self.vocabulary = VocabularyIndex(
+                MappedWords(self.inverted_lists), self.inverted_lists.dfs,
+                self.qgram_index)
+        return self.vocabulary
+
+    def get_impact_order(self, word):
+        """
+        Return the impact order of the inverted list of the given word (see
+        InvertedIndex.get_impact_order), as stored in the file.
+        """
+        if not self.impact_size:
+            return None
+        i = self.inverted_lists.find(word)
+        if i < 0 or self.inverted_lists.dfs[i] <= self.impact_size:
+            return None
+        return self.impact_positions[self.impact_offsets[i]:
+                                     self.impact_offsets[i + 1]]
+
+    def get_score_bounds(self, word):
+        """
+        Return the score bounds of the inverted list of the given word (see
+        InvertedIndex.get_score_bounds), as stored in the file.
+        """
+        if word not in self.score_bounds:
+            i = self.inverted_lists.find(word)
+            if i < 0:
+                raise KeyError(word)
+            if self.codec != "raw":
+                block_max_scores = \
+                    self.inverted_lists[word].block_max_scores()
+            else:
+                block_max_scores = self.inverted_lists.block(i)[3]
+            self.score_bounds[word] = (max(block_max_scores, default=0),
+                                       block_max_scores)
+        return self.score_bounds[word]
+
+    def rescore(self, b=None, k=None, field_weights=None):
+        """
+        Not supported, see copy (but see set_query_field_weights).
+        """
+        raise TypeError("A memory-mapped index cannot be changed, use copy() "
+                        "to copy it into memory first.")
+
+    # Adding or deleting docs is not supported either.
+    add_documents = delete_documents = rescore
+
+    def copy(self):
+        """
+        Return a copy of the index as an InvertedIndex in memory. The docs
+        are not copied, but still read from the file when they are accessed
+        (they are copied when docs are added, or when the index is pickled).
+        """
+        ii = InvertedIndex()
+        for word, inverted_list in self.inverted_lists.items():
+            copied_list = PostingList()
+            copied_list.doc_ids = array("I", inverted_list.doc_ids)
+            copied_list.tfs = array("I", inverted_list.tfs)
+            copied_list.scores = array("f", inverted_list.scores)
+            if inverted_list.title_tfs is not None:
+                copied_list.title_tfs = array("I", inverted_list.title_tfs)
+            ii.inverted_lists[word] = copied_list
+        ii.docs = self.docs
+        ii.doc_lengths = array("I", self.doc_lengths)
+        ii.b = self.b
+        ii.k = self.k
+        if self.title_lengths is not None:
+            ii.title_lengths = array("I", self.title_lengths)
+            ii.field_weights = self.field_weights
+        ii.analyzer = Analyzer.from_flags(self.analyzer.flags)
+        ii.impact_size = self.impact_size
+        for word in ii.inverted_lists:
+            order = self.get_impact_order(word)
+            if order is not None:
+                ii.impact_orders[word] = array("I", order)
+        return ii
+
+
+def write_index(ii, file_name, codec="raw", doc_block_size=0):
+    """
+    Write the given inverted index to the given file, in the binary index
+    format (see the comment at the beginning of this file and the example in
+    MappedInvertedIndex), with the posting blocks encoded by the given codec
+    (see compression.CODECS) and the docs compressed in blocks of the given
+    size (0 for no compression). An index with added or deleted docs has to
+    be compacted first (see InvertedIndex.compact).
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> import tempfile, os
+    >>> file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+    >>> write_index(ii, file_name, "bitpack")
+    >>> mapped = MappedInvertedIndex(file_name)
+    >>> mapped.codec, type(mapped.inverted_lists["film"]).__name__
+    ('bitpack', 'CompressedPostingList')
+    >>> result = mapped.process_query(["short", "film"], k=2)
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '2.176'), (3, '1.107')]
+    >>> mapped.copy().inverted_lists["short"].tfs
+    array('I', [1, 2])
+    >>> write_index(ii, file_name, doc_block_size=3)
+    >>> mapped = MappedInvertedIndex(file_name)
+    >>> mapped.doc_block_size, list(mapped.docs) == ii.docs
+    (3, True)
+
+    With an impact size, the impact orders are stored as well.
+
+    >>> ii.impact_size = 1
+    >>> ii.rescore()
+    >>> write_index(ii, file_name)
+    >>> mapped = MappedInvertedIndex(file_name)
+    >>> mapped.impact_size, list(mapped.get_impact_order("short"))
+    (1, [1])
+    >>> list(mapped.get_impact_order("movie")), mapped.get_impact_order("non")
+    ([], None)
+    >>> mapped.process_query(["short"], k=1)
+    [(4, 1.3134328126907349)]
+    >>> mapped.copy().impact_orders == ii.impact_orders
+    True
+
+    With fields, the tf scores in the titles, the lengths of the titles and
+    the field weights are stored as well, so the field weights can be
+    changed at query time (only with the codec "raw").
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example-fields.tsv", verbose=False, fields=True)
+    >>> write_index(ii, file_name)
+    >>> mapped = MappedInvertedIndex(file_name)
+    >>> mapped.field_weights, list(mapped.title_lengths)
+    ((2.0, 1.0), [2, 2, 2, 1])
+    >>> mapped.process_query(["short"]) == ii.process_query(["short"])
+    True
+    >>> mapped.set_query_field_weights((0, 1))
+    >>> [id for id, _ in mapped.process_query(["short"])]
+    [3, 2]
+    >>> copied = mapped.copy()
+    >>> copied.inverted_lists["short"].title_tfs
+    array('I', [1, 0, 0])
+    >>> write_index(ii, file_name, "bitpack")
+    Traceback (most recent call last):
+        ...
+    ValueError: An index with fields can only be written with the codec 'raw'.
+    """
+    check_byteorder()
+    if ii.has_updates() or ii.deleted_docs:
+        raise ValueError("The index has added or deleted docs, use compact() "
+                         "before writing it.")
+    if ii.title_lengths is not None and codec != "raw":
+        raise ValueError("An index with fields can only be written with the "
+                         "codec 'raw'.")
+
+    with open(file_name, "wb") as f:
+        # The header is written at the end, when the offsets are known.
+        f.write(bytes(HEADER.size))
+
+        # (1) The doc store.
+        doc_store = DocStoreWriter(f, doc_block_size)
+        for doc in ii.docs:
+            doc_store.add("\t".join(doc))
+        doc_offsets = doc_store.finish()
+
+        # (2) The posting blocks.
+        words = sorted(ii.inverted_lists)
+        posting_offsets = array("Q")
+        dfs = array("I")
+        for word in words:
+            inverted_list = ii.inverted_lists[word]
+            posting_offsets.append(write_postings(
+                f, inverted_list, ii.get_score_bounds(word)[1], codec))
+            dfs.append(len(inverted_list))
+
+        # (3) to (8) and the header.
+        impact_orders = None
+        if ii.impact_size:
+            impact_orders = [ii.get_impact_order(word) for word in words]
+            if codec != "raw":
+                # The compressed lists have quantized scores, with more ties,
+                # so their impact orders are computed from these.
+                impact_orders = [
+                    impact_order(array("B", quantize(
+                        ii.inverted_lists[word].scores)[1]), ii.impact_size)
+                    if order is not None else None
+                    for word, order in zip(words, impact_orders)]
+        write_tables(f, ii.doc_lengths, doc_offsets, words, posting_offsets,
+                     dfs, ii.b, ii.k, ii.analyzer, codec, doc_block_size,
+                     ii.impact_size, impact_orders, ii.title_lengths,
+                     ii.field_weights, build_qgram_index(words))
+
+
+def check_byteorder():
+    """
+    Raise a ValueError if the binary index format cannot be written on this
+    machine.
+    """
+    if sys.byteorder != "little":
+        raise ValueError("The binary index format can only be written on "
+                         "little-endian machines.")
+
+
+def write_postings(f, inverted_list, block_max_scores, codec="raw"):
+    """
+    Write the posting block of the given inverted list (with the given
+    maximal score of each block) to the given file, encoded by the given
+    codec, see section (2). Return the position of the posting block in the
+    file.
+    """
+    if codec != "raw":
+        align(f, 8)
+        offset = f.tell()
+        f.write(encode_postings(inverted_list, codec))
+        return offset
+
+    align(f, 4)
+    offset = f.tell()
+    f.write(array("I", inverted_list.doc_ids).tobytes())
+    f.write(array("I", inverted_list.tfs).tobytes())
+    if inverted_list.title_tfs is not None:
+        f.write(array("I", inverted_list.title_tfs).tobytes())
+    f.write(array("f", inverted_list.scores).tobytes())
+    f.write(array("f", block_max_scores).tobytes())
+    return offset
+
+
+def write_tables(f, doc_lengths, doc_offsets, words, posting_offsets, dfs,
+                 b, k, analyzer, codec="raw", doc_block_size=0,
+                 impact_size=0, impact_orders=None, title_lengths=None,
+                 field_weights=None, qgram_index=None):
+    """
+    Write the sections (3) to (8) to the given file, after the doc store and
+    the posting blocks, and then the header. The words can be any iterable of
+    the words in sorted order. With an impact size > 0, the impact orders are
+    the impact order of each word (None for the words with at most
+    impact_size postings). For an index with fields, the title lengths and
+    the field weights are given as well. The q-gram index of the words (see
+    vocabulary.build_qgram_index) is optional, without it, the q-gram index is
+    built when it is needed (see VocabularyIndex).
+    """
+    # (3) The document lengths.
+    align(f, 8)
+    doc_lengths_offset = f.tell()
+    f.write(array("I", doc_lengths).tobytes())
+    title_lengths_offset = 0
+    if title_lengths is not None:
+        title_lengths_offset = f.tell()
+        f.write(array("I", title_lengths).tobytes())
+
+    # (4) The doc offsets.
+    align(f, 8)
+    doc_offsets_offset = f.tell()
+    f.write(doc_offsets.tobytes())
+
+    # (5) The vocabulary.
+    word_offsets = array("Q")
+    for word in words:
+        word_offsets.append(f.tell())
+        f.write(word.encode("utf-8"))
+    word_offsets.append(f.tell())
+    align(f, 8)
+    word_offsets_offset = f.tell()
+    f.write(word_offsets.tobytes())
+
+    # (6) The offset table.
+    posting_offsets_offset = f.tell()
+    f.write(posting_offsets.tobytes())
+    dfs_offset = f.tell()
+    f.write(dfs.tobytes())
+
+    # (7) The impact orders.
+    impact_offsets_offset = 0
+    if impact_size:
+        impact_offsets = array("Q", [0])
+        for order in impact_orders:
+            impact_offsets.append(impact_offsets[-1]
+                                  + (len(order) if order is not None else 0))
+        align(f, 8)
+        impact_offsets_offset = f.tell()
+        f.write(impact_offsets.tobytes())
+        for order in impact_orders:
+            if order is not None:
+                f.write(array("I", order).tobytes())
+
+    # (8) The q-gram index.
+    qgram_offset = num_keys = 0
+    if qgram_index is not None:
+        keys, offsets, positions = qgram_index
+        align(f, 8)
+        qgram_offset = f.tell()
+        num_keys = len(keys)
+        f.write(array("Q", offsets).tobytes())
+        f.write(array("I", keys).tobytes())
+        f.write(array("I", positions).tobytes())
+
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, len(doc_lengths),
+                        len(word_offsets) - 1, b, k, doc_lengths_offset,
+                        doc_offsets_offset, word_offsets_offset,
+                        posting_offsets_offset, dfs_offset, analyzer.flags,
+                        CODECS.index(codec), doc_block_size, impact_size,
+                        impact_offsets_offset, title_lengths_offset,
+                        *(field_weights or (0.0, 0.0)), qgram_offset,
+                        num_keys))
+
+
+def align(f, n):
+    """
+    Pad the given file with zero bytes, so that its size is a multiple of n.
+    """
+    f.write(bytes(-f.tell() % n))
+
+
+class IndexUnpickler(pickle.Unpickler):
+    """
+    An unpickler for inverted indexes saved by 'inverted_index.py'. Since the
+    index is pickled when 'inverted_index.py' is run as the main module, its
+    classes are looked up in the module inverted_index instead of __main__.
+    """
+
+    def find_class(self, module, name):
+        if module == "__main__":
+            module = "inverted_index"
+        return super().find_class(module, name)
+
+
+def load_index(file_name, in_memory=False):
+    """
+    Load the inverted index from the given file, which is either in the
+    binary index format or a pickle file. An index in the binary format is
+    memory-mapped, unless in_memory is True.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> import tempfile, os
+    >>> file_name = os.path.join(tempfile.mkdtemp(), "example.pkl")
+    >>> pickle.dump(ii, open(file_name, "wb"))
+    >>> type(load_index(file_name)).__name__
+    'InvertedIndex'
+    >>> write_index(ii, file_name)
+    >>> type(load_index(file_name)).__name__
+    'MappedInvertedIndex'
+    >>> type(load_index(file_name, in_memory=True)).__name__
+    'InvertedIndex'
+    """
+    with open(file_name, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            if in_memory:
+                return MappedInvertedIndex(file_name).copy()
+            return MappedInvertedIndex(file_name)
+        f.seek(0)
+        return IndexUnpickler(f).load()
@@ -7,13 +7,182 @@ Theresa Klumpp <klumppt@cs.uni-freiburg.de>
 """
 
 import math
-import re
+import os
 import argparse
 import pickle
+import heapq
+import resource
+import threading
+import multiprocessing
+from copy import copy
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from functools import partial
+from itertools import accumulate
+
+from analyzer import Analyzer, stem, tokenize
+from profiling import NullProfiler, Profiler
+from snippets import make_snippet, to_ansi
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Without NumPy, BM25 scores are computed in pure Python.
 
 
 DEFAULT_B = 0.75
 DEFAULT_K = 1.75
+BLOCK_SIZE = 64  # The number of postings per block for block-max scores.
+# Top-k queries on fewer postings are processed exhaustively (see union and
+# top_k). With NumPy, the union is faster than the pruning in top_k for all
+# but very long lists.
+MIN_TOP_K_POSTINGS = 20000 if np is None else 1000000
+# Top-k queries with at most this many keywords use the impact orders first
+# (see impact_top_k). With more keywords, the top-k are rarely among the docs
+# in the impact orders.
+MAX_IMPACT_KEYWORDS = 2
+# The query modes (see InvertedIndex.process_query).
+MODES = ["or", "and", "phrase"]
+# The fields of a doc, and the default weights of the fields in the BM25F
+# scores (see InvertedIndex.read_from_file).
+FIELDS = ["title", "description"]
+DEFAULT_FIELD_WEIGHTS = (2.0, 1.0)
+
+
+class PostingList:
+    """
+    An inverted list, stored as parallel arrays: the doc ids (sorted in
+    ascending order), the BM25 scores and the tf scores (only for the lists in
+    the index, needed to re-compute the BM25 scores). Accessing or iterating
+    the entries gives postings of form (doc_id, bm25_score), like a list of
+    tuples.
+
+    Lists of an index with positions (see InvertedIndex.read_from_file) also
+    have the positional postings: the positions of the word in each doc (in
+    the terms of the doc, starting at 0), concatenated in one array. A
+    posting has tf positions, so they start at the sum of the tf scores of
+    the postings before (see position_starts).
+
+    Lists of an index with fields (see InvertedIndex.read_from_file) also
+    have the tf scores of the word in the title of each doc (title_tfs). The
+    tf scores in the description are the differences to the tf scores.
+
+    The scores of the lists in the index are stored as 32-bit floats. Lists
+    computed at query time use 64-bit floats, so that adding up scores does
+    not lose precision.
+
+    >>> pl = PostingList([(1, 0.5), (3, 2.0)])
+    >>> pl.append(4, 1.5)
+    >>> len(pl), pl[1], pl[-1]
+    (3, (3, 2.0), (4, 1.5))
+    >>> list(pl)
+    [(1, 0.5), (3, 2.0), (4, 1.5)]
+    >>> pl[1:]
+    PostingList([(3, 2.0), (4, 1.5)])
+    >>> pl.last_doc_id()
+    4
+    """
+
+    # The positional postings, as array, or None.
+    positions = None
+    # The tf scores in the title, as array, or None.
+    title_tfs = None
+
+    def __init__(self, postings=(), typecode="f"):
+        """
+        Creates a posting list with the given postings.
+        """
+        self.doc_ids = array("I")
+        self.scores = array(typecode)
+        self.tfs = array("I")
+        for doc_id, score in postings:
+            self.append(doc_id, score)
+
+    def append(self, doc_id, score):
+        """
+        Append a posting to the list.
+        """
+        self.doc_ids.append(doc_id)
+        self.scores.append(score)
+
+    def views(self):
+        """
+        Return the doc ids and the scores as sequences, together with a
+        function bisect(doc_id, lo) that returns the position of the first
+        posting at or after position lo with a doc id >= the given doc id.
+        Used by top_k, compressed lists (see compression.py) only decode the
+        parts that are accessed.
+        """
+        return self.doc_ids, self.scores, partial(bisect_left, self.doc_ids)
+
+    def last_doc_id(self):
+        """
+        Return the doc id of the last posting (the list must not be empty).
+        Compressed lists read it without decoding the list.
+        """
+        return self.doc_ids[-1]
+
+    def extend(self, other):
+        """
+        Append the postings of the given list (with a larger first doc id),
+        with their scores, tf scores, positions and tf scores in the title.
+        """
+        self.doc_ids.extend(other.doc_ids)
+        self.scores.extend(other.scores)
+        self.tfs.extend(other.tfs)
+        if self.positions is not None:
+            self.positions.extend(other.positions)
+        if self.title_tfs is not None:
+            self.title_tfs.extend(other.title_tfs)
+
+    def position_starts(self):
+        """
+        Return the start of the positions of each posting in positions, and
+        the end of the positions of the last posting (the prefix sums of the
+        tf scores).
+
+        >>> inverted_lists = {}
+        >>> add_doc(inverted_lists, 1, ["a", "b", "a"], positions=True)
+        >>> add_doc(inverted_lists, 2, ["b", "a"], positions=True)
+        >>> pl = inverted_lists["a"]
+        >>> list(pl.positions), list(map(int, pl.position_starts()))
+        ([0, 2, 1], [0, 2, 3])
+        """
+        if np is not None:
+            starts = np.zeros(len(self.tfs) + 1, dtype=np.int64)
+            np.cumsum(np.asarray(self.tfs), out=starts[1:])
+            return starts
+        return list(accumulate(self.tfs, initial=0))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            result = PostingList(typecode=self.scores.typecode)
+            result.doc_ids = self.doc_ids[i]
+            result.scores = self.scores[i]
+            result.tfs = self.tfs[i]
+            if self.title_tfs is not None:
+                result.title_tfs = self.title_tfs[i]
+            if self.positions is not None:
+                # The positions of the postings in the slice (with step 1).
+                start, stop, _ = i.indices(len(self.tfs))
+                first = sum(self.tfs[:start])
+                result.positions = self.positions[
+                    first:first + sum(self.tfs[start:stop])]
+            return result
+        return (self.doc_ids[i], self.scores[i])
+
+    def __iter__(self):
+        return zip(self.doc_ids, self.scores)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "PostingList(%s)" % list(self)
 
 
 class InvertedIndex:
@@ -25,11 +194,89 @@ class InvertedIndex:
         """
         Creates an empty inverted index.
         """
-        self.inverted_lists = {}  # The inverted lists.
+        self.inverted_lists = {}  # The inverted lists, as PostingList.
+        # The analyzer that splits the docs and the queries into terms.
+        self.analyzer = Analyzer()
         self.docs = []  # The docs, each in form (title, description).
-        self.doc_lengths = []  # The document lengths (= number of words).
+        # The document lengths (= number of words).
+        self.doc_lengths = array("I")
+        # The parameters of the BM25 scores.
+        self.b = DEFAULT_B
+        self.k = DEFAULT_K
+        # The maximal BM25 score of each inverted list and of each block of
+        # BLOCK_SIZE postings in it, used to prune in top-k queries.
+        self.score_bounds = {}
+        # Incremented whenever the inverted lists change, so that cached
+        # query results can be invalidated (see query_cache.py).
+        self.version = 0
+        # The delta segment: the inverted lists (with tf scores only) of the
+        # docs added since the last merge, and the number of these docs (see
+        # add_documents).
+        self.delta_lists = {}
+        self.num_delta_docs = 0
+        # The tombstones: the ids of all deleted docs, and of the deleted docs
+        # that are still in the inverted lists (see delete_documents).
+        self.deleted_docs = set()
+        self.pending_deletes = set()
+        # The number, the total length and the total title length of the docs
+        # that are not deleted, which the updates keep up to date (see
+        # get_doc_totals), or None if they are not computed yet.
+        self.doc_totals = None
+        # The lock for changing the index and for taking the snapshots that
+        # queries read (see snapshot), and the lock that allows only one
+        # merge at a time (see merge_delta).
+        self.lock = threading.RLock()
+        self.merge_lock = threading.RLock()
+        self.merge_thread = None
+        # True if the inverted lists have positional postings (see
+        # read_from_file), used by phrase queries.
+        self.positional = False
+        # The profiler that records the phases of building the index and of
+        # the queries (see profiling.py). By default, nothing is recorded.
+        self.profiler = NullProfiler()
+        # The impact orders: for each inverted list with more than
+        # impact_size postings, the positions of its (at most) impact_size
+        # postings with the highest non-zero scores, sorted by score (see
+        # impact_top_k). The orders take 4 bytes per posting, so impact_size
+        # bounds the extra space. With 0, no orders are kept.
+        self.impact_size = 0
+        self.impact_orders = {}
+        # The weights of the fields (see FIELDS) in the BM25F scores, and the
+        # number of words in the title of each doc, for an index with fields
+        # (see read_from_file). None for an index with BM25 scores.
+        self.field_weights = None
+        self.title_lengths = None
+        # Other field weights for the queries, which then compute the scores
+        # of their keywords with these weights (see set_query_field_weights).
+        self.query_field_weights = None
+        # The index of the words of the inverted lists, for prefix and fuzzy
+        # keywords (see get_vocabulary). Built when it is needed.
+        self.vocabulary = None
 
-    def read_from_file(self, file_name, b=None, k=None, verbose=True):
+    def __getstate__(self):
+        # Do not pickle the locks, the merge thread, the profiler and the
+        # vocabulary index.
+        state = self.__dict__.copy()
+        for name in ["lock", "merge_lock", "merge_thread", "profiler",
+                     "vocabulary"]:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled inverted index. Attributes missing in indexes
+        pickled by older versions are set to their defaults, and inverted
+        lists stored as lists of tuples are converted to PostingList.
+        """
+        self.__init__()
+        self.__dict__.update(state)
+        for word, inverted_list in self.inverted_lists.items():
+            if not isinstance(inverted_list, PostingList):
+                self.inverted_lists[word] = PostingList(inverted_list)
+
+    def read_from_file(self, file_name, b=None, k=None, verbose=True,
+                       workers=1, analyzer=None, positions=False,
+                       fields=False):
         """
         Construct the inverted index from the given file. The expected format
         of the file is one document per line, in the format
@@ -50,8 +297,35 @@ class InvertedIndex:
             documents that contains the word.
 
         On reading the file, use UTF-8 as the standard encoding. To split the
-        texts into words, use the method introduced in the lecture. Make sure
-        that you ignore empty words.
+        texts into words, use the given analyzer (by default, Analyzer(), see
+        analyzer.py). The analyzer is stored in the index, so that queries
+        can be split into words the same way.
+
+        If workers > 1, the first pass is done in parallel by the given
+        number of processes, each reading a part of the file (see
+        read_shard). The resulting index is the same.
+
+        The time of the phases is recorded by the profiler of the index (see
+        profiling.py): the first pass ("build/read"), and within it splitting
+        the docs into words ("build/tokenize", in all workers) and adding the
+        words to the inverted lists ("build/postings"), and the second pass
+        ("build/bm25" and "build/score bounds"), together with the number of
+        docs, terms and postings.
+
+        If positions is True, the positions of the words in each doc are
+        stored in the inverted lists as well (see PostingList), so that phrase
+        queries do not need to read the docs (see process_query). The
+        positions are only kept in memory and in pickled indexes, not in the
+        binary index format.
+
+        If fields is True, the index is built with fields (see FIELDS): the
+        inverted lists also have the tf scores in the title (see PostingList)
+        and the index has the number of words in the title of each doc. The
+        scores are then BM25F scores, which weight the tf scores in the title
+        and in the description by the field weights of the index (by default,
+        DEFAULT_FIELD_WEIGHTS, see bm25f_scores). The weights can be changed
+        without reading the file again, by rescore or, for the queries only,
+        by set_query_field_weights.
 
         >>> ii = InvertedIndex()
         >>> ii.read_from_file("example.tsv",
@@ -79,218 +353,2301 @@ class InvertedIndex:
          ('movie', [(1, '0.000'), (2, '0.000'), (3, '0.000'), (4, '0.000')]),
          ('non', [(2, '1.938')]),
          ('short', [(3, '1.106'), (4, '1.313')])]
+
+        >>> ii2 = InvertedIndex()
+        >>> ii2.read_from_file("example.tsv", b=0.75, k=1.75, verbose=False,
+        ...                    workers=3)
+        >>> ii2.inverted_lists == ii.inverted_lists, ii2.docs == ii.docs
+        (True, True)
+
+        >>> ii3 = InvertedIndex()
+        >>> ii3.read_from_file("example.tsv", verbose=False, workers=2,
+        ...                    positions=True)
+        >>> list(ii3.inverted_lists["short"].positions)
+        [1, 1, 3]
+
+        >>> ii4 = InvertedIndex()
+        >>> ii4.read_from_file("example-fields.tsv", verbose=False, workers=2,
+        ...                    fields=True)
+        >>> short = ii4.inverted_lists["short"]
+        >>> list(short.tfs), list(short.title_tfs), ii4.field_weights
+        ([1, 1, 1], [1, 0, 0], (2.0, 1.0))
+        >>> [(id, "%.3f" % tf) for id, tf in ii4.process_query(["short"])]
+        [(1, '0.580'), (3, '0.427'), (2, '0.347')]
         """
 
-        b = DEFAULT_B if b is None else b
-        k = DEFAULT_K if k is None else k
+        if analyzer is not None:
+            self.analyzer = analyzer
+        self.positional = positions
+        if fields:
+            self.field_weights = self.field_weights or DEFAULT_FIELD_WEIGHTS
+            self.title_lengths = array("I")
+        profiler = self.profiler
 
         # First pass: Compute (1) the inverted lists with tf scores and (2) the
-        # document lengths.
-        with open(file_name, "r", encoding="utf-8") as f:
-            doc_id = 0
-            for line in f:
+        # document lengths. With several workers, each worker reads one shard
+        # of the file, and the inverted lists of the shards are concatenated.
+        with profiler.phase("build/read"):
+            if workers > 1:
+                with multiprocessing.Pool(workers) as pool:
+                    shards = pool.starmap(read_packed_shard, [
+                        (file_name, start, end, self.analyzer, positions,
+                         profiler.enabled, fields)
+                        for start, end in split_file(file_name, workers)])
+                for _, _, _, report in shards:
+                    if report is not None:
+                        profiler.merge(report)
+                shards = [(unpack_lists(*packed_lists), docs, doc_lengths)
+                          for packed_lists, docs, doc_lengths, _ in shards]
+            else:
+                shards = [read_shard(file_name, verbose=verbose,
+                                     analyzer=self.analyzer,
+                                     positions=positions, profiler=profiler,
+                                     fields=fields)]
+
+            for inverted_lists, docs, doc_lengths in shards:
+                self.add_shard(inverted_lists, docs, doc_lengths)
+
+        if profiler.enabled:
+            profiler.count("build/docs", len(self.docs))
+            profiler.count("build/terms", sum(self.doc_lengths))
+            profiler.count("build/postings",
+                           sum(map(len, self.inverted_lists.values())))
+
+        if verbose:
+            print(f"Progress: Read {len(self.docs):6} documents.")
+
+        # Second pass: Compute the BM25 scores.
+        self.rescore(b, k)
+
+    def rescore(self, b=None, k=None, field_weights=None):
+        """
+        Compute the BM25 scores of all inverted lists from the tf scores and
+        the document lengths, with the given b and k (see the second pass in
+        read_from_file). This replaces the current BM25 scores, so that other
+        values of b and k can be tried without reading the file again. Docs
+        added or deleted since the last merge are merged (see merge_delta),
+        the scores are computed by bm25_scores (or bm25f_scores, for an index
+        with fields, with the given field weights or the current ones).
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", b=0.75, k=1.75, verbose=False)
+        >>> ii.rescore(b=0, k=float("inf"))
+        >>> [(i, '%.3f' % tf) for i, tf in ii.inverted_lists["short"]]
+        [(3, '1.000'), (4, '2.000')]
+        >>> ii.b, ii.k, ii.get_score_bounds("short")[0]
+        (0, inf, 2.0)
+        """
+        if field_weights is not None:
+            if self.field_weights is None:
+                raise ValueError("The index has no fields, it has to be "
+                                 "built again with fields.")
+            self.field_weights = tuple(map(float, field_weights))
+        self.b = DEFAULT_B if b is None else b
+        self.k = DEFAULT_K if k is None else k
+        self.merge_delta()
+
+    def add_documents(self, lines):
+        """
+        Add the given docs (each as a line <title>TAB<description>) to the
+        index, without computing the scores of the whole index again: the
+        inverted lists of the new docs (with tf scores) are kept in a small
+        delta segment, and queries compute the scores of the keywords from
+        the tf scores and the current statistics (see process_query), until
+        the delta segment is merged (see merge_delta and start_merge). Return
+        the ids of the new docs.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", b=0, k=float("inf"),
+        ...                   verbose=False)
+        >>> ii.add_documents(["Animated short\\tA short film."])
+        [5]
+        >>> result = ii.process_query(["short"])
+        >>> [(id, "%.3f" % tf) for id, tf in result]
+        [(4, '1.474'), (5, '1.474'), (3, '0.737')]
+        >>> "short" in ii.delta_lists, ii.docs[4], ii.has_updates()
+        (True, ('Animated short', 'A short film.'), True)
+        """
+        with self.lock:
+            if not isinstance(self.docs, list):
+                # The docs are read from a file (see doc_store.DocStore).
+                self.docs = list(self.docs)
+            n, total, title_total = self.get_doc_totals()
+            # The lists of the new docs are appended to copies of the lists
+            # of the delta segment, and the document lengths and the title
+            # lengths are replaced as well, since snapshots may share them
+            # (see snapshot).
+            new_lists = {}
+            doc_ids = []
+            doc_lengths = array("I")
+            title_lengths = array("I")
+            for line in lines:
                 line = line.strip()
+                doc_id = len(self.docs) + 1
+                if self.title_lengths is not None:
+                    title, _, description = line.partition("\t")
+                    words = self.analyzer.analyze(title)
+                    title_lengths.append(len(words))
+                    title_total += len(words)
+                    words += self.analyzer.analyze(description)
+                    add_doc(new_lists, doc_id, words, self.positional,
+                            title_lengths[-1])
+                else:
+                    words = self.analyzer.analyze(line)
+                    add_doc(new_lists, doc_id, words, self.positional)
+                self.docs.append(tuple(line.split("\t")))
+                doc_lengths.append(len(words))
+                n += 1
+                total += len(words)
+                doc_ids.append(doc_id)
+            delta_lists = dict(self.delta_lists)
+            for word, new_list in new_lists.items():
+                delta_list = delta_lists.get(word)
+                if delta_list is not None:
+                    delta_list = delta_list[:]
+                    delta_list.extend(new_list)
+                    new_list = delta_list
+                delta_lists[word] = new_list
+            self.delta_lists = delta_lists
+            self.doc_lengths = self.doc_lengths + doc_lengths
+            if self.title_lengths is not None:
+                self.title_lengths = self.title_lengths + title_lengths
+            self.doc_totals = (n, total, title_total)
+            self.num_delta_docs += len(doc_ids)
+            self.version += 1
+        return doc_ids
 
-                dl = 0  # Compute the document length (number of words).
-                doc_id += 1
+    def delete_documents(self, doc_ids):
+        """
+        Delete the docs with the given ids from the index. The deleted docs
+        are marked by tombstones: queries skip them and do not count them in
+        the statistics, until the next merge removes their postings (see
+        merge_delta). The doc ids of the other docs do not change, until the
+        index is compacted (see compact).
 
-                for word in re.split("[^A-Za-z]+", line):
-                    word = word.lower().strip()
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", b=0, k=float("inf"),
+        ...                   verbose=False)
+        >>> ii.delete_documents([3])
+        >>> result = ii.process_query(["short"])
+        >>> [(id, "%.3f" % tf) for id, tf in result]
+        [(4, '3.170')]
+        >>> ii.delete_documents([5])
+        Traceback (most recent call last):
+            ...
+        IndexError: doc id 5 out of range
+        """
+        with self.lock:
+            for doc_id in doc_ids:
+                if not 1 <= doc_id <= len(self.docs):
+                    raise IndexError("doc id %d out of range" % doc_id)
+            deleted = set(doc_ids) - self.deleted_docs
+            if deleted:
+                n, total, title_total = self.get_doc_totals()
+                if self.title_lengths is not None:
+                    title_total -= sum(self.title_lengths[x - 1]
+                                       for x in deleted)
+                self.doc_totals = (n - len(deleted), total - sum(
+                    self.doc_lengths[x - 1] for x in deleted), title_total)
+                # New sets, since snapshots may share them (see snapshot).
+                self.deleted_docs = self.deleted_docs | deleted
+                self.pending_deletes = self.pending_deletes | deleted
+                self.version += 1
+
+    def has_updates(self):
+        """
+        Return True if docs were added or deleted since the last merge.
+        """
+        return bool(self.num_delta_docs or self.pending_deletes)
+
+    def has_live_scores(self):
+        """
+        Return True if queries compute the scores of their keywords from the
+        tf scores (see live_lists) instead of using the stored scores: if
+        docs were added or deleted since the last merge, or if other field
+        weights are set for the queries (see set_query_field_weights).
+        """
+        return self.has_updates() or (
+            self.query_field_weights not in (None, self.field_weights))
+
+    def set_query_field_weights(self, field_weights):
+        """
+        Set the weights of the fields (see FIELDS) in the BM25F scores of the
+        queries, without re-computing the scores of the whole index (see
+        rescore). The queries then compute the scores of their keywords with
+        these weights, like for an index with updates, which is much slower
+        for long lists, but fast enough to try many weights (see evaluate.py).
+        With None, the queries use the stored scores again. Only for an index
+        with fields.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example-fields.tsv", verbose=False,
+        ...                   fields=True)
+        >>> before = ii.process_query(["short"])
+        >>> ii.set_query_field_weights((0, 1))
+        >>> [id for id, _ in ii.process_query(["short"])]
+        [3, 2]
+        >>> ii.set_query_field_weights(None)
+        >>> ii.process_query(["short"]) == before
+        True
+        >>> ii.set_query_field_weights((1, 1))
+        >>> result = ii.process_query(["short"])
+        >>> ii.rescore(field_weights=(1, 1))
+        >>> ii.set_query_field_weights(None)
+        >>> ii.process_query(["short"]) == result
+        True
+        """
+        if field_weights is not None:
+            if self.field_weights is None:
+                raise ValueError("The index has no fields, it has to be "
+                                 "built again with fields.")
+            field_weights = tuple(map(float, field_weights))
+        with self.lock:
+            self.query_field_weights = field_weights
+            self.version += 1
 
-                    # Ignore the word if it is empty.
-                    if len(word) == 0:
-                        continue
+    def live_list(self, word):
+        """
+        Return the inverted list (with tf scores only) of the given word in
+        the index with all updates: the postings of the delta segment are
+        appended and the postings of deleted docs are removed. Return None if
+        the word is in neither segment.
+        """
+        inverted_list = self.inverted_lists.get(word)
+        delta_list = self.delta_lists.get(word)
+        if delta_list is not None:
+            if inverted_list is None:
+                inverted_list = delta_list[:]
+            else:
+                inverted_list = inverted_list[:]
+                inverted_list.extend(delta_list)
+            inverted_list.scores = array("f")
+        elif inverted_list is None:
+            return None
+        return remove_docs(inverted_list, self.pending_deletes)
 
-                    dl += 1
+    def get_doc_totals(self):
+        """
+        Return the number, the total length and the total title length (0
+        without fields) of the docs that are not deleted. They are computed
+        once and then kept up to date by add_documents and delete_documents,
+        so queries on an index with updates do not compute them.
+        """
+        if self.doc_totals is None:
+            n, total = live_totals(self.doc_lengths, self.deleted_docs)
+            title_total = (live_totals(self.title_lengths,
+                                       self.deleted_docs)[1]
+                           if self.title_lengths is not None else 0)
+            self.doc_totals = (n, total, title_total)
+        return self.doc_totals
 
-                    if word not in self.inverted_lists:
-                        # The word is seen for first time, create new list.
-                        self.inverted_lists[word] = [(doc_id, 1)]
-                        continue
+    def doc_stats(self):
+        """
+        Return N (the number of docs that are not deleted), AVDL (their
+        average length) and AVTL (their average title length, 0 without
+        fields), like live_stats (see get_doc_totals).
 
-                    # Get last posting to check if the doc was already seen.
-                    last = self.inverted_lists[word][-1]
-                    if last[0] == doc_id:
-                        # The doc was already seen, increment tf by 1.
-                        self.inverted_lists[word][-1] = (doc_id, last[1] + 1)
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example-fields.tsv", verbose=False,
+        ...                   fields=True)
+        >>> ii.add_documents(["Short\tA short."]), ii.delete_documents([1])
+        ([5], None)
+        >>> n, avdl, avtl = ii.doc_stats()
+        >>> ((n, avdl) == live_stats(ii.doc_lengths, ii.deleted_docs),
+        ...  avtl == live_stats(ii.title_lengths, ii.deleted_docs)[1])
+        (True, True)
+        """
+        n, total, title_total = self.get_doc_totals()
+        return (n, total / n, title_total / n) if n else (0, 0, 0)
+
+    def snapshot(self):
+        """
+        Return a copy of the index that a query can read without holding the
+        lock, while docs are added or deleted and merges are installed. Only
+        taking the copy needs the lock. The copy shares all attributes, since
+        the updates replace the inverted lists, the delta segment, the
+        tombstones, the document lengths and the title lengths instead of
+        changing them (see add_documents, delete_documents, merge_delta and
+        compact). Only the list of docs grows in place, which does not change
+        the existing docs.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False)
+        >>> ii.add_documents(["Short film\tAn animated short film."])
+        [5]
+        >>> snapshot = ii.snapshot()
+        >>> ii.add_documents(["Short\tA short."]), ii.delete_documents([4])
+        ([6], None)
+        >>> list(snapshot.delta_lists["short"].doc_ids), snapshot.deleted_docs
+        ([5], set())
+        >>> [id for id, _ in snapshot.process_query(["short"])]
+        [4, 5, 3]
+        """
+        # A shallow copy, without __init__ (see __setstate__).
+        snapshot = type(self).__new__(type(self))
+        with self.lock:
+            snapshot.__dict__.update(self.__dict__)
+        return snapshot
+
+    def merge_delta(self):
+        """
+        Merge the delta segment and the tombstones into the inverted lists:
+        append the postings of the added docs, remove the postings of the
+        deleted docs and compute the BM25 scores of all lists from the tf
+        scores, with the statistics of the docs that are not deleted (see the
+        second pass in read_from_file). Every added or deleted doc changes N
+        and AVDL, so all scores change, and merging takes about as long as
+        rescore.
+
+        The merged lists are computed from a snapshot of the index, and only
+        installed at the end (under the lock). So the merge can run in a
+        background thread (see start_merge), while queries and updates go
+        on. Updates made during the merge are kept for the next merge.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False)
+        >>> ii.add_documents(["Short film\\tAn animated short film."])
+        [5]
+        >>> ii.delete_documents([2])
+        >>> before = ii.process_query(["short", "film"])
+        >>> ii.merge_delta()
+        >>> ii.has_updates(), ii.process_query(["short", "film"]) == before
+        (False, True)
+        >>> list(ii.inverted_lists["film"].doc_ids), ii.delta_lists
+        ([4, 5], {})
+        """
+        with self.merge_lock:
+            # Take a snapshot of the index (see snapshot). Only the current
+            # postings of the delta segment are merged.
+            with self.lock:
+                doc_lengths = self.doc_lengths
+                title_lengths = self.title_lengths
+                stats = self.doc_stats()
+                pending_deletes = self.pending_deletes
+                num_delta_docs = self.num_delta_docs
+                delta_lists = self.delta_lists
+                inverted_lists = self.inverted_lists
+                b, k = self.b, self.k
+                field_weights = self.field_weights
+
+            # Compute the merged lists. The lists that do not change are
+            # reused.
+            merged_lists = {}
+            for word in [*inverted_lists, *(x for x in delta_lists
+                                            if x not in inverted_lists)]:
+                inverted_list = inverted_lists.get(word)
+                delta_list = delta_lists.get(word)
+                if delta_list is not None:
+                    if inverted_list is None:
+                        inverted_list = delta_list
                     else:
-                        # The doc was not already seen, set tf to 1.
-                        self.inverted_lists[word].append((doc_id, 1))
+                        inverted_list = inverted_list[:]
+                        inverted_list.extend(delta_list)
+                inverted_list = remove_docs(inverted_list, pending_deletes)
+                if len(inverted_list.tfs) != len(inverted_list.doc_ids):
+                    raise ValueError("The inverted list of '%s' has no tf "
+                                     "scores, the index has to be built "
+                                     "again." % word)
+                if len(inverted_list) > 0:
+                    # A shallow copy, so that queries on a snapshot (see
+                    # snapshot) keep the scores of the reused lists.
+                    merged_lists[word] = copy(inverted_list)
 
-                # Store the doc as a tuple (title, description).
-                self.docs.append(tuple(line.split("\t")))
+            # Compute the BM25 (or BM25F) scores and the score bounds needed
+            # for top-k queries.
+            with self.profiler.phase("build/bm25"):
+                scores = score_lists(list(merged_lists.values()), doc_lengths,
+                                     title_lengths, stats, b, k,
+                                     field_weights)
+            with self.profiler.phase("build/score bounds"):
+                score_bounds = {word: compute_score_bounds(list_scores)
+                                for word, list_scores
+                                in zip(merged_lists, scores)}
+            with self.profiler.phase("build/impact orders"):
+                impact_size = self.impact_size
+                impact_orders = {word: impact_order(list_scores, impact_size)
+                                 for word, list_scores
+                                 in zip(merged_lists, scores)
+                                 if impact_size
+                                 and len(list_scores) > impact_size}
 
-                # Register the document length.
-                self.doc_lengths.append(dl)
+            # Install the merged lists, and keep the updates made since the
+            # snapshot.
+            with self.lock:
+                for inverted_list, list_scores in zip(merged_lists.values(),
+                                                      scores):
+                    inverted_list.scores = list_scores
+                self.inverted_lists = merged_lists
+                self.vocabulary = None
+                self.score_bounds = score_bounds
+                self.impact_orders = impact_orders
+                self.delta_lists = {
+                    word: delta_list[len(delta_lists.get(word, ())):]
+                    for word, delta_list in self.delta_lists.items()
+                    if len(delta_list) > len(delta_lists.get(word, ()))}
+                self.num_delta_docs -= num_delta_docs
+                self.pending_deletes = self.pending_deletes - pending_deletes
+                self.version += 1
 
-                if verbose:
-                    if doc_id % 1000 == 0:
-                        print(f"Progress: Read {doc_id:6} documents.",
-                              end="\r")
+    def start_merge(self):
+        """
+        Merge the updates in a background thread (see merge_delta), until
+        there are no more updates, unless such a thread is running already.
+        Queries on an index with updates are slower, since they compute the
+        scores of the keywords, so the updates should be merged soon. Return
+        the thread.
+        """
+        def merge():
+            while self.has_updates():
+                self.merge_delta()
 
-        # Compute N (the total number of documents).
-        n = len(self.docs)
+        with self.lock:
+            if self.merge_thread is None or not self.merge_thread.is_alive():
+                self.merge_thread = threading.Thread(target=merge,
+                                                     daemon=True)
+                self.merge_thread.start()
+            return self.merge_thread
 
-        if verbose:
-            print(f"Progress: Read {n:6} documents.")
+    def compact(self):
+        """
+        Merge the updates (see merge_delta) and remove the deleted docs from
+        the index: the doc ids of the following docs are decreased, so that
+        the doc ids are 1, ..., N again. The scores do not change. This is
+        needed before writing the index in the binary index format.
 
-        # Compute AVDL (the average document length).
-        avdl = sum(self.doc_lengths) / n
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False)
+        >>> ii.delete_documents([1])
+        >>> before = ii.process_query(["film", "short"])
+        >>> ii.compact()
+        >>> after = ii.process_query(["film", "short"])
+        >>> [(id, "%.3f" % tf) for id, tf in before]
+        [(4, '1.312'), (3, '0.664'), (2, '0.585')]
+        >>> [(id, "%.3f" % tf) for id, tf in after]
+        [(3, '1.312'), (2, '0.664'), (1, '0.585')]
+        >>> len(ii.docs), list(ii.doc_lengths), ii.deleted_docs
+        (3, [4, 3, 5], set())
+        """
+        with self.merge_lock, self.lock:
+            self.merge_delta()
+            if not self.deleted_docs:
+                return
+            # The new doc id of each doc (0 for the deleted docs).
+            new_ids = array("I", bytes(4 * (len(self.docs) + 1)))
+            new_id = 0
+            for doc_id in range(1, len(self.docs) + 1):
+                if doc_id not in self.deleted_docs:
+                    new_id += 1
+                    new_ids[doc_id] = new_id
+            # The lists are replaced by copies, so that queries on a
+            # snapshot (see snapshot) keep the old doc ids.
+            compacted_lists = {}
+            for word, inverted_list in self.inverted_lists.items():
+                inverted_list = compacted_lists[word] = copy(inverted_list)
+                if np is not None:
+                    inverted_list.doc_ids = array("I", np.asarray(new_ids)[
+                        np.asarray(inverted_list.doc_ids)].tobytes())
+                else:
+                    inverted_list.doc_ids = array(
+                        "I", map(new_ids.__getitem__, inverted_list.doc_ids))
+            self.inverted_lists = compacted_lists
+            live = [x not in self.deleted_docs
+                    for x in range(1, len(self.docs) + 1)]
+            self.docs = [x for x, keep in zip(self.docs, live) if keep]
+            self.doc_lengths = array("I", (x for x, keep in zip(
+                self.doc_lengths, live) if keep))
+            if self.title_lengths is not None:
+                self.title_lengths = array("I", (x for x, keep in zip(
+                    self.title_lengths, live) if keep))
+            self.deleted_docs = set()
+            self.version += 1
 
-        # Second pass: Iterate the inverted lists and replace the tf scores by
-        # BM25 scores, defined as follows:
-        # BM25 = tf * (k + 1) / (k * (1 - b + b * DL / AVDL) + tf) * log2(N/df)
-        for word, inverted_list in self.inverted_lists.items():
-            for i, (doc_id, tf) in enumerate(inverted_list):
-                # Obtain the document length (dl) of the document.
-                dl = self.doc_lengths[doc_id - 1]  # doc_id is 1-based.
-                # Compute alpha = (1 - b + b * DL / AVDL).
-                alpha = 1 - b + (b * dl / avdl)
-                # Compute tf2 = tf * (k + 1) / (k * alpha + tf).
-                tf2 = tf * (1 + (1 / k)) / (alpha + (tf / k)) if k > 0 else 1
-                # Compute df (that is the length of the inverted list).
-                df = len(self.inverted_lists[word])
-                # Compute the BM25 score = tf' * log2(N/df).
-                inverted_list[i] = (doc_id, tf2 * math.log(n / df, 2))
+    def add_shard(self, inverted_lists, docs, doc_lengths):
+        """
+        Append the docs of a shard, as returned by read_shard, to the index.
+        The doc ids in the inverted lists of the shard are relative to the
+        shard, they are shifted by the number of docs already in the index.
+        The inverted lists of the shard are reused by the index.
+
+        >>> ii = InvertedIndex()
+        >>> ii.add_shard(*read_shard("example.tsv", 0, 51))
+        >>> ii.add_shard(*read_shard("example.tsv", 51))
+        >>> short = ii.inverted_lists["short"]
+        >>> list(zip(short.doc_ids, short.tfs)), list(ii.doc_lengths)
+        ([(3, 1), (4, 2)], [3, 4, 3, 5])
+        """
+        offset = len(self.docs)
+        if self.title_lengths is not None:
+            self.title_lengths.extend(count_title_words(inverted_lists,
+                                                        len(docs)))
+        for word, shard_list in inverted_lists.items():
+            if offset > 0:
+                shard_list.doc_ids = array("I", (doc_id + offset for doc_id
+                                                 in shard_list.doc_ids))
+            inverted_list = self.inverted_lists.get(word)
+            if inverted_list is None:
+                self.inverted_lists[word] = shard_list
+            else:
+                inverted_list.extend(shard_list)
+        self.vocabulary = None
+        self.docs.extend(docs)
+        self.doc_lengths.extend(doc_lengths)
+        self.doc_totals = None
+        self.version += 1
+
+    def get_score_bounds(self, word):
+        """
+        Return the maximal BM25 score of the inverted list of the given word,
+        together with a list containing the maximal BM25 score of each block
+        of BLOCK_SIZE consecutive postings in the list. The bounds are computed
+        on the first call and cached.
+
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {"foo": PostingList([(1, 0.5), (3, 2.0)])}
+        >>> ii.get_score_bounds("foo")
+        (2.0, [2.0])
+        """
+        if word not in self.score_bounds:
+            self.score_bounds[word] = compute_score_bounds(
+                self.inverted_lists[word].scores)
+        return self.score_bounds[word]
+
+    def get_impact_order(self, word):
+        """
+        Return the impact order of the inverted list of the given word (see
+        impact_order), or None if the index keeps no impact order for it
+        (since the list is not longer than impact_size).
+        """
+        return self.impact_orders.get(word)
+
+    def get_vocabulary(self):
+        """
+        Return the index of the words of the inverted lists (see
+        vocabulary.VocabularyIndex), which expands prefix and fuzzy keywords
+        (see analyze_query). It is built on the first call, and again after
+        the words changed by a merge (see merge_delta), so the words of docs
+        added since the last merge are not in it.
+        """
+        # vocabulary.py needs this module, so import it here.
+        from vocabulary import VocabularyIndex
+
+        vocabulary = self.vocabulary
+        if vocabulary is None:
+            with self.lock:
+                inverted_lists = self.inverted_lists
+            words = sorted(inverted_lists)
+            vocabulary = VocabularyIndex(words, array("I", (
+                len(inverted_lists[word]) for word in words)))
+            with self.lock:
+                if self.inverted_lists is inverted_lists:
+                    self.vocabulary = vocabulary
+        return vocabulary
+
+    def analyze_query(self, query, fuzzy=False):
+        """
+        Split the given query into keywords, like the docs (see analyzer).
+        Words of form <word>* (prefix keywords) are expanded to the terms of
+        the index that start with the word, and words of form <word>~ or
+        <word>~N (fuzzy keywords) to the terms within edit distance N of the
+        word (by default, the maximal distance for its length), see
+        vocabulary.VocabularyIndex. A keyword that is expanded to several
+        terms is a tuple of them, which process_query matches by any of
+        them. If fuzzy is True, the keywords that are not in the index are
+        expanded like fuzzy keywords, so misspelled keywords still find
+        docs.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False)
+        >>> ii.analyze_query("Anim* flim~ shrot~0 non-mov*")
+        [('animated', 'animation'), 'film', (), 'non', 'movie']
+        >>> ii.analyze_query("the shrot flim", fuzzy=True)
+        [(), 'short', 'film']
+        """
+        # vocabulary.py needs this module, so import it here.
+        from vocabulary import EXPANSION_PATTERN, MAX_DISTANCE, MAX_EXPANSIONS
+
+        def expand(word, distance=None):
+            vocabulary = self.get_vocabulary()
+            if distance is None:
+                terms = vocabulary.prefix(word, MAX_EXPANSIONS)
+            else:
+                terms = vocabulary.fuzzy(word, distance, MAX_EXPANSIONS)
+            return terms[0] if len(terms) == 1 else tuple(terms)
+
+        keywords = []
+        for token in query.split():
+            match = EXPANSION_PATTERN.match(token)
+            words = tokenize(match.group(1)) if match is not None else []
+            if not words:
+                for term in self.analyzer.analyze(token):
+                    if fuzzy and term not in self.inverted_lists \
+                            and term not in self.delta_lists:
+                        term = expand(term, MAX_DISTANCE)
+                    keywords.append(term)
+                continue
+            # Only the last word of the token is expanded.
+            keywords.extend(self.analyzer.analyze(" ".join(words[:-1])))
+            if match.group(2) == "*":
+                keywords.append(expand(words[-1]))
+            else:
+                word = stem(words[-1]) if self.analyzer.stemming \
+                    else words[-1]
+                keywords.append(expand(word, int(match.group(3))
+                                       if match.group(3) else MAX_DISTANCE))
+        return keywords
 
     def merge(self, list1, list2):
         """
         Compute the union of the two given inverted lists in linear time
         (linear in the total number of entries in the two lists), where the
         entries in the inverted lists are postings of form (doc_id, bm25_score)
-        and are expected to be sorted by doc_id, in ascending order.
+        and are expected to be sorted by doc_id, in ascending order. The
+        result is a PostingList with 64-bit scores.
 
         >>> ii = InvertedIndex()
-        >>> l1 = ii.merge([(1, 2.1), (5, 3.2)], [(1, 1.7), (2, 1.3), (6, 3.3)])
+        >>> l1 = ii.merge(PostingList([(1, 2.1), (5, 3.2)]),
+        ...               PostingList([(1, 1.7), (2, 1.3), (6, 3.3)]))
         >>> [(id, "%.1f" % tf) for id, tf in l1]
         [(1, '3.8'), (2, '1.3'), (5, '3.2'), (6, '3.3')]
 
-        >>> l2 = ii.merge([(3, 1.7), (5, 3.2), (7, 4.1)], [(1, 2.3), (5, 1.3)])
+        >>> l2 = ii.merge(PostingList([(3, 1.7), (5, 3.2), (7, 4.1)]),
+        ...               PostingList([(1, 2.3), (5, 1.3)]))
         >>> [(id, "%.1f" % tf) for id, tf in l2]
         [(1, '2.3'), (3, '1.7'), (5, '4.5'), (7, '4.1')]
         """
+        ids1, scores1 = list1.doc_ids, list1.scores
+        ids2, scores2 = list2.doc_ids, list2.scores
+        result = PostingList(typecode="d")
+        result_ids, result_scores = result.doc_ids, result.scores
         i = 0  # The pointer in the first list.
         j = 0  # The pointer in the second list.
-        result = []
 
         # Iterate the lists in an interleaving order and aggregate the scores.
-        while i < len(list1) and j < len(list2):
-            if i < list1[i][0] == list2[j][0]:
-                result.append((list1[i][0], list1[i][1] + list2[j][1]))
+        while i < len(ids1) and j < len(ids2):
+            if ids1[i] == ids2[j]:
+                result_ids.append(ids1[i])
+                result_scores.append(scores1[i] + scores2[j])
                 i += 1
                 j += 1
-            elif list1[i][0] < list2[j][0]:
-                result.append(list1[i])
+            elif ids1[i] < ids2[j]:
+                result_ids.append(ids1[i])
+                result_scores.append(scores1[i])
                 i += 1
             else:
-                result.append(list2[j])
+                result_ids.append(ids2[j])
+                result_scores.append(scores2[j])
                 j += 1
 
         # Append the rest of the first list.
-        while i < len(list1):
-            result.append(list1[i])
-            i += 1
+        result_ids.extend(ids1[i:])
+        result_scores.extend(array("d", scores1[i:]))
 
         # Append the rest of the second list.
-        while j < len(list2):
-            result.append(list2[j])
-            j += 1
+        result_ids.extend(ids2[j:])
+        result_scores.extend(array("d", scores2[j:]))
 
         return result
 
-    def process_query(self, keywords):
+    def union(self, lists, k=None):
+        """
+        Compute the union of the given inverted lists in one pass over all
+        lists: the scores of each doc are added up in an accumulator indexed
+        by doc id (in the order of the lists, like the pairwise merge does).
+        Return the postings with a non-zero score, sorted by score in
+        descending order (ties are broken by doc id). If k is given, only the
+        top-k are selected, without sorting all postings.
+
+        The result is the same as sorting the pairwise merge of the lists.
+        With NumPy, the accumulator is an array over all doc ids, otherwise a
+        dictionary of the doc ids that occur in the lists.
+
+        >>> ii = InvertedIndex()
+        >>> l1 = PostingList([(1, 0.25), (3, 0.5), (5, 0.375)])
+        >>> l2 = PostingList([(1, 0.375), (2, 0.75), (3, 0.5), (4, 0.0)])
+        >>> l3 = PostingList([(2, 0.25), (6, 0.625)])
+        >>> ii.union([l1, l2, l3])
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [(2, 1.0), (3, 1.0), (1, 0.625), (6, 0.625), (5, 0.375)]
+        >>> ii.union([l1, l2, l3], k=3)
+        [(2, 1.0), (3, 1.0), (1, 0.625)]
+        >>> ii.union([l1, l2, l3], k=0), ii.union([PostingList()])
+        ([], [])
+        """
+        if k is not None and k <= 0:
+            return []
+        lists = [x for x in lists if len(x) > 0]
+        if not lists:
+            return []
+
+        with self.profiler.phase("query/merge"):
+            doc_ids, scores = self.accumulate(lists)
+        with self.profiler.phase("query/sort"):
+            return rank(doc_ids, scores, k)
+
+    def accumulate(self, lists):
+        """
+        Add up the scores of each doc in the given (non-empty) inverted lists
+        (see union). Return the doc ids in ascending order and their scores,
+        as NumPy arrays (or lists, without NumPy).
+        """
+        if np is not None:
+            if len(lists) == 1:
+                # A single list needs no accumulator.
+                doc_ids = np.asarray(lists[0].doc_ids)
+                scores = np.asarray(lists[0].scores, dtype=np.float64)
+                non_zero = scores != 0
+                doc_ids, scores = doc_ids[non_zero], scores[non_zero]
+            else:
+                # Accumulate the scores of each list at once (the doc ids of
+                # a list are distinct). The arrays are read with their item
+                # type, so the scores are added up as 64-bit floats.
+                num_docs = max(x.last_doc_id() for x in lists) + 1
+                accumulator = np.zeros(num_docs)
+                for inverted_list in lists:
+                    accumulator[np.asarray(inverted_list.doc_ids)] += \
+                        np.asarray(inverted_list.scores)
+                doc_ids = np.flatnonzero(accumulator)
+                scores = accumulator[doc_ids]
+            return doc_ids, scores
+
+        # Initialize the accumulator with the first list, then add the scores
+        # of the other lists.
+        accumulator = dict(zip(lists[0].doc_ids, lists[0].scores))
+        get = accumulator.get
+        for inverted_list in lists[1:]:
+            for doc_id, score in zip(inverted_list.doc_ids,
+                                     inverted_list.scores):
+                accumulator[doc_id] = get(doc_id, 0.0) + score
+        doc_ids = sorted(accumulator)
+        return doc_ids, list(map(accumulator.__getitem__, doc_ids))
+
+    def intersection(self, lists, k=None, phrase=None):
+        """
+        Compute the intersection of the given inverted lists (see intersect):
+        the docs that occur in all lists, with the sum of their scores (in the
+        order of the lists, like union does). If a phrase (the keywords of the
+        lists, in order) is given, only keep the docs that contain the phrase
+        (see phrase_matches). Return the postings with a non-zero score,
+        sorted by score in descending order (ties are broken by doc id), only
+        the top-k if k is given.
+
+        The scores are the same as in the union, so the result is the union
+        without the docs that miss one of the lists (or the phrase).
+
+        >>> ii = InvertedIndex()
+        >>> l1 = PostingList([(1, 0.25), (3, 0.5), (5, 0.375)])
+        >>> l2 = PostingList([(1, 0.375), (2, 0.75), (3, 0.5), (4, 0.0)])
+        >>> ii.intersection([l1, l2])
+        [(3, 1.0), (1, 0.625)]
+        >>> ii.intersection([l1, l2], k=1), ii.intersection([l1, l2], k=0)
+        ([(3, 1.0)], [])
+        """
+        if k is not None and k <= 0:
+            return []
+        with self.profiler.phase("query/merge"):
+            doc_ids, scores, indices = intersect(lists)
+            if np is not None:
+                doc_ids = np.asarray(doc_ids, dtype=np.int64)
+                scores = np.asarray(scores, dtype=np.float64)
+        if phrase is not None and len(phrase) > 1 and len(doc_ids) > 0:
+            with self.profiler.phase("query/filter"):
+                matches = self.phrase_matches(phrase, lists, doc_ids, indices)
+                if np is not None:
+                    matches = np.array(matches, dtype=bool)
+                    doc_ids, scores = doc_ids[matches], scores[matches]
+                else:
+                    doc_ids = [x for x, y in zip(doc_ids, matches) if y]
+                    scores = [x for x, y in zip(scores, matches) if y]
+        with self.profiler.phase("query/sort"):
+            if np is not None:
+                non_zero = scores != 0
+                doc_ids, scores = doc_ids[non_zero], scores[non_zero]
+            return rank(doc_ids, scores, k)
+
+    def phrase_matches(self, phrase, lists, doc_ids, indices):
+        """
+        Return for each of the given docs (with the given indices of their
+        postings in the given inverted lists of the keywords of the given
+        phrase, see intersect) if the doc contains the phrase: the keywords
+        at consecutive positions (in the terms of the doc). If all lists have
+        positional postings (see PostingList), they are used, otherwise the
+        docs are analyzed again.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False, positions=True)
+        >>> lists = [ii.inverted_lists["short"], ii.inverted_lists["film"]]
+        >>> doc_ids, _, indices = intersect(lists)
+        >>> list(map(int, doc_ids)), ii.docs[3]
+        ([4], ('Movie   Short animated short film.',))
+        >>> ii.phrase_matches(["short", "film"], lists, doc_ids, indices)
+        [True]
+        >>> lists.reverse()
+        >>> ii.phrase_matches(["film", "short"], lists, doc_ids, indices[::-1])
+        [False]
+        >>> ii.positional = False
+        >>> ii.phrase_matches(["film", "short"], [PostingList()] * 2,
+        ...                   doc_ids, indices)
+        [False]
+        """
+        if any(x.positions is None for x in lists):
+            phrase = list(phrase)
+            return [contains_phrase(self.analyzer.analyze(
+                        "\t".join(self.docs[doc_id - 1])), phrase)
+                    for doc_id in doc_ids]
+
+        starts = [x.position_starts() for x in lists]
+        matches = []
+        for j in range(len(doc_ids)):
+            # The start positions of the phrase that fit the positions of
+            # each keyword in the doc so far.
+            candidates = None
+            for i, inverted_list in enumerate(lists):
+                p = indices[i][j]
+                positions = inverted_list.positions[starts[i][p]:
+                                                    starts[i][p + 1]]
+                if candidates is None:
+                    candidates = set(positions)
+                else:
+                    candidates.intersection_update(x - i for x in positions)
+                if not candidates:
+                    break
+            matches.append(bool(candidates))
+        return matches
+
+    def process_query(self, keywords, k=None, mode="or"):
         """
         Process the given keyword query as follows: Fetch the inverted list for
-        each of the keywords in the query and compute the union of all lists.
-        Sort the resulting list by BM25 scores in descending order.
+        each of the keywords in the query and compute the union of all lists
+        (see union), sorted by BM25 scores in descending order. If k is given,
+        only compute the top-k of the result list. For short lists, the
+        exhaustive union is faster than the pruning in top_k, so top_k is only
+        used if the lists contain at least MIN_TOP_K_POSTINGS postings. If
+        docs were added or deleted since the last merge, the scores of the
+        keywords are computed from the tf scores (see live_lists).
+
+        The mode is one of MODES: with "or", the docs that contain any of the
+        keywords are returned. With "and", only the docs that contain all
+        keywords (see intersection), which is much faster than the union for
+        long lists, since the longer lists are only searched for the doc ids
+        of the shortest list. With "phrase", only the docs that contain the
+        keywords in the given order at consecutive positions. The scores are
+        the same in all modes.
+
+        A keyword can also be a tuple of terms, like an expanded prefix or
+        fuzzy keyword (see analyze_query): its inverted list is the union of
+        the lists of its terms, with the maximal score of the terms for each
+        doc (see merge_expansions). Such keywords cannot be used in the mode
+        "phrase".
 
         >>> ii = InvertedIndex()
         >>> ii.inverted_lists = {
-        ... "foo": [(1, 0.2), (3, 0.6)],
-        ... "bar": [(1, 0.4), (2, 0.7), (3, 0.5)],
-        ... "baz": [(2, 0.1)]}
+        ... "foo": PostingList([(1, 0.2), (3, 0.6)]),
+        ... "bar": PostingList([(1, 0.4), (2, 0.7), (3, 0.5)]),
+        ... "baz": PostingList([(2, 0.1)])}
         >>> result = ii.process_query(["foo", "bar"])
         >>> [(id, "%.1f" % tf) for id, tf in result]
         [(3, '1.1'), (2, '0.7'), (1, '0.6')]
+        >>> result = ii.process_query(["foo", "bar"], k=2)
+        >>> [(id, "%.1f" % tf) for id, tf in result]
+        [(3, '1.1'), (2, '0.7')]
+        >>> result = ii.process_query(["foo", "bar"], mode="and")
+        >>> [(id, "%.1f" % tf) for id, tf in result]
+        [(3, '1.1'), (1, '0.6')]
+        >>> ii.process_query(["foo", "baz"], mode="and")
+        []
+        >>> ii.process_query(["foo"], mode="any")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown query mode 'any', expected one of or, and, phrase.
+        >>> result = ii.process_query([("foo", "baz"), "bar"], mode="and")
+        >>> [(id, "%.1f" % tf) for id, tf in result]
+        [(3, '1.1'), (2, '0.8'), (1, '0.6')]
         """
+        if mode not in MODES:
+            raise ValueError("Unknown query mode '%s', expected one of %s."
+                             % (mode, ", ".join(MODES)))
+        if mode == "phrase" and not all(isinstance(x, str) for x in keywords):
+            raise ValueError("Prefix and fuzzy keywords cannot be used in "
+                             "phrase queries.")
         if not keywords:
             return []
+        if self.profiler.enabled:
+            return self.profiler.profile_query(self.run_query, keywords, k,
+                                               mode)
+        return self.run_query(keywords, k, mode)
 
-        # Fetch the inverted lists for each of the given keywords.
-        lists = []
-        for keyword in keywords:
-            if keyword in self.inverted_lists:
-                lists.append(self.inverted_lists[keyword])
+    def run_query(self, keywords, k=None, mode="or"):
+        """
+        Process the given keywords in the given mode, see process_query
+        (which checks the mode and records the query in the profiler). The
+        phases are recorded by the profiler: fetching the inverted lists
+        ("query/lookup"), computing the union or the intersection
+        ("query/merge"), checking the phrases ("query/filter") and selecting
+        the top-k ("query/sort", top_k and impact_top_k select them while
+        computing the union), together with the number of postings in the
+        lists. The query reads a snapshot of the index (see snapshot), so it
+        does not hold the lock while it runs.
+        """
+        profiler = self.profiler
+        # The pruning needs the score bounds of the stored lists, which the
+        # lists of expanded keywords do not have.
+        expanded = not all(isinstance(x, str) for x in keywords)
+        with profiler.phase("query/lookup"):
+            index = self.snapshot()
+            lists = index.fetch_lists(keywords, mode)
+        if not lists:
+            return []
+        if profiler.enabled:
+            profiler.count("query/postings", sum(map(len, lists)))
+
+        if mode != "or":
+            return index.intersection(
+                lists, k, keywords if mode == "phrase" else None)
+
+        if (k is not None and k <= index.impact_size
+                and len(lists) <= MAX_IMPACT_KEYWORDS
+                and not index.has_live_scores() and not expanded):
+            with profiler.phase("query/merge"):
+                result = index.impact_top_k(
+                    [x for x in keywords if x in index.inverted_lists],
+                    lists, k)
+            if result is not None:
+                return result
+
+        if (k is not None and not index.has_live_scores() and not expanded
+                and sum(map(len, lists)) >= MIN_TOP_K_POSTINGS):
+            with profiler.phase("query/merge"):
+                bounds = [index.get_score_bounds(keyword)
+                          for keyword in keywords
+                          if keyword in index.inverted_lists]
+                return index.top_k(lists, bounds, k)
 
         # Compute the union of all inverted lists.
-        if len(lists) == 0:
+        return index.union(lists, k)
+
+    def fetch_lists(self, keywords, mode="or"):
+        """
+        Return the inverted lists of the given keywords, in the order of the
+        keywords (for a tuple keyword, the merged lists of its terms, see
+        merge_expansions). If docs were added or deleted since the last merge
+        (or other field weights are set for the queries), the lists contain
+        the updates and their scores are computed (see live_lists). In the
+        mode "or", the keywords that are not in the index are skipped, in the
+        other modes, the result is empty then (no doc contains all keywords).
+        """
+        if not all(isinstance(x, str) for x in keywords):
+            # The list of an expanded keyword merges the lists of its terms.
+            lists = []
+            for keyword in keywords:
+                terms = (keyword,) if isinstance(keyword, str) else keyword
+                term_lists = self.fetch_lists(terms)
+                if len(term_lists) == 1:
+                    lists.append(term_lists[0])
+                elif term_lists:
+                    lists.append(merge_expansions(term_lists))
+        elif self.has_live_scores():
+            lists = self.live_lists(keywords)
+        else:
+            lists = [self.inverted_lists[keyword] for keyword in keywords
+                     if keyword in self.inverted_lists]
+        if mode != "or" and len(lists) < len(keywords):
+            return []
+        return lists
+
+    def live_lists(self, keywords):
+        """
+        Return the inverted lists of the given keywords in the index with all
+        updates (see live_list), with the BM25 scores computed from the tf
+        scores and the statistics of the docs that are not deleted. The
+        scores are the same as after merging the updates (see merge_delta).
+        If field weights for the queries are set (see
+        set_query_field_weights), the BM25F scores with these weights.
+        """
+        lists = {}
+        for keyword in keywords:
+            if keyword not in lists:
+                lists[keyword] = self.live_list(keyword)
+        # The lists without updates are the lists of the index, so their
+        # scores are set on shallow copies.
+        lists = {x: copy(y) for x, y in lists.items()
+                 if y is not None and len(y)}
+        for inverted_list, scores in zip(lists.values(), score_lists(
+                list(lists.values()), self.doc_lengths, self.title_lengths,
+                self.doc_stats(), self.b, self.k,
+                self.query_field_weights or self.field_weights)):
+            inverted_list.scores = scores
+        return [lists[x] for x in keywords if x in lists]
+
+    def top_k(self, lists, bounds, k):
+        """
+        Compute the k postings with the highest scores in the union of the
+        given inverted lists, using block-max WAND. The bounds are the score
+        bounds of the lists, as returned by get_score_bounds. The result is the
+        same as the first k postings of the exhaustive union, sorted by BM25
+        scores in descending order (ties are broken by doc id).
+
+        The lists are traversed in doc id order with one cursor per list. A doc
+        is only scored if the maximal scores of the lists that can contain it
+        add up to more than the score of the current k-th best doc. Otherwise,
+        the cursors skip ahead to the next doc that can still make it into the
+        top-k, without looking at the postings in between.
+
+        >>> ii = InvertedIndex()
+        >>> l1 = PostingList([(1, 0.25), (3, 0.5), (5, 0.375)])
+        >>> l2 = PostingList([(1, 0.375), (2, 0.75), (3, 0.5), (4, 0.0)])
+        >>> bounds = [(0.5, [0.5]), (0.75, [0.75])]
+        >>> ii.top_k([l1, l2], bounds, 3)
+        [(3, 1.0), (2, 0.75), (1, 0.625)]
+        >>> ii.top_k([l1, l2], bounds, 0)
+        []
+        """
+        if k <= 0 or not lists:
+            return []
+
+        # The doc ids and scores of the lists, and the functions to find doc
+        # ids in them (see PostingList.views).
+        doc_ids, scores, bisects = zip(*[x.views() for x in lists])
+        lengths = [len(x) for x in lists]
+
+        # A cursor is a list [doc id, position, list index], where the doc id
+        # is the doc id of the posting at the position. The postings before
+        # the position have already been processed.
+        cursors = [[doc_ids[i][0], 0, i]
+                   for i in range(len(lists)) if lengths[i] > 0]
+        # The top-k so far as a min-heap of (score, -doc_id).
+        heap = []
+
+        def move(cursor, target_id):
+            # Move the cursor to the first posting with a doc id >= target_id.
+            # Return False, if there is no such posting.
+            i = cursor[2]
+            cursor[1] = bisects[i](target_id, cursor[1])
+            if cursor[1] == lengths[i]:
+                return False
+            cursor[0] = doc_ids[i][cursor[1]]
+            return True
+
+        while cursors:
+            cursors.sort()
+            # A doc has to score more than the threshold to enter the top-k.
+            threshold = heap[0][0] if len(heap) == k else 0
+
+            # Find the pivot: the first cursor at which the maximal scores of
+            # all lists up to this cursor add up to more than the threshold.
+            # No doc before the doc of the pivot can make it into the top-k.
+            pivot = None
+            upper_bound = 0
+            for p, cursor in enumerate(cursors):
+                upper_bound += bounds[cursor[2]][0]
+                if upper_bound > threshold:
+                    pivot = p
+                    break
+            if pivot is None:
+                break
+            pivot_id = cursors[pivot][0]
+
+            if cursors[0][0] != pivot_id:
+                # Move the cursors before the pivot to the pivot doc.
+                exhausted = [not move(c, pivot_id) for c in cursors[:pivot]]
+            else:
+                # All cursors up to the pivot point to the pivot doc. Include
+                # the cursors after the pivot that point to the same doc.
+                while (pivot + 1 < len(cursors)
+                       and cursors[pivot + 1][0] == pivot_id):
+                    pivot += 1
+                current = cursors[:pivot + 1]
+
+                # Check the (tighter) bound given by the maximal scores of the
+                # blocks the cursors are currently in.
+                block_bound = 0
+                for _, pos, i in current:
+                    block_bound += bounds[i][1][pos // BLOCK_SIZE]
+
+                if block_bound > threshold:
+                    # Score the doc. Add up the scores in the order of the
+                    # lists, like the exhaustive union does.
+                    current.sort(key=lambda c: c[2])
+                    score = 0
+                    for cursor in current:
+                        score += scores[cursor[2]][cursor[1]]
+                    if score > threshold:
+                        if len(heap) == k:
+                            heapq.heapreplace(heap, (score, -pivot_id))
+                        else:
+                            heapq.heappush(heap, (score, -pivot_id))
+                    exhausted = [not move(c, pivot_id + 1) for c in current]
+                else:
+                    # No doc up to the end of the first of the current blocks
+                    # can make it into the top-k. Skip to the doc after it.
+                    next_id = min(
+                        doc_ids[i][min((pos // BLOCK_SIZE + 1) * BLOCK_SIZE,
+                                       lengths[i]) - 1]
+                        for _, pos, i in current) + 1
+                    if pivot + 1 < len(cursors):
+                        next_id = min(next_id, cursors[pivot + 1][0])
+                    exhausted = [not move(c, next_id) for c in current]
+
+            # Remove the cursors at the end of their list.
+            if any(exhausted):
+                cursors = [c for c in cursors if c[1] < lengths[c[2]]]
+
+        return [(-neg_id, score) for score, neg_id in sorted(heap,
+                                                             reverse=True)]
+
+    def impact_top_k(self, keywords, lists, k):
+        """
+        Compute the k postings with the highest scores in the union of the
+        given inverted lists of the given keywords from the impact orders of
+        the lists (see impact_order), like the threshold algorithm. The result
+        is the same as the first k postings of the exhaustive union. Return
+        None if the impact orders are too short to compute it, then the union
+        has to be computed (see run_query).
+
+        For a single keyword, the first k postings of the impact order are
+        the result. Otherwise, the candidates are the docs in the impact
+        orders, their full scores are computed by looking them up in all lists
+        (by binary search). Every other doc scores at most the sum of the last
+        scores in the impact orders, so if the k-th best candidate scores
+        more than that, the candidates contain the top-k. A list without a
+        stored impact order (it is short) is sorted on the fly.
+
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {
+        ... "foo": PostingList([(1, 0.25), (3, 0.5), (5, 0.375), (6, 0.125)]),
+        ... "bar": PostingList([(1, 0.375), (2, 0.75), (3, 0.5)])}
+        >>> ii.impact_size = 3
+        >>> ii.impact_orders = {"foo": impact_order(
+        ...     ii.inverted_lists["foo"].scores, ii.impact_size)}
+        >>> list(ii.impact_orders["foo"])
+        [1, 2, 0]
+        >>> lists = list(ii.inverted_lists.values())
+        >>> ii.impact_top_k(["foo", "bar"], lists, 2)
+        [(3, 1.0), (2, 0.75)]
+        >>> ii.impact_top_k(["foo"], lists[:1], 2)
+        [(3, 0.5), (5, 0.375)]
+
+        The impact order of "foo" does not contain the posting of doc 6, so
+        the top-5 of "foo" and "bar" cannot be computed from it.
+
+        >>> ii.impact_top_k(["foo", "bar"], lists, 4)
+        [(3, 1.0), (2, 0.75), (1, 0.625), (5, 0.375)]
+        >>> print(ii.impact_top_k(["foo", "bar"], lists, 5))
+        None
+
+        Compressed lists (see compression.py) are only decoded in the blocks
+        of the candidates.
+
+        >>> from compression import CompressedPostingList, encode_postings
+        >>> for pl in lists:
+        ...     pl.tfs = array("I", [1] * len(pl))
+        >>> lists = [CompressedPostingList(encode_postings(pl, "bitpack"), 0,
+        ...                                len(pl), "bitpack") for pl in lists]
+        >>> [(doc_id, "%.3f" % score)
+        ...  for doc_id, score in ii.impact_top_k(["foo", "bar"], lists, 2)]
+        [(3, '1.000'), (2, '0.750')]
+        """
+        if k <= 0 or not lists:
             return []
 
-        union = lists[0]
-        for i in range(1, len(lists)):
-            union = self.merge(union, lists[i])
+        # The impact order of each list, and the maximal score of the docs
+        # that are not in it (0 if it contains all postings with a non-zero
+        # score).
+        orders = [self.get_impact_order(keyword) for keyword in keywords]
+        if all(order is None for order in orders):
+            # All lists are short, the union is fast.
+            return None
+        threshold = 0
+        views = [inverted_list.views() for inverted_list in lists]
+        for i, inverted_list in enumerate(lists):
+            if orders[i] is None:
+                orders[i] = impact_order(inverted_list.scores,
+                                         len(inverted_list))
+            elif len(orders[i]) == self.impact_size:
+                threshold += views[i][1][orders[i][-1]]
 
-        # Filter all postings with BM25 = 0.
-        union = [x for x in union if x[1] != 0]
+        if len(lists) == 1:
+            if threshold > 0 and k > len(orders[0]):
+                return None
+            # The impact order of a single list is its top-k.
+            doc_ids, scores, _ = views[0]
+            return [(doc_ids[pos], scores[pos]) for pos in orders[0][:k]]
 
-        # Sort the postings by BM25 scores, in descending order.
-        return sorted(union, key=lambda x: x[1], reverse=True)
+        # Compute the scores of the candidates. Add up the scores in the order
+        # of the lists, like the exhaustive union does. Compressed lists are
+        # only decoded in the blocks of the candidates.
+        if np is not None and all(isinstance(x, PostingList) for x in lists):
+            candidates = np.unique(np.concatenate([
+                np.asarray(inverted_list.doc_ids)[np.asarray(order)]
+                for inverted_list, order in zip(lists, orders)]))
+            candidate_scores = np.zeros(len(candidates))
+            for inverted_list in lists:
+                doc_ids = np.asarray(inverted_list.doc_ids)
+                positions = np.minimum(np.searchsorted(doc_ids, candidates),
+                                       len(doc_ids) - 1)
+                found = doc_ids[positions] == candidates
+                candidate_scores[found] += np.asarray(
+                    inverted_list.scores)[positions[found]]
+        else:
+            candidates = sorted({doc_ids[pos]
+                                 for (doc_ids, _, _), order in zip(views,
+                                                                   orders)
+                                 for pos in sorted(order)})
+            candidate_scores = [0] * len(candidates)
+            for doc_ids, scores, bisect in views:
+                for i, doc_id in enumerate(candidates):
+                    pos = bisect(doc_id, 0)
+                    if pos < len(doc_ids) and doc_ids[pos] == doc_id:
+                        candidate_scores[i] += scores[pos]
+
+        result = rank(candidates, candidate_scores, k)
+        if threshold > 0 and (len(result) < k or result[-1][1] <= threshold):
+            return None
+        return result
 
     def render_output(self, postings, keywords, k=3):
         """
         Render the output for the top-k of the given postings. Fetch the
         the titles and descriptions of the related docs and highlight the
-        occurences of the given keywords in the output, using ANSI escape
-        codes.
+        occurences of the given keywords (terms of the analyzer of the index)
+        in the output, using ANSI escape codes. Only a snippet of each
+        description is shown (see snippets.make_snippet).
         """
-
-        # Compile a pattern to identify the given keywords in a string.
-        p = re.compile('\\b(' + '|'.join(keywords) + ')\\b', re.IGNORECASE)
+        terms = set(keyword_terms(keywords))
 
         # Output at most k matching docs.
         for i in range(min(len(postings), k)):
             doc_id, tf = postings[i]
-            title, desc = self.docs[doc_id - 1]  # doc_id is 1-based.
+            title, *desc = self.docs[doc_id - 1]  # doc_id is 1-based.
 
-            # Highlight the keywords in the title in bold and red.
-            title = re.sub(p, "\033[0m\033[1;31m\\1\033[0m\033[1m", title)
+            # Highlight the keywords in the title in bold and red, and print
+            # the rest of the title in bold.
+            title = to_ansi(make_snippet(title, terms, self.analyzer,
+                                         len(title)), bold=True)
 
-            # Print the rest of the title in bold.
-            title = "\033[1m%s\033[0m" % title
-
-            # Highlight the keywords in the description in red.
-            desc = re.sub(p, "\033[31m\\1\033[0m", desc)
+            # Highlight the keywords in the snippet of the description in
+            # red.
+            desc = to_ansi(make_snippet(" ".join(desc), terms, self.analyzer))
 
             print("\n%s\n%s" % (title, desc))
 
         print("\n# total hits: %s." % len(postings))
 
 
-def main(file_name, b, k):
-    # Create a new inverted index from the given file.
-    print("Creating index with BM25 scores from file '%s'." % file_name)
-    ii = InvertedIndex()
-    ii.read_from_file(file_name, b=b, k=k)
+def read_shard(file_name, start=0, end=None, verbose=False, analyzer=None,
+               positions=False, profiler=None, fields=False):
+    """
+    Read the lines of the given file that start in the given byte range
+    [start, end) (by default, the whole file), see the first pass in
+    InvertedIndex.read_from_file. The start is expected to be the start of a
+    line. The lines are split into words by the given analyzer (by default,
+    Analyzer()). Return a triple (inverted_lists, docs, doc_lengths), where the
+    inverted lists contain tf scores (and positions, if positions is True)
+    and the doc ids are 1-based and relative to the start. The time of
+    splitting the docs into words and of adding them to the inverted lists
+    is recorded by the given profiler (see profiling.py), if any. If fields
+    is True, the inverted lists also have the tf scores in the title (see
+    PostingList): the title and the description are split into words
+    separately, which gives the same words as splitting the whole line.
+
+    Lines are separated as when reading the file in text mode, that is, by
+    LF, CR or CRLF.
+
+    >>> inverted_lists, docs, doc_lengths = read_shard("example.tsv", 51)
+    >>> [(w, list(zip(l.doc_ids, l.tfs)))
+    ...  for w, l in sorted(inverted_lists.items())]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('animated', [(2, 1)]),
+     ('animation', [(1, 1)]),
+     ('film', [(2, 1)]),
+     ('movie', [(1, 1), (2, 1)]),
+     ('short', [(1, 1), (2, 2)])]
+    >>> list(doc_lengths)
+    [3, 5]
+    """
+    inverted_lists = {}
+    docs = []
+    doc_lengths = array("I")
+    analyze = (analyzer or Analyzer()).analyze
+    add = add_doc
+    if profiler is not None:
+        analyze = profiler.timed("build/tokenize", analyze)
+        add = profiler.timed("build/postings", add)
+
+    for doc_id, line in enumerate(read_lines(file_name, start, end), 1):
+        # Add the words of the doc to the inverted lists and register the
+        # document length (number of words).
+        if fields:
+            title, _, description = line.partition("\t")
+            words = analyze(title)
+            title_length = len(words)
+            words += analyze(description)
+            add(inverted_lists, doc_id, words, positions, title_length)
+        else:
+            words = analyze(line)
+            add(inverted_lists, doc_id, words, positions)
+        doc_lengths.append(len(words))
+
+        # Store the doc as a tuple (title, description).
+        docs.append(tuple(line.split("\t")))
+
+        if verbose:
+            if doc_id % 1000 == 0:
+                print(f"Progress: Read {doc_id:6} documents.", end="\r")
+
+    return inverted_lists, docs, doc_lengths
+
 
-    new_name = (file_name.replace("input", "output")
-                         .replace(".tsv", "_")) + "precomputed_ii.pkl"
+def read_lines(file_name, start=0, end=None):
+    """
+    Generate the lines of the given file that start in the given byte range
+    [start, end) (by default, the whole file), decoded from UTF-8 and
+    stripped. Lines are separated as when reading the file in text mode,
+    that is, by LF, CR or CRLF.
+
+    >>> list(read_lines("example.tsv", 51, 76))
+    ['Movie   Short animation.']
+    """
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        position = start
+        for raw_line in f:
+            if end is not None and position >= end:
+                break
+            position += len(raw_line)
+
+            for line in raw_line.splitlines():
+                yield line.decode("utf-8").strip()
+
+
+def add_doc(inverted_lists, doc_id, words, positions=False,
+            title_length=None):
+    """
+    Add the given words of a doc with the given doc id to the given inverted
+    lists with tf scores (see the first pass in InvertedIndex.read_from_file).
+    If positions is True, also add the position of each word in the doc to
+    the positional postings (see PostingList). If a title length is given,
+    the first title_length words are the title, and the tf scores in the
+    title are added as well. The doc id must be larger than the doc ids
+    already in the lists.
+
+    >>> inverted_lists = {}
+    >>> add_doc(inverted_lists, 1, ["short", "film", "a", "short", "movie"])
+    >>> [(w, list(zip(l.doc_ids, l.tfs)))
+    ...  for w, l in sorted(inverted_lists.items())]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('a', [(1, 1)]), ('film', [(1, 1)]), ('movie', [(1, 1)]),
+     ('short', [(1, 2)])]
+    >>> inverted_lists = {}
+    >>> add_doc(inverted_lists, 1, ["short", "film", "short"], title_length=1)
+    >>> [(w, list(l.tfs), list(l.title_tfs))
+    ...  for w, l in sorted(inverted_lists.items())]
+    [('film', [1], [0]), ('short', [2], [1])]
+    """
+    for position, word in enumerate(words):
+        inverted_list = inverted_lists.get(word)
+        if inverted_list is None:
+            # The word is seen for first time, create new list.
+            inverted_list = inverted_lists[word] = PostingList()
+            if positions:
+                inverted_list.positions = array("I")
+            if title_length is not None:
+                inverted_list.title_tfs = array("I")
+        elif inverted_list.doc_ids[-1] == doc_id:
+            # The doc was already seen, increment tf by 1.
+            inverted_list.tfs[-1] += 1
+            if positions:
+                inverted_list.positions.append(position)
+            if title_length is not None and position < title_length:
+                inverted_list.title_tfs[-1] += 1
+            continue
+
+        # The doc was not already seen, set tf to 1.
+        inverted_list.doc_ids.append(doc_id)
+        inverted_list.tfs.append(1)
+        if positions:
+            inverted_list.positions.append(position)
+        if title_length is not None:
+            inverted_list.title_tfs.append(int(position < title_length))
+
+
+def remove_docs(inverted_list, doc_ids):
+    """
+    Return the given inverted list without the postings of the given doc ids
+    (the list itself, if it contains none of them). The doc ids are found by
+    binary search, so this is fast for a few doc ids.
+
+    >>> pl = PostingList([(1, 0.5), (3, 2.0), (4, 1.5), (6, 1.0)])
+    >>> remove_docs(pl, {2, 3, 6})
+    PostingList([(1, 0.5), (4, 1.5)])
+    >>> remove_docs(pl, {2}) is pl
+    True
+    """
+    positions = []
+    for doc_id in sorted(doc_ids):
+        i = bisect_left(inverted_list.doc_ids, doc_id)
+        if i < len(inverted_list) and inverted_list.doc_ids[i] == doc_id:
+            positions.append(i)
+    if not positions:
+        return inverted_list
+    result = inverted_list[:positions[0]]
+    for start, end in zip(positions, positions[1:] + [len(inverted_list)]):
+        result.extend(inverted_list[start + 1:end])
+    return result
+
+
+def intersect(lists):
+    """
+    Compute the intersection of the given inverted lists. Return a triple
+    (doc_ids, scores, indices): the doc ids that occur in all lists (in
+    ascending order), the sum of their scores in the lists (added up in the
+    order of the lists, as 64-bit floats) and, for each list, the indices of
+    the postings of the doc ids in the list.
+
+    The lists are processed from the shortest to the longest one: only the
+    doc ids of the shortest list are searched in the other lists, so the time
+    depends on the length of the shortest list, and is only logarithmic in
+    the lengths of the others. With NumPy, the doc ids of the shortest list
+    are searched in each other list at once (by binary search). Otherwise,
+    one cursor per list leapfrogs to the next doc id that may be in all lists,
+    by binary search from the current position (see PostingList.views; the
+    cursors of compressed lists skip the blocks that cannot contain the doc
+    id, using the last doc id of each block).
+
+    >>> l1 = PostingList([(1, 0.25), (3, 0.5), (5, 0.375), (8, 0.5)])
+    >>> l2 = PostingList([(1, 0.375), (2, 0.75), (3, 0.5), (4, 0.0), (8, 1)])
+    >>> doc_ids, scores, indices = intersect([l1, l2])
+    >>> list(map(int, doc_ids)), list(map(float, scores))
+    ([1, 3, 8], [0.625, 1.0, 1.5])
+    >>> [list(map(int, x)) for x in indices]
+    [[0, 1, 3], [0, 2, 4]]
+    >>> doc_ids, scores, indices = intersect([l1, PostingList()])
+    >>> len(doc_ids), len(scores), [len(x) for x in indices]
+    (0, 0, [0, 0])
+    """
+    if np is not None and all(isinstance(x, PostingList) for x in lists):
+        order = sorted(range(len(lists)), key=lambda i: len(lists[i]))
+        doc_ids = [np.asarray(x.doc_ids) for x in lists]
+        indices = [None] * len(lists)
+        indices[order[0]] = np.arange(len(doc_ids[order[0]]))
+        candidates = doc_ids[order[0]]
+        found = order[:1]  # The lists searched so far.
+        for i in order[1:]:
+            if len(doc_ids[i]) == 0:
+                candidates = candidates[:0]
+                indices[i] = np.arange(0)
+            else:
+                positions = np.searchsorted(doc_ids[i], candidates)
+                positions[positions == len(doc_ids[i])] = 0
+                matches = doc_ids[i][positions] == candidates
+                candidates = candidates[matches]
+                indices[i] = positions[matches]
+                for j in found:
+                    indices[j] = indices[j][matches]
+            found.append(i)
+        scores = np.zeros(len(candidates))
+        for inverted_list, list_indices in zip(lists, indices):
+            scores += np.asarray(inverted_list.scores)[list_indices]
+        return candidates, scores, indices
+
+    doc_ids, list_scores, seeks = zip(*[x.views() for x in lists])
+    lengths = [len(x) for x in lists]
+    order = sorted(range(len(lists)), key=lengths.__getitem__)
+    result_ids, result_scores = [], []
+    indices = [[] for _ in lists]
+    if min(lengths) == 0:
+        return result_ids, result_scores, indices
+    cursors = [0] * len(lists)
+    target = doc_ids[order[0]][0]
+    while True:
+        # Move the cursors to the first doc id >= the target, from the
+        # shortest list on. If a cursor passes the target, its doc id is the
+        # next target.
+        for i in order:
+            cursors[i] = seeks[i](target, cursors[i])
+            if cursors[i] == lengths[i]:
+                return result_ids, result_scores, indices
+            doc_id = doc_ids[i][cursors[i]]
+            if doc_id != target:
+                target = doc_id
+                break
+        else:
+            # All cursors are at the target.
+            score = 0.0
+            for i in range(len(lists)):
+                score += list_scores[i][cursors[i]]
+                indices[i].append(cursors[i])
+            result_ids.append(target)
+            result_scores.append(score)
+            target += 1
+
+
+def rank(doc_ids, scores, k=None):
+    """
+    Return the postings of the given doc ids (in ascending order) with the
+    given scores, without the postings with a score of 0, sorted by score in
+    descending order (ties are broken by doc id). If k is given, only the
+    top-k are selected, without sorting all postings. With NumPy, the doc ids
+    and the scores are expected as NumPy arrays.
+
+    >>> rank([1, 2, 4, 5], [0.5, 0.0, 1.0, 0.5], 2)
+    [(4, 1.0), (1, 0.5)]
+    """
+    if np is not None and isinstance(scores, np.ndarray):
+        if k is not None and k < len(doc_ids):
+            # Keep only the docs with at least the k-th highest score.
+            kth_score = np.partition(scores, -k)[-k]
+            selected = scores >= kth_score
+            doc_ids, scores = doc_ids[selected], scores[selected]
+        order = np.lexsort((doc_ids, -scores))[:k]
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
+    postings = list(filter(itemgetter(1), zip(doc_ids, scores)))
+    if k is None:
+        return sorted(postings, key=itemgetter(1), reverse=True)
+    return heapq.nlargest(k, postings, key=itemgetter(1))
+
+
+def merge_expansions(lists):
+    """
+    Merge the given inverted lists of the terms of an expanded keyword (see
+    InvertedIndex.analyze_query) into one list: the union of the docs, each
+    with the maximal score of the terms it contains. Taking the maximum
+    instead of the sum keeps a doc that contains many of the terms from
+    ranking above a doc that contains the keyword the user meant.
+
+    >>> l1 = PostingList([(1, 0.25), (3, 0.5), (5, 0.375)])
+    >>> l2 = PostingList([(1, 0.375), (2, 0.75), (3, 0.0)])
+    >>> merge_expansions([l1, l2])
+    PostingList([(1, 0.375), (2, 0.75), (3, 0.5), (5, 0.375)])
+    >>> merge_expansions([l2, PostingList()])
+    PostingList([(1, 0.375), (2, 0.75), (3, 0.0)])
+    """
+    result = PostingList(typecode="d")
+    lists = [x for x in lists if len(x) > 0]
+    if not lists:
+        return result
+    if np is not None:
+        num_docs = max(x.last_doc_id() for x in lists) + 1
+        accumulator = np.zeros(num_docs)
+        seen = np.zeros(num_docs, dtype=bool)
+        for inverted_list in lists:
+            doc_ids = np.asarray(inverted_list.doc_ids)
+            accumulator[doc_ids] = np.maximum(
+                accumulator[doc_ids], np.asarray(inverted_list.scores))
+            seen[doc_ids] = True
+        doc_ids = np.flatnonzero(seen)
+        result.doc_ids.frombytes(doc_ids.astype(np.uint32).tobytes())
+        result.scores.frombytes(accumulator[doc_ids].tobytes())
+        return result
+
+    accumulator = {}
+    for inverted_list in lists:
+        for doc_id, score in zip(inverted_list.doc_ids, inverted_list.scores):
+            if score >= accumulator.get(doc_id, score):
+                accumulator[doc_id] = score
+    for doc_id in sorted(accumulator):
+        result.append(doc_id, accumulator[doc_id])
+    return result
+
+
+def keyword_terms(keywords):
+    """
+    Return the terms of the given keywords, with the terms of the tuple
+    keywords (see InvertedIndex.analyze_query) in place of the keywords.
+
+    >>> keyword_terms(["short", ("film", "films"), ()])
+    ['short', 'film', 'films']
+    """
+    return [term for keyword in keywords
+            for term in ((keyword,) if isinstance(keyword, str) else keyword)]
+
+
+def contains_phrase(words, phrase):
+    """
+    Return True if the given list of words contains the given phrase (a list
+    of words) at consecutive positions.
+
+    >>> contains_phrase(["a", "short", "film"], ["short", "film"])
+    True
+    >>> contains_phrase(["film", "short", "film"], ["short", "movie"])
+    False
+    """
+    n = len(phrase)
+    return any(words[i:i + n] == phrase
+               for i, word in enumerate(words) if word == phrase[0])
+
+
+def live_totals(doc_lengths, deleted_docs):
+    """
+    Return the number and the total length of the docs with the given
+    lengths, without the given deleted docs.
+
+    >>> live_totals(array("I", [3, 4, 3, 5]), {2})
+    (3, 11)
+    """
+    n = len(doc_lengths) - len(deleted_docs)
+    total = sum(doc_lengths) - sum(doc_lengths[x - 1] for x in deleted_docs)
+    return n, total
+
+
+def live_stats(doc_lengths, deleted_docs):
+    """
+    Return N (the number of docs) and AVDL (the average document length) of
+    the docs with the given lengths, without the given deleted docs.
+
+    >>> live_stats(array("I", [3, 4, 3, 5]), {2})
+    (3, 3.6666666666666665)
+    """
+    n, total = live_totals(doc_lengths, deleted_docs)
+    return n, total / n if n else 0
+
+
+def bm25_scores(inverted_lists, doc_lengths, n, avdl, b, k, dfs=None):
+    """
+    Compute the BM25 scores of the given inverted lists (with tf scores)
+    from the given document lengths, N, AVDL, b and k (see the second pass in
+    InvertedIndex.read_from_file). The df of each list is its length, unless
+    the dfs of the lists are given (like for a shard of an index, whose
+    scores are computed with the statistics of the whole index, see
+    sharding.py). Return the scores of each list, as arrays of 32-bit floats.
+
+    If NumPy is available, the scores of all lists are computed at once with
+    NumPy. Otherwise, they are computed in pure Python. Both give the same
+    scores.
+
+    >>> pl = PostingList([(1, 0), (3, 0)])
+    >>> pl.tfs = array("I", [1, 2])
+    >>> bm25_scores([pl], array("I", [3, 4, 3, 5]), 4, 3.75, 0, float("inf"))
+    [array('f', [1.0, 2.0])]
+    >>> bm25_scores([pl], array("I", [3, 4, 3, 5]), 4, 3.75, 0, float("inf"),
+    ...             dfs=[1])
+    [array('f', [2.0, 4.0])]
+    """
+    # BM25 = tf * (k + 1) / (k * (1 - b + b * DL / AVDL) + tf) * log2(N/df)
+    # The computation with NumPy does the same operations in the same order
+    # on all postings at once.
+    if np is not None:
+        if not inverted_lists:
+            return []
+        # Compute the idf = log2(N/df) of each inverted list and repeat it
+        # for each posting.
+        lengths = np.array([len(x) for x in inverted_lists])
+        idfs = np.repeat([math.log(n / df, 2)
+                          for df in (lengths if dfs is None else dfs)],
+                         lengths)
+        doc_ids = np.frombuffer(
+            b"".join(x.doc_ids for x in inverted_lists), np.uint32)
+        tfs = np.frombuffer(b"".join(x.tfs for x in inverted_lists),
+                            np.uint32).astype(np.float64)
+        # Compute alpha = (1 - b + b * DL / AVDL) for each posting (only the
+        # lengths of the docs in the lists are read).
+        dls = np.frombuffer(doc_lengths, np.uint32)[doc_ids - 1]
+        alphas = 1 - b + (b * dls.astype(np.float64) / avdl)
+        # Compute tf2 = tf * (k + 1) / (k * alpha + tf).
+        if k > 0:
+            tf2s = tfs * (1 + (1 / k)) / (alphas + (tfs / k))
+        else:
+            tf2s = np.ones(len(tfs))
+        # Compute the BM25 score = tf' * log2(N/df).
+        scores = (tf2s * idfs).astype(np.float32).tobytes()
+        result = []
+        start = 0
+        for length in lengths.tolist():
+            result.append(array("f", scores[start:start + 4 * length]))
+            start += 4 * length
+        return result
+
+    result = []
+    if dfs is None:
+        # The df of a list is its length.
+        dfs = map(len, inverted_lists)
+    for inverted_list, df in zip(inverted_lists, dfs):
+        idf = math.log(n / df, 2)
+        scores = array("f", bytes(4 * len(inverted_list)))
+        for i, doc_id in enumerate(inverted_list.doc_ids):
+            tf = inverted_list.tfs[i]
+            # Obtain the document length (dl) of the document.
+            dl = doc_lengths[doc_id - 1]  # doc_id is 1-based.
+            # Compute alpha = (1 - b + b * DL / AVDL).
+            alpha = 1 - b + (b * dl / avdl)
+            # Compute tf2 = tf * (k + 1) / (k * alpha + tf).
+            tf2 = (tf * (1 + (1 / k)) / (alpha + (tf / k))
+                   if k > 0 else 1)
+            # Compute the BM25 score = tf' * log2(N/df).
+            scores[i] = tf2 * idf
+        result.append(scores)
+    return result
+
+
+def bm25f_scores(inverted_lists, doc_lengths, title_lengths, n, avdl, avtl,
+                 b, k, field_weights):
+    """
+    Compute the BM25F scores of the given inverted lists (with tf scores and
+    tf scores in the title) from the given document lengths and title lengths
+    (the number of words in the title of each doc), N, AVDL, AVTL (the
+    average title length), b, k and the weights of the fields (see FIELDS).
+    Return the scores of each list, as arrays of 32-bit floats.
+
+    The tf scores of the fields are normalized by the length of the field,
+    like in BM25, weighted and added up before the saturation by k:
+    tf' = w_title * tf_title / alpha_title + w_desc * tf_desc / alpha_desc,
+    where alpha_f = 1 - b + b * L_f / AVL_f for the length L_f of the field
+    in the doc and its average length AVL_f. The score is then
+    tf' * (k + 1) / (k + tf') * log2(N/df). So with a higher weight of the
+    title, the words in the title count more, but the score of a word is
+    still bounded, no matter how often it occurs.
+
+    If NumPy is available, the scores of all lists are computed at once with
+    NumPy. Otherwise, they are computed in pure Python. Both give the same
+    scores.
+
+    >>> pl = PostingList([(1, 0), (3, 0)])
+    >>> pl.tfs = array("I", [1, 2])
+    >>> pl.title_tfs = array("I", [1, 0])
+    >>> bm25f_scores([pl], array("I", [3, 4, 3, 5]), array("I", [1, 1, 1, 1]),
+    ...              4, 3.75, 1, 0, float("inf"), (2, 1))
+    [array('f', [2.0, 2.0])]
+    """
+    # The average length of the descriptions. Its lengths are all 0 if it is
+    # 0, then the lengths are not normalized.
+    avddl = (avdl - avtl) or 1
+    avtl = avtl or 1
+    title_weight, description_weight = field_weights
+    if np is not None:
+        if not inverted_lists:
+            return []
+        # Compute the idf = log2(N/df) of each inverted list and repeat it
+        # for each posting.
+        lengths = np.array([len(x) for x in inverted_lists])
+        idfs = np.repeat([math.log(n / df, 2) for df in lengths], lengths)
+        doc_ids = np.frombuffer(
+            b"".join(x.doc_ids for x in inverted_lists), np.uint32)
+        tfs = np.frombuffer(b"".join(x.tfs for x in inverted_lists),
+                            np.uint32).astype(np.float64)
+        title_tfs = np.frombuffer(
+            b"".join(x.title_tfs for x in inverted_lists),
+            np.uint32).astype(np.float64)
+        description_tfs = tfs - title_tfs
+        # Compute alpha_f = (1 - b + b * L_f / AVL_f) of each field for each
+        # doc (1 for a field of length 0 with b = 1, its tf scores are 0).
+        dls = np.frombuffer(doc_lengths, np.uint32).astype(np.float64)
+        tls = np.frombuffer(title_lengths, np.uint32).astype(np.float64)
+        title_alphas = 1 - b + (b * tls / avtl)
+        description_alphas = 1 - b + (b * (dls - tls) / avddl)
+        title_alphas[title_alphas <= 0] = 1
+        description_alphas[description_alphas <= 0] = 1
+        # Compute tf' of each posting (doc_id is 1-based).
+        tf1s = (title_weight * title_tfs / title_alphas[doc_ids - 1]
+                + description_weight * description_tfs
+                / description_alphas[doc_ids - 1])
+        # Compute tf2 = tf' * (k + 1) / (k + tf').
+        if k > 0:
+            tf2s = tf1s * (1 + (1 / k)) / (1 + (tf1s / k))
+        else:
+            tf2s = np.ones(len(tfs))
+        # Compute the BM25F score = tf2 * log2(N/df).
+        scores = (tf2s * idfs).astype(np.float32).tobytes()
+        result = []
+        start = 0
+        for length in lengths.tolist():
+            result.append(array("f", scores[start:start + 4 * length]))
+            start += 4 * length
+        return result
+
+    result = []
+    for inverted_list in inverted_lists:
+        idf = math.log(n / len(inverted_list), 2)
+        scores = array("f", bytes(4 * len(inverted_list)))
+        for i, doc_id in enumerate(inverted_list.doc_ids):
+            title_tf = inverted_list.title_tfs[i]
+            description_tf = inverted_list.tfs[i] - title_tf
+            # Obtain the length of the title and of the description.
+            tl = title_lengths[doc_id - 1]  # doc_id is 1-based.
+            ddl = doc_lengths[doc_id - 1] - tl
+            # Compute alpha_f = (1 - b + b * L_f / AVL_f) of each field.
+            title_alpha = 1 - b + (b * tl / avtl)
+            description_alpha = 1 - b + (b * ddl / avddl)
+            # Compute tf' = the weighted sum of tf_f / alpha_f.
+            tf1 = (title_weight * title_tf
+                   / (title_alpha if title_alpha > 0 else 1)
+                   + description_weight * description_tf
+                   / (description_alpha if description_alpha > 0 else 1))
+            # Compute tf2 = tf' * (k + 1) / (k + tf').
+            tf2 = tf1 * (1 + (1 / k)) / (1 + (tf1 / k)) if k > 0 else 1
+            # Compute the BM25F score = tf2 * log2(N/df).
+            scores[i] = tf2 * idf
+        result.append(scores)
+    return result
+
+
+def score_lists(inverted_lists, doc_lengths, title_lengths, stats, b, k,
+                field_weights=None):
+    """
+    Compute the scores of the given inverted lists with the given statistics
+    N, AVDL and AVTL (see InvertedIndex.doc_stats) of the docs with the
+    given lengths (and title lengths): the BM25 scores (see bm25_scores), or
+    with field weights the BM25F scores (see bm25f_scores).
+    """
+    n, avdl, avtl = stats
+    if field_weights is None:
+        return bm25_scores(inverted_lists, doc_lengths, n, avdl, b, k)
+    return bm25f_scores(inverted_lists, doc_lengths, title_lengths, n, avdl,
+                        avtl, b, k, field_weights)
+
+
+def count_title_words(inverted_lists, num_docs):
+    """
+    Return the number of words in the title of each of the docs 1, ...,
+    num_docs, that is the sum of the tf scores in the title of its postings
+    in the given inverted lists (with fields, see read_shard).
+
+    >>> inverted_lists, docs, _ = read_shard("example-fields.tsv",
+    ...                                      fields=True)
+    >>> list(count_title_words(inverted_lists, len(docs)))
+    [2, 2, 2, 1]
+    """
+    if np is not None:
+        lists = list(inverted_lists.values())
+        if not lists:
+            return array("I", bytes(4 * num_docs))
+        counts = np.bincount(
+            np.frombuffer(b"".join(x.doc_ids for x in lists), np.uint32),
+            np.frombuffer(b"".join(x.title_tfs for x in lists), np.uint32),
+            num_docs + 1)
+        return array("I", counts[1:].astype(np.uint32).tobytes())
+
+    counts = array("I", bytes(4 * num_docs))
+    for inverted_list in inverted_lists.values():
+        for doc_id, title_tf in zip(inverted_list.doc_ids,
+                                    inverted_list.title_tfs):
+            counts[doc_id - 1] += title_tf  # doc_id is 1-based.
+    return counts
+
+
+def compute_score_bounds(scores):
+    """
+    Return the maximal score of the given scores of an inverted list,
+    together with a list containing the maximal score of each block of
+    BLOCK_SIZE consecutive scores (see InvertedIndex.get_score_bounds).
+    """
+    block_max_scores = [max(scores[i:i + BLOCK_SIZE])
+                        for i in range(0, len(scores), BLOCK_SIZE)]
+    return max(block_max_scores, default=0), block_max_scores
+
+
+def impact_order(scores, n):
+    """
+    Return the positions of the (at most) n highest non-zero scores of the
+    given scores of an inverted list, sorted by score in descending order
+    (ties are broken by position, that is by doc id), as an array. This is
+    the impact order of the list (see InvertedIndex.impact_top_k).
+
+    >>> list(impact_order([0.5, 2.0, 0.0, 1.0, 2.0], 3))
+    [1, 4, 3]
+    >>> list(impact_order([0.5, 0.0], 3))
+    [0]
+    """
+    if np is not None:
+        scores = np.asarray(scores)
+        positions = np.flatnonzero(scores)
+        if len(positions) > n:
+            # Keep only the positions with at least the n-th highest score.
+            nth_score = np.partition(scores[positions], -n)[-n]
+            positions = positions[scores[positions] >= nth_score]
+        order = np.lexsort((positions, -scores[positions]))[:n]
+        return array("I", positions[order].astype(np.uint32).tobytes())
+    return array("I", heapq.nsmallest(
+        n, filter(scores.__getitem__, range(len(scores))),
+        key=lambda i: -scores[i]))
+
+
+def read_packed_shard(file_name, start, end, analyzer=None, positions=False,
+                      profile=False, fields=False):
+    """
+    Same as read_shard, but return the inverted lists packed by pack_lists,
+    and the report of a profiler (see profiling.py) if profile is True (None
+    otherwise). Used by the worker processes in InvertedIndex.read_from_file,
+    since the packed lists can be sent to the main process much faster.
+    """
+    profiler = Profiler() if profile else None
+    inverted_lists, docs, doc_lengths = read_shard(file_name, start, end,
+                                                   analyzer=analyzer,
+                                                   positions=positions,
+                                                   profiler=profiler,
+                                                   fields=fields)
+    return (pack_lists(inverted_lists), docs, doc_lengths,
+            profiler.report() if profile else None)
+
+
+def pack_lists(inverted_lists):
+    """
+    Pack the given inverted lists (with tf scores) into a tuple (words,
+    lengths, doc_ids, tfs, positions, title_tfs), where words is the list of
+    words, lengths is an array of the lengths of their inverted lists and
+    doc_ids, tfs, positions and title_tfs are the concatenation of the doc
+    ids, the tf scores, the positional postings and the tf scores in the
+    title of all inverted lists (positions and title_tfs are None if the
+    lists have none).
+
+    >>> inverted_lists, _, _ = read_shard("example.tsv", 51)
+    >>> packed = pack_lists(inverted_lists)
+    >>> packed  # doctest: +NORMALIZE_WHITESPACE
+    (['movie', 'short', 'animation', 'animated', 'film'],
+     array('I', [2, 2, 1, 1, 1]), array('I', [1, 2, 1, 2, 1, 2, 2]),
+     array('I', [1, 1, 1, 2, 1, 1, 1]), None, None)
+    >>> unpacked = unpack_lists(*packed)
+    >>> list(zip(unpacked["short"].doc_ids, unpacked["short"].tfs))
+    [(1, 1), (2, 2)]
+    >>> inverted_lists, _, _ = read_shard("example.tsv", 51, positions=True)
+    >>> unpacked = unpack_lists(*pack_lists(inverted_lists))
+    >>> list(unpacked["short"].positions)
+    [1, 1, 3]
+    >>> inverted_lists, _, _ = read_shard("example-fields.tsv", fields=True)
+    >>> unpacked = unpack_lists(*pack_lists(inverted_lists))
+    >>> list(unpacked["short"].title_tfs)
+    [1, 0, 0]
+    """
+    words = list(inverted_lists)
+    lengths = array("I")
+    doc_ids = array("I")
+    tfs = array("I")
+    positions = title_tfs = None
+    if any(x.positions is not None for x in inverted_lists.values()):
+        positions = array("I")
+    if any(x.title_tfs is not None for x in inverted_lists.values()):
+        title_tfs = array("I")
+    for word in words:
+        inverted_list = inverted_lists[word]
+        lengths.append(len(inverted_list))
+        doc_ids.extend(inverted_list.doc_ids)
+        tfs.extend(inverted_list.tfs)
+        if positions is not None:
+            positions.extend(inverted_list.positions)
+        if title_tfs is not None:
+            title_tfs.extend(inverted_list.title_tfs)
+    return words, lengths, doc_ids, tfs, positions, title_tfs
+
+
+def unpack_lists(words, lengths, doc_ids, tfs, positions=None,
+                 title_tfs=None):
+    """
+    Unpack inverted lists packed by pack_lists.
+    """
+    inverted_lists = {}
+    start = 0
+    position_start = 0
+    for word, length in zip(words, lengths):
+        inverted_list = PostingList()
+        inverted_list.doc_ids = doc_ids[start:start + length]
+        inverted_list.tfs = tfs[start:start + length]
+        if title_tfs is not None:
+            inverted_list.title_tfs = title_tfs[start:start + length]
+        if positions is not None:
+            num_positions = sum(inverted_list.tfs)
+            inverted_list.positions = positions[
+                position_start:position_start + num_positions]
+            position_start += num_positions
+        inverted_lists[word] = inverted_list
+        start += length
+    return inverted_lists
+
+
+def split_file(file_name, num_shards):
+    """
+    Split the given file into the given number of byte ranges of about the
+    same size, such that each range starts at the start of a line. Return the
+    ranges as a list of pairs (start, end).
+
+    >>> split_file("example.tsv", 2)
+    [(0, 76), (76, 111)]
+    """
+    size = os.path.getsize(file_name)
+    starts = [0]
+    with open(file_name, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards - 1, starts[-1]))
+            f.readline()
+            starts.append(max(f.tell(), starts[-1]))
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def parse_field_weights(text):
+    """
+    Parse the weights of the fields (see FIELDS), given as comma-separated
+    numbers.
+
+    >>> parse_field_weights("3,1")
+    (3.0, 1.0)
+    >>> parse_field_weights("3")
+    Traceback (most recent call last):
+        ...
+    ValueError: Expected 2 comma-separated field weights, got '3'.
+    """
+    field_weights = tuple(float(x) for x in text.split(","))
+    if len(field_weights) != len(FIELDS) or min(field_weights) < 0:
+        raise ValueError("Expected %d comma-separated field weights, got "
+                         "'%s'." % (len(FIELDS), text))
+    return field_weights
+
+
+def parse_ids(text):
+    """
+    Parse a comma-separated list of doc ids (positive integers).
+
+    >>> parse_ids("17,42")
+    [17, 42]
+    >>> parse_ids("17,0")
+    Traceback (most recent call last):
+        ...
+    ValueError: doc ids must be positive
+    """
+    doc_ids = [int(x) for x in text.split(",")]
+    if min(doc_ids) < 1:
+        raise ValueError("doc ids must be positive")
+    return doc_ids
+
+
+def main(file_name, b, k, file_format, workers, rescore, memory_limit=None,
+         analyzer=None, codec="raw", add_file=None, delete_ids=(),
+         doc_block_size=0, positions=False, profile_file=None,
+         impact_size=None, fields=False, field_weights=None):
+    # The binary index format needs this module, so import it here.
+    from index_format import load_index, write_index
+
+    # Record the phases of building the index, if a profile is requested.
+    profiler = Profiler() if profile_file is not None else NullProfiler()
+
+    if memory_limit is not None:
+        # Build the index with bounded memory (see spimi.build_index). The
+        # buffer gets 3/4 of the memory that is not used yet by this process
+        # (ru_maxrss is in KB on Linux), the rest is left for the memory that
+        # is freed by the runs but not returned to the system.
+        from spimi import build_index
+        used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        buffer_size = (memory_limit * 2**20 - used) * 3 // 4
+        if buffer_size < 2**20:
+            raise ValueError("The memory limit must be larger than %dMB."
+                             % (used // 2**20 + 1))
+        print("Creating index with BM25 scores from file '%s', using at most "
+              "%dMB." % (file_name, memory_limit))
+        new_name = (file_name.replace("input", "output")
+                             .replace(".tsv", "_")) + "precomputed_ii.idx"
+        print("Saving index as '%s'." % new_name)
+        with profiler.phase("build/spimi"):
+            build_index(file_name, new_name + ".tmp", b=b, k=k,
+                        buffer_size=buffer_size, analyzer=analyzer,
+                        codec=codec, doc_block_size=doc_block_size)
+        os.replace(new_name + ".tmp", new_name)
+        write_profile(profiler, profile_file, file_name, new_name)
+        return
+
+    if rescore or add_file is not None or delete_ids:
+        # Update the index in the given file: add and delete docs (see
+        # InvertedIndex.add_documents) and re-compute the BM25 scores.
+        print("Updating the index in file '%s'." % file_name)
+        with profiler.phase("build/load"):
+            ii = load_index(file_name, in_memory=True)
+        ii.profiler = profiler
+        print("The index has BM25 scores with b=%s and k=%s." % (ii.b, ii.k))
+        if add_file is not None:
+            doc_ids = ii.add_documents(read_lines(add_file))
+            print("Added %d documents from file '%s'."
+                  % (len(doc_ids), add_file))
+        if delete_ids:
+            if max(delete_ids) > len(ii.docs):
+                raise ValueError("The index has only %d documents, there is "
+                                 "no document %d." % (len(ii.docs),
+                                                      max(delete_ids)))
+            ii.delete_documents(delete_ids)
+            print("Deleted %d documents." % len(set(delete_ids)))
+        if impact_size is not None:
+            print("Keeping the top-%d postings of each list in impact order."
+                  % impact_size)
+            ii.impact_size = impact_size
+        if rescore:
+            print("Re-computing BM25 scores with b=%s and k=%s." % (b, k))
+        else:
+            b, k = ii.b, ii.k
+        if field_weights is not None:
+            print("Re-computing BM25F scores with field weights %s."
+                  % (field_weights,))
+        if rescore or field_weights is not None:
+            ii.rescore(b=b, k=k, field_weights=field_weights)
+        # Merge the updates and remove the deleted docs (the doc ids of the
+        # following docs change).
+        ii.compact()
+        new_name = os.path.splitext(file_name)[0]
+    else:
+        # Create a new inverted index from the given file.
+        print("Creating index with BM25 scores from file '%s'." % file_name)
+        ii = InvertedIndex()
+        ii.profiler = profiler
+        ii.impact_size = impact_size or 0
+        ii.field_weights = field_weights
+        ii.read_from_file(file_name, b=b, k=k, workers=workers,
+                          analyzer=analyzer, positions=positions,
+                          fields=fields)
+        new_name = (file_name.replace("input", "output")
+                             .replace(".tsv", "_")) + "precomputed_ii"
+
+    # Write to a temporary file first, since a re-scored index may replace the
+    # file it was read from.
+    new_name += ".idx" if file_format == "binary" else ".pkl"
     print("Saving index as '%s'." % new_name)
-    pickle.dump(ii, open(new_name, "wb"))
+    with profiler.phase("build/serialize"):
+        if file_format == "binary":
+            write_index(ii, new_name + ".tmp", codec, doc_block_size)
+        else:
+            pickle.dump(ii, open(new_name + ".tmp", "wb"))
+    os.replace(new_name + ".tmp", new_name)
+    write_profile(profiler, profile_file, file_name, new_name)
+
+
+def write_profile(profiler, profile_file, file_name, index_file):
+    """
+    Write the report of the given profiler of building the index from the
+    given file to the given profile file (see profiling.Profiler.write), and
+    print a summary. Do nothing if the profile file is None.
+    """
+    if profile_file is None:
+        return
+    print("Saving profile as '%s'.\n%s" % (profile_file, profiler.summary()))
+    profiler.write(profile_file, program="inverted_index.py",
+                   doc_file=file_name, index_file=index_file,
+                   index_size=os.path.getsize(index_file))
 
 
 if __name__ == "__main__":
     # Parse the command line arguments.
     parser = argparse.ArgumentParser(description="""Construct the inverted
         index with BM25 scores from the given file. Save the inverted index
-        using pickle.""")
+        in the binary index format (see 'index_format.py') or using
+        pickle.""")
     # Positional arguments
     parser.add_argument("doc_file", type=str, help="""File to read from. The
             expected format of the file is one document per line, in the format
-            <title>TAB<description>.""")
+            <title>TAB<description>. With --rescore, a file containing a
+            precomputed inverted index.""")
     # Optional arguments
     parser.add_argument("-b", "--b", type=float, default=0.75, help="""b value
             for the BM25 scores (default: %(default)s)""")
     parser.add_argument("-k", "--k", type=float, default=1.75, help="""k value
             for the BM25 scores (default: %(default)s)""")
+    parser.add_argument("-f", "--format", type=str, default="binary",
+                        choices=["binary", "pickle"], help="""Format of the
+            saved index. The binary format is memory-mapped when the index is
+            read, which is much faster than unpickling (default:
+            %(default)s)""")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="""Number
+            of processes that read the file in parallel (default:
+            %(default)s)""")
+    parser.add_argument("-r", "--rescore", action="store_true", help="""Do not
+            read documents, but re-compute the BM25 scores of the precomputed
+            inverted index in 'doc_file' with the given b and k, and replace
+            the file (the extension follows the format given by -f)""")
+    parser.add_argument("-m", "--memory-limit", type=int, default=None,
+                        help="""Build the index with at most about this much
+            memory (in MB), for files that are larger than the memory: the
+            inverted lists are written to temporary files in parts, which are
+            merged at the end (only for the binary format, not with -w or
+            -r)""")
+    parser.add_argument("-a", "--add", type=str, default=None,
+                        metavar="FILE", help="""Do not build a new index, but
+            add the documents in FILE (in the same format as 'doc_file') to
+            the precomputed inverted index in 'doc_file', and replace the file
+            (like -r, but the BM25 scores keep the b and k of the index,
+            unless -r is given as well)""")
+    parser.add_argument("-d", "--delete", type=parse_ids, default=(),
+                        metavar="IDS", help="""Do not build a new index, but
+            delete the documents with the given comma-separated ids from the
+            precomputed inverted index in 'doc_file', and replace the file
+            (like -a). The ids of the following documents decrease
+            accordingly""")
+    parser.add_argument("-c", "--codec", type=str, default="raw",
+                        choices=["raw", "varbyte", "bitpack"], help="""Encoding
+            of the posting blocks in the binary format: uncompressed, or
+            compressed with delta-encoded doc ids (see 'compression.py').
+            Compressed indexes are smaller, but slower to query (default:
+            %(default)s)""")
+    parser.add_argument("--doc-block-size", type=int, default=0,
+                        metavar="N", help="""Compress the documents in the
+            binary format in blocks of N documents (with zlib). The index
+            file is smaller, but reading a document decompresses its block
+            (0: no compression, default: %(default)s)""")
+    parser.add_argument("--positions", action="store_true", help="""Store
+            the positions of the words in the documents, for faster phrase
+            queries (only for the pickle format, in the binary format phrase
+            queries read the documents instead)""")
+    parser.add_argument("--impact-size", type=int, default=None,
+                        metavar="N", help="""Also store the N postings with
+            the highest scores of each inverted list with more than N
+            postings, in score order (4 bytes per posting). Top-k queries
+            with k <= N read these first and stop early when no other doc
+            can make it into the top-k, which is much faster for queries with
+            one or few frequent keywords. With --rescore, --add or --delete,
+            the impact orders are recomputed with the new N (0: none,
+            default: 0, or the N of the index)""")
+    parser.add_argument("--fields", action="store_true", help="""Index the
+            title and the description of the documents as separate fields,
+            with BM25F scores, so that matches in the title can be weighted
+            higher (see --field-weights). The weights can also be changed at
+            query time, without building the index again (see 'evaluate.py'
+            and 'query.py'). Not with --memory-limit or a compressed
+            codec""")
+    parser.add_argument("--field-weights", type=parse_field_weights,
+                        default=None, metavar="T,D", help="""Weights of the
+            title and the description in the BM25F scores, for an index with
+            fields. With --rescore, --add or --delete, the scores of the
+            index are re-computed with these weights (default: 2,1, or the
+            weights of the index)""")
+    parser.add_argument("--profile", type=str, default=None,
+                        metavar="FILE", help="""Write the time of each phase
+            of building the index (tokenizing, building the inverted lists,
+            computing the BM25 scores and saving the index) and the number
+            of documents, terms and postings to FILE, as JSON""")
+    parser.add_argument("--stopwords", action="store_true", help="""Remove
+            frequent English words (see analyzer.py) from the docs and from
+            the queries""")
+    parser.add_argument("--stemming", action="store_true", help="""Reduce the
+            words of the docs and of the queries to their stems (see
+            analyzer.py)""")
     args = parser.parse_args()
-    main(args.doc_file, args.b, args.k)
+    update = args.rescore or args.add is not None or args.delete
+    if args.memory_limit is not None and (args.format != "binary"
+                                          or args.workers > 1 or update):
+        parser.error("--memory-limit can only be used with the binary "
+                     "format and without --workers, --rescore, --add or "
+                     "--delete")
+    if args.impact_size is not None and args.impact_size < 0:
+        parser.error("--impact-size must not be negative")
+    if args.memory_limit is not None and args.impact_size:
+        parser.error("--impact-size cannot be used with --memory-limit")
+    if update and (args.stopwords or args.stemming):
+        parser.error("--stopwords and --stemming cannot be used with "
+                     "--rescore, --add or --delete, the index has to be built "
+                     "again")
+    if args.codec != "raw" and args.format != "binary":
+        parser.error("--codec can only be used with the binary format")
+    if args.doc_block_size and args.format != "binary":
+        parser.error("--doc-block-size can only be used with the binary "
+                     "format")
+    if args.fields and (args.memory_limit is not None or update
+                        or args.codec != "raw"):
+        parser.error("--fields cannot be used with --memory-limit, --rescore, "
+                     "--add, --delete or a compressed codec")
+    if args.field_weights is not None and not (args.fields or update):
+        parser.error("--field-weights can only be used with --fields, "
+                     "--rescore, --add or --delete")
+    if args.positions and (args.format != "pickle" or update):
+        parser.error("--positions can only be used with the pickle format "
+                     "and without --rescore, --add or --delete")
+    try:
+        main(args.doc_file, args.b, args.k, args.format, args.workers,
+             args.rescore, args.memory_limit,
+             Analyzer(stopwords=args.stopwords, stemming=args.stemming),
+             args.codec, args.add, args.delete, args.doc_block_size,
+             args.positions, args.profile, args.impact_size, args.fields,
+             args.field_weights)
+    except ValueError as e:
+        # An index file that cannot be read or updated as requested.
+        parser.error(str(e))
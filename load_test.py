@@ -0,0 +1,136 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import time
+import random
+import argparse
+import http.client
+import multiprocessing
+from urllib.parse import urlencode
+
+
+def read_query_texts(file_name):
+    """
+    Read the queries from the given file, one per line, optionally followed
+    by a TAB and anything else (like benchmark.read_queries, but the queries
+    are returned as texts, since the server splits them into keywords).
+
+    >>> read_query_texts("example-benchmark.tsv")
+    ['animated film', 'short film']
+    """
+    with open(file_name, "r", encoding="utf-8") as f:
+        queries = [line.split("\t")[0].strip() for line in f]
+    return [x for x in queries if x]
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile (0 <= p <= 100) of the given values, by the
+    nearest-rank method.
+
+    >>> values = [5, 1, 4, 2, 3, 10, 6, 7, 9, 8]
+    >>> percentile(values, 50), percentile(values, 99), percentile(values, 0)
+    (5, 10, 1)
+    """
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))  # ceil(n * p / 100)
+    return values[int(rank) - 1]
+
+
+def run_client(host, port, queries, num_requests, k, seed, mode="or"):
+    """
+    Send the given number of search requests for random queries of the given
+    list (in the given query mode) to the search server at the given
+    address, one after the other over one connection. Return the latency of
+    each request (in seconds) and the number of failed requests.
+    """
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection(host, port)
+    latencies = []
+    errors = 0
+    for _ in range(num_requests):
+        path = "/search?" + urlencode({"q": rng.choice(queries), "k": k,
+                                       "mode": mode})
+        start = time.perf_counter()
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port)
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    return latencies, errors
+
+
+def load_test(host, port, queries, clients, num_requests, k, mode="or"):
+    """
+    Run the given number of concurrent clients (each in its own process, see
+    run_client), each sending the given number of requests. Return the
+    latencies of all requests, the number of failed requests and the total
+    time (in seconds).
+    """
+    with multiprocessing.Pool(clients) as pool:
+        start = time.perf_counter()
+        results = pool.starmap(run_client, [
+            (host, port, queries, num_requests, k, seed, mode)
+            for seed in range(clients)])
+        total_time = time.perf_counter() - start
+    latencies = [x for client_latencies, _ in results
+                 for x in client_latencies]
+    errors = sum(client_errors for _, client_errors in results)
+    return latencies, errors, total_time
+
+
+def main(query_file, host, port, clients, num_requests, k, mode="or"):
+    print("Reading queries from file '%s'." % query_file)
+    queries = read_query_texts(query_file)
+
+    # Warm up the server (and its caches), then measure.
+    run_client(host, port, queries, min(len(queries), 100), k, -1, mode)
+    print("Sending %d requests from each of %d concurrent clients to "
+          "'http://%s:%d/search'.\n" % (num_requests, clients, host, port))
+    latencies, errors, total_time = load_test(host, port, queries, clients,
+                                              num_requests, k, mode)
+    print("%-10s %10d" % ("requests", len(latencies)))
+    print("%-10s %10d" % ("errors", errors))
+    print("%-10s %10.1f" % ("QPS", len(latencies) / total_time))
+    for p in [50, 90, 99]:
+        print("%-10s %8.2fms" % ("p%d" % p, 1000 * percentile(latencies, p)))
+    print("%-10s %8.2fms" % ("max", 1000 * max(latencies)))
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Load test for the search
+            API of 'search_server.py': send requests for random queries from
+            concurrent clients and report the latency percentiles and the
+            throughput (queries per second).""")
+    parser.add_argument("query_file", type=str, help="""File containing the
+            queries, one per line. A benchmark file as used by 'evaluate.py'
+            can be used as well.""")
+    parser.add_argument("--host", type=str, default="localhost",
+                        help="""Address of the server (default:
+            %(default)s)""")
+    parser.add_argument("-p", "--port", type=int, default=5000, help="""Port
+            of the server (default: %(default)s)""")
+    parser.add_argument("-c", "--clients", type=int, default=8, help="""Number
+            of concurrent clients (default: %(default)s)""")
+    parser.add_argument("-n", "--requests", type=int, default=500,
+                        help="""Number of requests per client (default:
+            %(default)s)""")
+    parser.add_argument("-k", "--k", type=int, default=10, help="""Number of
+            results per request (default: %(default)s)""")
+    parser.add_argument("-m", "--mode", type=str, default="or",
+                        choices=["or", "and", "phrase"], help="""Query mode
+            of the requests (default: %(default)s)""")
+    args = parser.parse_args()
+    main(args.query_file, args.host, args.port, args.clients, args.requests,
+         args.k, args.mode)
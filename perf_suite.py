@@ -0,0 +1,333 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from itertools import accumulate
+
+from inverted_index import InvertedIndex, np
+from index_format import load_index, write_index
+from benchmark import random_queries, time_queries
+from load_test import percentile
+
+
+# The number of docs of the synthetic corpora (see make_corpus).
+DEFAULT_SIZES = [10000, 30000, 100000]
+# The number of distinct words of a corpus of 10000 docs (the vocabulary
+# grows with the square root of the number of docs, by Heaps' law).
+VOCABULARY_SIZE = 20000
+# The number of queries per number of keywords (see measure_queries).
+NUM_QUERIES = 100
+# The maximal relative increase of each measure before it is a regression
+# (see compare). The index size only depends on the code, the times also
+# on the machine and its load.
+TOLERANCES = {"build_s": 0.25, "index_mb": 0.01, "load_ms": 0.5,
+              "p50_ms": 0.25, "p90_ms": 0.25, "p99_ms": 0.5}
+# Times below this (in milliseconds) are too small to compare.
+MIN_COMPARED_MS = 0.05
+
+
+def make_word(i):
+    """
+    Return the i-th word of the synthetic vocabulary (a pronounceable word of
+    letters only, so the analyzer keeps it as it is).
+
+    >>> [make_word(i) for i in [0, 1, 5, 94, 95]]
+    ['ba', 'be', 'ca', 'zu', 'baba']
+    """
+    consonants = "bcdfghjklmnprstvwxz"
+    vowels = "aeiou"
+    syllables = []
+    while True:
+        i, syllable = divmod(i, len(consonants) * len(vowels))
+        syllables.append(consonants[syllable // len(vowels)]
+                         + vowels[syllable % len(vowels)])
+        if i == 0:
+            return "".join(reversed(syllables))
+        i -= 1
+
+
+def make_corpus(num_docs, vocabulary_size=None, seed=0, exponent=1.0):
+    """
+    Generate a synthetic corpus with the given number of docs, in the format
+    of the input files of 'inverted_index.py': one doc per line, as
+    <title>TAB<description>. The words are drawn from a vocabulary of the
+    given size (by default, growing with the square root of num_docs, see
+    VOCABULARY_SIZE) with Zipf-distributed frequencies (the frequency of the
+    r-th word is proportional to 1 / r^exponent), like the words of natural
+    text. The titles have 1 to 6 words, the descriptions 10 to 150 words.
+    The corpus only depends on the arguments, so it is the same on each
+    machine. Return the lines (without newline).
+
+    >>> lines = make_corpus(3, 100)
+    >>> lines == make_corpus(3, 100), len(lines)
+    (True, 3)
+    >>> [len(line.split("\\t")) for line in lines]
+    [2, 2, 2]
+    """
+    if vocabulary_size is None:
+        vocabulary_size = int(VOCABULARY_SIZE * (num_docs / 10000) ** 0.5)
+    rng = random.Random(seed)
+    words = [make_word(i) for i in range(vocabulary_size)]
+    cum_weights = list(accumulate(1 / r ** exponent
+                                  for r in range(1, vocabulary_size + 1)))
+    lines = []
+    for _ in range(num_docs):
+        title = rng.choices(words, cum_weights=cum_weights,
+                            k=rng.randint(1, 6))
+        description = rng.choices(words, cum_weights=cum_weights,
+                                  k=rng.randint(10, 150))
+        lines.append(" ".join(title).capitalize() + "\t"
+                     + " ".join(description).capitalize() + ".")
+    return lines
+
+
+def write_corpus(file_name, lines):
+    """
+    Write the given lines (see make_corpus) to the given file.
+    """
+    with open(file_name, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line + "\n")
+
+
+def measure_queries(ii, queries, k=10, mode="or"):
+    """
+    Process the given queries with the given index (see
+    benchmark.time_queries, the time of each query is the fastest of three
+    runs) and return the 50th, 90th and 99th percentile of the times, in
+    milliseconds.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> sorted(measure_queries(ii, [["short", "film"], ["movie"]]))
+    ['p50_ms', 'p90_ms', 'p99_ms']
+    """
+    _, times = time_queries(ii, queries, k=k, mode=mode)
+    return {"p%d_ms" % p: round(1000 * percentile(times, p), 4)
+            for p in (50, 90, 99)}
+
+
+def run_size(doc_file, index_file, num_queries=NUM_QUERIES, seed=0):
+    """
+    Build the index of the given doc file (with a single process) and write
+    it to the given index file in the binary index format. Load the index
+    again and process random queries on it (see benchmark.random_queries):
+    single-word queries and queries with 2 to 4 words (in mode "or" with
+    k=10). Return a dictionary with the build time (reading the doc file and
+    writing the index, in seconds), the index size (in MB), the load time (in
+    milliseconds) and the percentiles of the query times (see
+    measure_queries) per kind of query.
+
+    >>> import tempfile
+    >>> index_file = os.path.join(tempfile.mkdtemp(), "example.idx")
+    >>> result = run_size("example.tsv", index_file, num_queries=2)
+    >>> sorted(result)
+    ['build_s', 'index_mb', 'load_ms', 'multi', 'single']
+    >>> sorted(result["multi"])
+    ['p50_ms', 'p90_ms', 'p99_ms']
+    """
+    start = time.perf_counter()
+    ii = InvertedIndex()
+    ii.read_from_file(doc_file, verbose=False)
+    write_index(ii, index_file)
+    build_time = time.perf_counter() - start
+    queries = random_queries(ii, 4, num_queries, seed=seed)
+    del ii
+
+    start = time.perf_counter()
+    ii = load_index(index_file)
+    load_time = time.perf_counter() - start
+    return {"build_s": round(build_time, 4),
+            "index_mb": round(os.path.getsize(index_file) / 2**20, 4),
+            "load_ms": round(1000 * load_time, 4),
+            "single": measure_queries(ii, queries[0]),
+            "multi": measure_queries(ii, sum(queries[1:], []))}
+
+
+def flatten(result, prefix=""):
+    """
+    Return the measures of the given result of run_size (with nested
+    dictionaries) as a flat dictionary.
+
+    >>> flatten({"build_s": 1.5, "single": {"p50_ms": 0.1}})
+    {'build_s': 1.5, 'single/p50_ms': 0.1}
+    """
+    measures = {}
+    for name, value in result.items():
+        if isinstance(value, dict):
+            measures.update(flatten(value, prefix + name + "/"))
+        else:
+            measures[prefix + name] = value
+    return measures
+
+
+def compare(results, baseline, scale=1.0):
+    """
+    Compare the given results with the given baseline (both as returned by
+    run_suite). Return the list of regressions as tuples (corpus size,
+    measure, baseline value, new value): the measures that increased by
+    more than their tolerance (see TOLERANCES, the tolerances of the times
+    are multiplied by the given scale). Measures of sizes that are not in
+    both are not compared.
+
+    >>> baseline = {"sizes": {"1000": {"build_s": 1.0, "index_mb": 2.0,
+    ...                                "single": {"p50_ms": 0.5}}}}
+    >>> results = {"sizes": {"1000": {"build_s": 1.2, "index_mb": 2.1,
+    ...                               "single": {"p50_ms": 1.0}}}}
+    >>> compare(results, baseline)
+    [('1000', 'index_mb', 2.0, 2.1), ('1000', 'single/p50_ms', 0.5, 1.0)]
+    >>> compare(results, baseline, scale=4)
+    [('1000', 'index_mb', 2.0, 2.1)]
+    """
+    regressions = []
+    for size, result in results["sizes"].items():
+        if size not in baseline["sizes"]:
+            continue
+        old_measures = flatten(baseline["sizes"][size])
+        for name, value in flatten(result).items():
+            old = old_measures.get(name)
+            if old is None:
+                continue
+            unit = name.rsplit("_", 1)[1]
+            tolerance = TOLERANCES[name.split("/")[-1]]
+            if unit != "mb":
+                tolerance *= scale
+            if unit == "ms" and value < MIN_COMPARED_MS:
+                continue
+            if value > old * (1 + tolerance):
+                regressions.append((size, name, old, value))
+    return regressions
+
+
+def environment():
+    """
+    Return a description of the machine and the Python version, which is
+    stored with the results, since the times are only comparable on the same
+    machine.
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__ if np is not None else None,
+            "machine": platform.machine(),
+            "system": platform.system(),
+            "cpus": os.cpu_count()}
+
+
+def run_suite(sizes, num_queries=NUM_QUERIES, seed=0, corpus_dir=None):
+    """
+    Generate a synthetic corpus (see make_corpus) for each of the given
+    sizes, and measure building, loading and querying its index (see
+    run_size). The corpora and the indexes are written to the given
+    directory (by default, a temporary directory, which is removed
+    afterwards). Return the results as a dictionary, which can be written as
+    JSON: the environment, the seed and the measures per size.
+    """
+    results = {"environment": environment(), "seed": seed, "sizes": {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = corpus_dir or temp_dir
+        for size in sizes:
+            doc_file = os.path.join(directory, "zipf-%d.tsv" % size)
+            index_file = os.path.join(directory, "zipf-%d.idx" % size)
+            print("Generating a corpus with %d docs..." % size)
+            write_corpus(doc_file, make_corpus(size, seed=seed))
+            print("Building, loading and querying its index...")
+            result = run_size(doc_file, index_file, num_queries, seed)
+            results["sizes"][str(size)] = result
+            print_result(size, result)
+    return results
+
+
+def print_result(size, result):
+    """
+    Print the given result of run_size for a corpus of the given size.
+    """
+    print("%8d docs: build %.2fs, index %.1fMB, load %.2fms"
+          % (size, result["build_s"], result["index_mb"], result["load_ms"]))
+    for kind in ["single", "multi"]:
+        print("%14s queries: p50 %.3fms, p90 %.3fms, p99 %.3fms"
+              % (kind, result[kind]["p50_ms"], result[kind]["p90_ms"],
+                 result[kind]["p99_ms"]))
+
+
+def main(sizes, output_file, baseline_file, save_baseline, num_queries,
+         seed, scale, corpus_dir=None):
+    results = run_suite(sizes, num_queries, seed, corpus_dir)
+    print("Saving results as '%s'." % output_file)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+    if save_baseline:
+        print("Saving results as baseline '%s'." % baseline_file)
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        return
+    if not os.path.exists(baseline_file):
+        print("No baseline '%s' to compare with (create it with "
+              "--save-baseline)." % baseline_file)
+        return
+
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["environment"] != results["environment"]:
+        print("WARNING: The baseline was measured in another environment "
+              "(%s), the times may not be comparable."
+              % baseline["environment"])
+    if baseline["seed"] != seed:
+        print("WARNING: The baseline was measured with seed %d."
+              % baseline["seed"])
+    regressions = compare(results, baseline, scale)
+    if not regressions:
+        print("No regressions compared to baseline '%s'." % baseline_file)
+        return
+    print("Regressions compared to baseline '%s':" % baseline_file)
+    for size, name, old, new in regressions:
+        print("%8s docs: %-14s %10.4f -> %10.4f (%+.0f%%)"
+              % (size, name, old, new, 100 * (new / old - 1)))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Measure the performance
+            of building, loading and querying inverted indexes of synthetic
+            corpora with Zipf-distributed words, save the results as JSON and
+            compare them with a baseline. Exits with status 1 if a measure
+            got worse than the baseline by more than its tolerance.""")
+    parser.add_argument("-s", "--sizes", type=str,
+                        default=",".join(map(str, DEFAULT_SIZES)),
+                        help="""Comma-separated numbers of docs of the
+            corpora (default: %(default)s)""")
+    parser.add_argument("-o", "--output", type=str,
+                        default="output/bench-results.json", help="""File to
+            save the results in (default: %(default)s)""")
+    parser.add_argument("-b", "--baseline", type=str,
+                        default="output/bench-baseline.json", help="""File
+            with the results to compare with (default: %(default)s)""")
+    parser.add_argument("--save-baseline", action="store_true", help="""Save
+            the results as the new baseline instead of comparing with it""")
+    parser.add_argument("-n", "--num-queries", type=int, default=NUM_QUERIES,
+                        help="""Number of random queries per number of
+            keywords (default: %(default)s)""")
+    parser.add_argument("--seed", type=int, default=0, help="""Seed of the
+            corpora and the queries (default: %(default)s)""")
+    parser.add_argument("-t", "--tolerance-scale", type=float, default=1.0,
+                        help="""Factor for the tolerances of the times, for
+            example 2 on a noisy machine (default: %(default)s)""")
+    parser.add_argument("--keep-corpora", type=str, default=None,
+                        metavar="DIR", help="""Write the corpora and their
+            indexes to DIR and keep them""")
+    args = parser.parse_args()
+    main([int(x) for x in args.sizes.split(",")], args.output, args.baseline,
+         args.save_baseline, args.num_queries, args.seed,
+         args.tolerance_scale, args.keep_corpora)
@@ -0,0 +1,202 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class NullProfiler:
+    """
+    A profiler that does not record anything, used when profiling is off
+    (see InvertedIndex.profiler). Its methods do (almost) nothing: phase
+    returns a shared empty context manager and timed returns the function
+    itself, so the instrumented code runs at full speed.
+
+    >>> profiler = NullProfiler()
+    >>> with profiler.phase("query/merge"):
+    ...     profiler.count("query/postings", 3)
+    >>> profiler.timed("build/tokenize", len) is len, profiler.enabled
+    (True, False)
+    """
+
+    enabled = False
+    NULL_CONTEXT = nullcontext()
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+    def phase(self, name):
+        return self.NULL_CONTEXT
+
+    def timed(self, name, function):
+        return function
+
+    def count(self, name, n=1):
+        pass
+
+
+class Profiler(NullProfiler):
+    """
+    Records the time spent in named phases, counters and the timings of
+    single queries, for a machine-readable report (see report and write).
+    The names of the phases and counters are of form <stage>/<name>, like
+    "build/tokenize" or "query/merge". Phases may be nested, the time of a
+    phase includes the time of the phases within it.
+
+    >>> profiler = Profiler()
+    >>> with profiler.phase("build/read"):
+    ...     words = profiler.timed("build/tokenize", str.split)("a b c")
+    ...     profiler.count("build/terms", len(words))
+    >>> report = profiler.report()
+    >>> sorted(report["phases"]), report["phases"]["build/read"]["calls"]
+    (['build/read', 'build/tokenize'], 1)
+    >>> report["counters"], report["queries"]
+    ({'build/terms': 3}, [])
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.seconds = {}  # The total time of each phase.
+        self.calls = {}  # The number of times each phase was entered.
+        self.counters = {}
+        self.queries = []  # The timing of each query, see profile_query.
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Add the given time (and number of calls) to the phase with the given
+        name.
+        """
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Return a context manager that adds the time spent in it to the phase
+        with the given name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, name, function):
+        """
+        Return a wrapper of the given function that adds the time of each
+        call to the phase with the given name. Used for functions that are
+        called in a loop, like the analyzer for each doc.
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+        return wrapper
+
+    def count(self, name, n=1):
+        """
+        Add n to the counter with the given name.
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def profile_query(self, process, keywords, k, mode):
+        """
+        Process the query with the given keywords, k and mode by the given
+        function (see InvertedIndex.process_query), as phase "query/total".
+        Record the time of the query, the number of postings of the inverted
+        lists of its keywords (the counter "query/postings") and the number
+        of results. Return the result.
+
+        >>> profiler = Profiler()
+        >>> def process(keywords, k, mode):
+        ...     profiler.count("query/postings", 5)
+        ...     return [(1, 0.5)]
+        >>> profiler.profile_query(process, ["film"], 3, "or")
+        [(1, 0.5)]
+        >>> entry = profiler.queries[0]
+        >>> entry["keywords"], entry["postings"], entry["results"]
+        (['film'], 5, 1)
+        """
+        postings = self.counters.get("query/postings", 0)
+        start = time.perf_counter()
+        with self.phase("query/total"):
+            result = process(keywords, k, mode)
+        self.count("query/queries")
+        self.queries.append({
+            "keywords": list(keywords),
+            "k": k,
+            "mode": mode,
+            "ms": round(1000 * (time.perf_counter() - start), 4),
+            "postings": self.counters.get("query/postings", 0) - postings,
+            "results": len(result)})
+        return result
+
+    def merge(self, report):
+        """
+        Add the phases, counters and queries of the given report (of another
+        profiler, for example in a worker process) to this profiler.
+
+        >>> profiler = Profiler()
+        >>> profiler.count("build/docs", 2)
+        >>> other = Profiler()
+        >>> other.count("build/docs", 3)
+        >>> other.add_time("build/tokenize", 0.5)
+        >>> profiler.merge(other.report())
+        >>> profiler.counters, profiler.calls
+        ({'build/docs': 5}, {'build/tokenize': 1})
+        """
+        for name, phase in report["phases"].items():
+            self.add_time(name, phase["seconds"], phase["calls"])
+        for name, n in report["counters"].items():
+            self.count(name, n)
+        self.queries.extend(report["queries"])
+
+    def report(self):
+        """
+        Return the recorded data as a dictionary, which can be written as
+        JSON: the phases (each with the total time in seconds and the number
+        of calls), the counters and the queries.
+        """
+        return {"phases": {name: {"seconds": round(self.seconds[name], 6),
+                                  "calls": self.calls[name]}
+                           for name in self.seconds},
+                "counters": dict(self.counters),
+                "queries": list(self.queries)}
+
+    def pop_report(self):
+        """
+        Return the report (see report) and clear the recorded data.
+        """
+        report = self.report()
+        self.__init__()
+        return report
+
+    def write(self, file_name, **info):
+        """
+        Write the report (see report) to the given file as JSON, together
+        with the given information (like the program and its arguments).
+        """
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump({**info, **self.report()}, f, indent=2)
+            f.write("\n")
+
+    def summary(self):
+        """
+        Return a summary of the phases as a string, one line per phase, with
+        its total time and number of calls.
+
+        >>> profiler = Profiler()
+        >>> profiler.add_time("query/merge", 0.25, 100)
+        >>> print(profiler.summary())
+        query/merge                   250.00ms      100 calls
+        """
+        return "\n".join("%-25s %10.2fms %8d calls"
+                         % (name, 1000 * self.seconds[name], self.calls[name])
+                         for name in self.seconds)
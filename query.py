@@ -7,51 +7,181 @@ Theresa Klumpp <klumppt@cs.uni-freiburg.de>
 """
 
 import re
-import readline  # NOQA
+import sys
 import argparse
-import pickle
-from inverted_index import InvertedIndex  # NOQA
+from inverted_index import MODES, parse_field_weights
+from index_format import load_index
+from query_cache import QueryCache
+from benchmark import read_queries
+from profiling import Profiler
 
 
-def main(precomputed_file):
-    # Create a new inverted index from the given file.
-    print("Reading from file '%s'." % precomputed_file)
-    ii = pickle.load(open(precomputed_file, "rb"))
+def main(precomputed_file, cache_size, warm_up_file, mode="or",
+         profile_file=None, batch_format=None, k=3, field_weights=None,
+         fuzzy=False):
+    # Create a new inverted index from the given file. In batch mode, the
+    # messages go to stderr, so that stdout only has the results.
+    log = sys.stderr if batch_format is not None else sys.stdout
+    print("Reading from file '%s'." % precomputed_file, file=log)
+    ii = load_index(precomputed_file)
+    if profile_file is not None:
+        # Record the phases of each query (see profiling.py).
+        ii.profiler = Profiler()
+    if field_weights is not None:
+        # Score the keywords with these weights instead of the weights of
+        # the index (see InvertedIndex.set_query_field_weights).
+        ii.set_query_field_weights(field_weights)
+
+    if batch_format is not None:
+        # Answer the queries from stdin, one per line, like query_client.py
+        # does with a daemon (see query_daemon.py).
+        from search_server import SearchService
+        from query_client import write_responses
+        service = SearchService(ii, cache_size, fuzzy)
+        if warm_up_file is not None:
+            service.cache.warm_up(read_queries(warm_up_file, ii.analyzer), k,
+                                  mode)
+
+        def responses():
+            for line in sys.stdin:
+                query = line.split("\t")[0].strip()
+                try:
+                    yield service.search(query, k, mode)
+                except ValueError as e:
+                    # Like the daemon, for example for a prefix keyword in a
+                    # phrase query.
+                    yield {"query": query, "error": str(e)}
+
+        write_responses(responses(), batch_format)
+        if profile_file is not None:
+            print("Saving profile as '%s'." % profile_file, file=log)
+            ii.profiler.write(profile_file, program="query.py",
+                              index_file=precomputed_file,
+                              cache=service.cache.stats())
+        return
+
+    # Edit the queries with the arrow keys (only needed interactively).
+    import readline  # NOQA
+
+    # Cache the results of repeated queries.
+    cache = QueryCache(ii, max_entries=cache_size)
+    if warm_up_file is not None:
+        print("Warming up the cache with the queries from file '%s'."
+              % warm_up_file)
+        cache.warm_up(read_queries(warm_up_file, ii.analyzer), k, mode)
 
     print("Query the inverted index to find the most relevant hits. Enter any "
           "amount of keywords. Type 'num_res=<n>' to change the number of "
-          "results presented to you. Use ctrl+d to leave the program.")
-    k = 3  # number of results shown
+          "results presented to you. Type 'mode=<or|and|phrase>' to change "
+          "the query mode (docs with any keyword, docs with all keywords, or "
+          "docs with the keywords in the given order), currently '%s'. Type "
+          "'weights=<title>,<description>' to change the field weights (for "
+          "an index with fields). Type 'cache' to see the statistics of the "
+          "query cache. End a keyword with '*' to search for all words with "
+          "this prefix, or with '~' to search for all words within a small "
+          "edit distance ('~1' or '~2' for a given distance). Use ctrl+d to "
+          "leave the program." % mode)
     while True:
         try:
             # Ask the user for a keyword query.
             query = input("\nYour keyword query: ")
         except (KeyboardInterrupt, EOFError):
-            print("\nBye!")
+            print("\nQuery cache: %s." % cache.stats())
+            if profile_file is not None:
+                print("Saving profile as '%s'.\n%s"
+                      % (profile_file, ii.profiler.summary()))
+                ii.profiler.write(profile_file, program="query.py",
+                                  index_file=precomputed_file,
+                                  cache=cache.stats())
+            print("Bye!")
             break
 
+        if query == "cache":
+            print("Query cache: %s." % cache.stats())
+            continue
+
         m = re.match(r"num_res=([0-9]+)$", query)
         if m:
             k = int(m.group(1))
             print(f"Changed the number of results shown to {k}.")
             continue
-        # Split the query into keywords.
-        keywords = [x.lower().strip() for x in re.split("[^A-Za-z]+", query)]
 
-        # Process the keywords.
-        postings = ii.process_query(keywords)
+        m = re.match(r"mode=(%s)$" % "|".join(MODES), query)
+        if m:
+            mode = m.group(1)
+            print(f"Changed the query mode to '{mode}'.")
+            continue
+
+        m = re.match(r"weights=(.*)$", query)
+        if m:
+            try:
+                ii.set_query_field_weights(parse_field_weights(m.group(1)))
+            except ValueError as e:
+                print(e)
+                continue
+            print(f"Changed the field weights to {ii.query_field_weights}.")
+            continue
+        # Split the query into keywords, like the docs of the index, and
+        # expand the prefix and fuzzy keywords.
+        keywords = ii.analyze_query(query, fuzzy and mode != "phrase")
+
+        # Process the keywords (only the top-k are shown).
+        try:
+            postings = cache.process_query(keywords, k, mode)
+        except ValueError as e:
+            print(e)
+            continue
 
         # Render the output (with ANSI codes to highlight the keywords).
-        ii.render_output(postings, keywords, k)
+        with ii.profiler.phase("query/render"):
+            ii.render_output(postings, keywords, k)
 
 
 if __name__ == "__main__":
     # Parse the command line arguments.
     parser = argparse.ArgumentParser(description="""Query a precomputed
         inverted index to find the most relavent hits.""")
-    parser.add_argument("precomputed_file", type=str, help="""Pickle file
-        containing a precomputed inverted index. To generate such a file,
-        use 'inverted_index.py'.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+        containing a precomputed inverted index, in the binary index format or
+        as pickle. To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("-c", "--cache-size", type=int, default=1000,
+                        help="""Maximal number of query results kept in the
+        cache, the least recently used results are evicted first (default:
+        %(default)s)""")
+    parser.add_argument("--warm-up", type=str, default=None, help="""File with
+        queries whose results are put into the cache at the start, one query
+        per line, like a query log or the benchmark file used by
+        'evaluate.py'""")
+    parser.add_argument("-m", "--mode", type=str, default="or", choices=MODES,
+                        help="""Query mode: the docs that contain any of the
+        keywords, all keywords, or the keywords as a phrase, in the given
+        order. Can be changed with 'mode=<mode>' (default: %(default)s)""")
+    parser.add_argument("--profile", type=str, default=None, metavar="FILE",
+                        help="""At the end, write the timings of the queries
+        (the time of each query and of its phases: fetching the inverted
+        lists, merging them, filtering, sorting and rendering the results)
+        and the number of postings touched to FILE, as JSON. Queries answered
+        from the cache are not processed, so they are not included""")
+    parser.add_argument("--batch", type=str, default=None,
+                        choices=["tsv", "json"], help="""Do not prompt, but
+        read the queries from stdin, one per line, and write the results to
+        stdout, as TSV or JSON (like 'query_client.py')""")
+    parser.add_argument("-k", "--num-results", type=int, default=3,
+                        help="""Number of results per query (default:
+        %(default)s)""")
+    parser.add_argument("--field-weights", type=parse_field_weights,
+                        default=None, metavar="T,D", help="""Weights of the
+        title and the description in the BM25F scores of the queries, instead
+        of the weights of the index (only for an index with fields, see
+        'inverted_index.py --fields'). The scores of the keywords are then
+        computed for each query, which is slower for frequent keywords. Can
+        be changed with 'weights=<title>,<description>'""")
+    parser.add_argument("--fuzzy", action="store_true", help="""Expand the
+        keywords that are not in the index to the terms within a small edit
+        distance, like fuzzy keywords (<word>~), to find the docs for
+        misspelled keywords""")
     args = parser.parse_args()
 
-    main(args.precomputed_file)
+    main(args.precomputed_file, args.cache_size, args.warm_up, args.mode,
+         args.profile, args.batch, args.num_results, args.field_weights,
+         args.fuzzy)
@@ -0,0 +1,219 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import threading
+from collections import OrderedDict
+
+from inverted_index import InvertedIndex, PostingList  # NOQA
+
+
+class QueryCache:
+    """
+    A cache for the results of InvertedIndex.process_query, with LRU
+    eviction. The results are cached by the query mode, the normalized
+    keywords (see normalize) and k. The cache holds at most max_entries
+    results with at most max_postings postings in total, the least recently
+    used results are evicted first. When the index changes (see
+    InvertedIndex.version), the cache is cleared. The cache can be used by
+    several threads, like the threads of the search server (see
+    search_server.py): looking up, inserting and evicting results holds a
+    lock, processing a query does not.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", b=0.75, k=1.75, verbose=False)
+    >>> cache = QueryCache(ii, max_entries=2)
+    >>> result = cache.process_query(["short", "film"], 1)
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '2.176')]
+    >>> cache.process_query(["film", "short", "foo"], 1) is result
+    True
+    >>> cache.hits, cache.misses, len(cache)
+    (1, 1, 1)
+    >>> _ = cache.process_query(["animated"], 3)
+    >>> _ = cache.process_query(["movie"], 3)
+    >>> _ = cache.process_query(["short", "film"], 1)
+    >>> cache.hits, cache.misses, len(cache)
+    (1, 4, 2)
+
+    Re-computing the scores clears the cache.
+
+    >>> ii.rescore(b=0, k=float("inf"))
+    >>> result = cache.process_query(["short", "film"], 1)
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '3.000')]
+    >>> cache.hits, cache.misses, len(cache)
+    (1, 5, 1)
+
+    In the mode "phrase", the order of the keywords matters.
+
+    >>> result = cache.process_query(["short", "film"], 1, mode="phrase")
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '3.000')]
+    >>> cache.process_query(["film", "short"], 1, mode="phrase")
+    []
+
+    Several threads can use the cache at once.
+
+    >>> cache = QueryCache(ii, max_entries=2)
+    >>> queries = [["short"], ["film"], ["animated"], ["movie", "short"]]
+    >>> threads = [threading.Thread(target=lambda: [
+    ...     cache.process_query(x, 3) for _ in range(200) for x in queries])
+    ...     for _ in range(8)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> len(cache), cache.hits + cache.misses
+    (2, 6400)
+    >>> cache.num_postings == sum(map(len, cache.results.values()))
+    True
+    """
+
+    def __init__(self, ii, max_entries=1000, max_postings=1000000):
+        """
+        Creates an empty cache for the given inverted index.
+        """
+        self.ii = ii
+        self.max_entries = max_entries
+        self.max_postings = max_postings
+        self.results = OrderedDict()  # The results, least recently used first.
+        self.num_postings = 0  # The total number of postings in the results.
+        self.version = ii.version  # The version of the index of the results.
+        self.hits = 0
+        self.misses = 0
+        # The lock for the results and the counters.
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.results)
+
+    def normalize(self, keywords, mode="or"):
+        """
+        Return the given keywords in a normal form for the given query mode
+        (see InvertedIndex.process_query): sorted and without the keywords
+        that are not in the index (in neither segment, see
+        InvertedIndex.add_documents). Keywords that occur several times
+        are kept, since they count several times in the scores. Processing the
+        normalized keywords gives the same result as processing the given
+        keywords (up to the order of adding the scores). In the mode "and",
+        the keywords that are not in the index are kept (there are no results
+        then), in the mode "phrase", the keywords are not changed, since
+        their order matters. Tuple keywords (expanded prefix or fuzzy
+        keywords, see InvertedIndex.analyze_query) are sorted after the other
+        keywords, in the mode "or" without the empty ones.
+
+        >>> cache = QueryCache(InvertedIndex())
+        >>> cache.ii.inverted_lists = {"a": PostingList(), "b": PostingList()}
+        >>> cache.normalize(["b", "", "c", "a", "b"])
+        ('a', 'b', 'b')
+        >>> cache.normalize(["b", "c", "a"], "and")
+        ('a', 'b', 'c')
+        >>> cache.normalize(["b", "c", "a"], "phrase")
+        ('b', 'c', 'a')
+        >>> cache.normalize([("b", "c"), "b", (), ("a",)])
+        ('b', ('a',), ('b', 'c'))
+        """
+        if mode == "phrase":
+            return tuple(keywords)
+        if mode == "and":
+            return tuple(sorted(keywords, key=sort_key))
+        # An empty tuple keyword matches no docs, like a keyword that is not
+        # in the index.
+        return tuple(sorted((x for x in keywords if (
+            len(x) > 0 if isinstance(x, tuple) else
+            x in self.ii.inverted_lists or x in self.ii.delta_lists)),
+            key=sort_key))
+
+    def process_query(self, keywords, k=None, mode="or"):
+        """
+        Return the result of processing the given keywords with the index in
+        the given mode (see InvertedIndex.process_query), from the cache if
+        possible. The result must not be changed.
+        """
+        key = (mode, self.normalize(keywords, mode), k)
+        with self.lock:
+            version = self.ii.version
+            if self.version != version:
+                self.invalidate()
+            result = self.results.get(key)
+            if result is not None:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return result
+            self.misses += 1
+
+        # Process the query without the lock, so that other threads can use
+        # the cache meanwhile.
+        result = self.ii.process_query(list(key[1]), k, mode)
+        if len(result) > self.max_postings:
+            return result
+        with self.lock:
+            # Only keep the result if the index did not change meanwhile.
+            if self.version != version or self.ii.version != version:
+                return result
+            # Another thread may have put the same query into the cache.
+            previous = self.results.pop(key, None)
+            if previous is not None:
+                self.num_postings -= len(previous)
+            self.results[key] = result
+            self.num_postings += len(result)
+            # Evict the least recently used results.
+            while (len(self.results) > self.max_entries
+                   or self.num_postings > self.max_postings):
+                _, evicted = self.results.popitem(last=False)
+                self.num_postings -= len(evicted)
+        return result
+
+    def invalidate(self):
+        """
+        Remove all results from the cache (the counters are kept).
+        """
+        with self.lock:
+            self.results.clear()
+            self.num_postings = 0
+            self.version = self.ii.version
+
+    def warm_up(self, queries, k=None, mode="or"):
+        """
+        Put the results of the given queries (lists of keywords, processed in
+        the given mode) into the cache, for example the queries of a query log
+        or a benchmark (see benchmark.read_queries). The counters are not
+        changed.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.tsv", verbose=False)
+        >>> cache = QueryCache(ii)
+        >>> cache.warm_up([["short", "film"], ["animated", "film"]], 3)
+        >>> _ = cache.process_query(["film", "animated"], 3)
+        >>> len(cache), cache.hits, cache.misses
+        (2, 1, 0)
+        """
+        hits, misses = self.hits, self.misses
+        for keywords in queries:
+            self.process_query(keywords, k, mode)
+        self.hits, self.misses = hits, misses
+
+    def stats(self):
+        """
+        Return a summary of the counters as a string.
+
+        >>> cache = QueryCache(InvertedIndex())
+        >>> _ = cache.process_query(["foo"]), cache.process_query(["bar"])
+        >>> cache.stats()
+        '1 hits, 1 misses (hit rate 50.0%), 1 cached results'
+        """
+        total = self.hits + self.misses
+        return "%d hits, %d misses (hit rate %.1f%%), %d cached results" % (
+            self.hits, self.misses, 100 * self.hits / total if total else 0,
+            len(self.results))
+
+
+def sort_key(keyword):
+    """
+    Return the key to sort the given keyword by (see QueryCache.normalize),
+    since strings and tuples cannot be compared.
+    """
+    return (isinstance(keyword, tuple), keyword)
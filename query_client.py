@@ -0,0 +1,133 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+# Only modules of the standard library that load fast are imported, so that
+# the client starts in a few milliseconds (the index and NumPy are only
+# loaded by the daemon, see query_daemon.py).
+import sys
+import json
+import socket
+import argparse
+import threading
+
+
+# The Unix socket of the query daemon, if not given.
+DEFAULT_SOCKET = "/tmp/query_daemon.sock"
+# The number of results of a query, if not given.
+DEFAULT_NUM_RESULTS = 3
+# The output formats of the results.
+FORMATS = ["tsv", "json"]
+
+
+def send_queries(sock, queries, k=DEFAULT_NUM_RESULTS, mode="or"):
+    """
+    Send the given queries (texts) to the query daemon connected to the
+    given socket, as one JSON request per line, and yield the responses in
+    the same order (see query_daemon.QueryHandler). The queries are sent by a
+    separate thread while the responses are read, so that many queries can
+    be streamed over one connection.
+    """
+    def send():
+        with sock.makefile("w", encoding="utf-8") as f:
+            for query in queries:
+                f.write(json.dumps({"q": query, "k": k, "mode": mode}) + "\n")
+        # Tell the daemon that there are no more queries.
+        sock.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    with sock.makefile("r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+    sender.join()
+
+
+def to_tsv(response):
+    """
+    Return the given response of the daemon as lines of TSV, one per result:
+    the query, the rank, the doc id, the score and the title of the doc. A
+    query without results gives one line with empty fields, an error one line
+    with the error message.
+
+    >>> to_tsv({"query": "short film", "results": [
+    ...     {"id": 4, "score": 2.176, "title": "Short film"}]}).split("\\t")
+    ['short film', '1', '4', '2.176', 'Short film']
+    >>> to_tsv({"query": "foo", "results": []}).split("\\t")
+    ['foo', '', '', '', '']
+    >>> to_tsv({"query": "foo", "error": "Unknown query mode 'x'."})
+    "foo\\tERROR: Unknown query mode 'x'."
+    """
+    query = response["query"].replace("\t", " ")
+    if "error" in response:
+        return "%s\tERROR: %s" % (query, response["error"])
+    if not response["results"]:
+        return query + "\t" * 4
+    return "\n".join("%s\t%d\t%d\t%s\t%s"
+                     % (query, rank, result["id"], result["score"],
+                        result["title"].replace("\t", " "))
+                     for rank, result in enumerate(response["results"], 1))
+
+
+def write_responses(responses, output_format, out=sys.stdout):
+    """
+    Write the given responses of the daemon to the given file, in the given
+    format (one of FORMATS): as TSV (see to_tsv), or as JSON, one response
+    per line. Return the number of responses with an error.
+    """
+    errors = 0
+    for response in responses:
+        if "error" in response:
+            errors += 1
+        if output_format == "json":
+            out.write(json.dumps(response) + "\n")
+        else:
+            out.write(to_tsv(response) + "\n")
+    return errors
+
+
+def main(queries, socket_path, k, mode, output_format):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sys.exit("No query daemon is listening on '%s', start one with "
+                 "'python3 query_daemon.py <precomputed_file>'." % socket_path)
+    with sock:
+        errors = write_responses(send_queries(sock, queries, k, mode),
+                                 output_format)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Send keyword queries to
+            a running query daemon (see 'query_daemon.py') and print the
+            results as TSV or JSON. Without a query on the command line, the
+            queries are read from stdin, one per line, and streamed to the
+            daemon over one connection.""")
+    parser.add_argument("query", type=str, nargs="*", help="""Keywords of a
+            single query""")
+    parser.add_argument("-s", "--socket", type=str, default=DEFAULT_SOCKET,
+                        help="""Unix socket of the daemon (default:
+            %(default)s)""")
+    parser.add_argument("-k", "--k", type=int, default=DEFAULT_NUM_RESULTS,
+                        help="""Number of results per query (default:
+            %(default)s)""")
+    parser.add_argument("-m", "--mode", type=str, default="or",
+                        choices=["or", "and", "phrase"], help="""Query mode:
+            the docs that contain any of the keywords, all keywords, or the
+            keywords as a phrase (default: %(default)s)""")
+    parser.add_argument("-f", "--format", type=str, default="tsv",
+                        choices=FORMATS, help="""Output format: one line per
+            result (query, rank, doc id, score, title), or the response of
+            the daemon as JSON, one line per query (default: %(default)s)""")
+    args = parser.parse_args()
+    if args.query:
+        queries = [" ".join(args.query)]
+    else:
+        queries = (line.split("\t")[0].strip() for line in sys.stdin)
+    main(queries, args.socket, args.k, args.mode, args.format)
@@ -0,0 +1,172 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import json
+import signal
+import socket
+import argparse
+import socketserver
+
+from inverted_index import InvertedIndex  # NOQA
+from index_format import load_index
+from search_server import SearchService
+from query_client import DEFAULT_SOCKET, DEFAULT_NUM_RESULTS
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a connection to a QueryDaemon. Each line sent by the client is a
+    request as JSON, {"q": <query>, "k": <number of results>, "mode":
+    <or|and|phrase>} (k and mode are optional), and is answered by one line
+    with the result of SearchService.search as JSON, or with {"query":
+    <query>, "error": <message>} if the request is invalid. The connection
+    is kept open until the client closes it, so a client can stream many
+    queries over it.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                query, k, mode = parse_request(line)
+            except ValueError as e:
+                response = {"query": "", "error": str(e)}
+            else:
+                # Only invalid queries are answered with an error, like an
+                # unknown mode. Other errors are bugs, they are logged by the
+                # server and close the connection.
+                try:
+                    response = self.server.service.search(query, k, mode)
+                except ValueError as e:
+                    response = {"query": query, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+def parse_request(line):
+    """
+    Return the query, k and the mode of the given request line (see
+    QueryHandler). Raise a ValueError if the request is invalid.
+
+    >>> parse_request('{"q": "short film", "mode": "and"}')
+    ('short film', 3, 'and')
+    >>> parse_request('["short film"]')
+    Traceback (most recent call last):
+        ...
+    ValueError: The request must be a JSON object with the query 'q'.
+    >>> parse_request('{"q": "short film", "k": 0}')
+    Traceback (most recent call last):
+        ...
+    ValueError: k must be a positive number.
+    >>> parse_request('{"q": "short film", "k": true}')
+    Traceback (most recent call last):
+        ...
+    ValueError: k must be a positive number.
+    """
+    request = json.loads(line)
+    if not isinstance(request, dict) or "q" not in request:
+        raise ValueError("The request must be a JSON object with the query "
+                         "'q'.")
+    query = request["q"]
+    k = request.get("k", DEFAULT_NUM_RESULTS)
+    mode = request.get("mode", "or")
+    if not isinstance(query, str):
+        raise ValueError("The query must be a string.")
+    # A bool is an int too, but not a number of results.
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        raise ValueError("k must be a positive number.")
+    return query, k, mode
+
+
+class QueryDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    A server for the given SearchService on a Unix socket at the given path,
+    with one thread per connection (see QueryHandler). The index is loaded
+    once, and each client only pays for connecting to the socket. The socket
+    file is replaced if no daemon is listening on it anymore.
+
+    >>> import tempfile, threading
+    >>> from query_client import send_queries
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> path = os.path.join(tempfile.mkdtemp(), "query.sock")
+    >>> daemon = QueryDaemon(path, SearchService(ii))
+    >>> threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    >>> sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    >>> sock.connect(path)
+    >>> responses = list(send_queries(sock, ["short film", "film short"], 1,
+    ...                               "phrase"))
+    >>> [[x["id"] for x in response["results"]] for response in responses]
+    [[4], []]
+    >>> sock.close()
+    >>> QueryDaemon(path, SearchService(ii))  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    OSError: A query daemon is already listening on '...'.
+    >>> daemon.shutdown()
+    >>> daemon.server_close()
+    >>> os.path.exists(path)
+    False
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            # Only replace the socket file if no daemon is listening on it.
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except OSError:
+                os.remove(path)
+            else:
+                raise OSError("A query daemon is already listening on '%s'."
+                              % path)
+            finally:
+                sock.close()
+        super().__init__(path, QueryHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def main(precomputed_file, socket_path, cache_size):
+    print("Reading from file '%s'." % precomputed_file)
+    ii = load_index(precomputed_file)
+    daemon = QueryDaemon(socket_path, SearchService(ii, cache_size))
+    print("Answering queries on '%s', use 'python3 query_client.py -s %s "
+          "<query>' or pipe queries into it." % (socket_path, socket_path))
+    # Stop on Ctrl-C and on SIGTERM.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        print("\nBye!")
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Load a precomputed
+            inverted index once and answer keyword queries from many clients
+            (see 'query_client.py') over a local Unix socket, with the same
+            results as 'search_server.py'.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            (preferred, since it is memory-mapped instead of read) or as
+            pickle. To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("-s", "--socket", type=str, default=DEFAULT_SOCKET,
+                        help="""Path of the Unix socket (default:
+            %(default)s)""")
+    parser.add_argument("-c", "--cache-size", type=int, default=1000,
+                        help="""Maximal number of query results kept in the
+            cache (default: %(default)s)""")
+    args = parser.parse_args()
+    main(args.precomputed_file, args.socket, args.cache_size)
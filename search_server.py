@@ -0,0 +1,278 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import json
+import time
+import signal
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from inverted_index import InvertedIndex, MODES, keyword_terms  # NOQA
+from index_format import load_index
+from query_cache import QueryCache
+from snippets import make_snippet, to_json
+
+
+# The number of results of a search, if not given, and the maximal number.
+DEFAULT_NUM_RESULTS = 10
+MAX_NUM_RESULTS = 100
+
+
+class SearchService:
+    """
+    Answers search requests on an inverted index: splits the query into
+    keywords (like the docs of the index, with prefix and fuzzy keywords
+    expanded, see InvertedIndex.analyze_query), processes them in the given
+    query mode (see InvertedIndex.process_query, the results of repeated
+    queries are cached, see query_cache.py) and returns the results as a
+    dictionary, which can be sent as JSON. With fuzzy=True, keywords that are
+    not in the index are expanded like fuzzy keywords (except in the mode
+    "phrase").
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> service = SearchService(ii)
+    >>> response = service.search("Short films", 2)
+    >>> response["keywords"], len(response["results"])
+    (['short', 'films'], 2)
+    >>> response["results"][0]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'id': 4, 'score': 1.313, 'title': 'Movie   Short animated short film.',
+     'snippet': {'text': 'Movie   Short animated short film.',
+                 'highlights': [[8, 13], [23, 28]]}}
+    >>> response = service.search("animated film", mode="and")
+    >>> [x["id"] for x in response["results"]]
+    [2, 4]
+    >>> response = service.search("anim* shrot~ flim", 2)
+    >>> response["keywords"], [x["id"] for x in response["results"]]
+    ([['animated', 'animation'], 'short', 'flim'], [3, 4])
+    >>> SearchService(ii, fuzzy=True).search("flim", 2)["keywords"]
+    ['film']
+    """
+
+    def __init__(self, ii, cache_size=1000, fuzzy=False):
+        """
+        Creates a service for the given index, with a cache for the results
+        of the given size.
+        """
+        self.ii = ii
+        self.cache = QueryCache(ii, max_entries=cache_size)
+        self.fuzzy = fuzzy
+
+    def search(self, query, k=DEFAULT_NUM_RESULTS, mode="or"):
+        """
+        Return the top-k results for the given query in the given query mode,
+        as a dictionary with the query, the mode, its keywords, the
+        processing time (in milliseconds) and the results. Each result has
+        the doc id, the BM25 score, the title and a snippet of the
+        description (of the title, for docs without a description) with the
+        highlighted keywords (see snippets.to_json).
+        """
+        start = time.perf_counter()
+        keywords = self.ii.analyze_query(query,
+                                         self.fuzzy and mode != "phrase")
+        postings = self.cache.process_query(keywords, k, mode)
+        terms = set(keyword_terms(keywords))
+        results = []
+        for doc_id, score in postings:
+            title, *description = self.ii.docs[doc_id - 1]  # 1-based.
+            results.append({
+                "id": doc_id,
+                "score": round(score, 3),
+                "title": title,
+                "snippet": to_json(make_snippet(" ".join(description) or title,
+                                                terms, self.ii.analyzer))})
+        return {"query": query,
+                "mode": mode,
+                "keywords": [x if isinstance(x, str) else list(x)
+                             for x in keywords],
+                "time_ms": round(1000 * (time.perf_counter() - start), 3),
+                "results": results}
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of a SearchServer. The only endpoint is
+    /search?q=<query>&k=<number of results>&mode=<or|and|phrase>, which
+    returns the results of SearchService.search as JSON (the parameters k
+    and mode are optional). Connections are kept alive (HTTP/1.1).
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Send small responses right away (no delay by Nagle's algorithm).
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != "/search":
+            self.send_json(404, {"error": "Not found, use "
+                                          "/search?q=...&k=..."})
+            return
+        params = parse_qs(url.query)
+        query = params.get("q", [""])[0]
+        mode = params.get("mode", ["or"])[0]
+        try:
+            k = int(params.get("k", [DEFAULT_NUM_RESULTS])[0])
+        except ValueError:
+            k = -1
+        if not query.strip():
+            self.send_json(400, {"error": "The parameter q is missing."})
+        elif not 1 <= k <= MAX_NUM_RESULTS:
+            self.send_json(400, {"error": "The parameter k must be a number "
+                                          "from 1 to %d." % MAX_NUM_RESULTS})
+        elif mode not in MODES:
+            self.send_json(400, {"error": "The parameter mode must be one of "
+                                          "%s." % ", ".join(MODES)})
+        else:
+            try:
+                response = self.server.service.search(query, k, mode)
+            except ValueError as e:
+                # For example, a prefix keyword in a phrase query.
+                self.send_json(400, {"error": str(e)})
+            else:
+                self.send_json(200, response)
+
+    def send_json(self, status, data):
+        """
+        Send the given data as JSON response with the given status.
+        """
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class SearchServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server for the given SearchService, with one thread per
+    connection.
+
+    >>> import threading
+    >>> from urllib.request import urlopen
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> server = SearchServer(("127.0.0.1", 0), SearchService(ii))
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> url = "http://127.0.0.1:%d/search?" % server.server_address[1]
+    >>> response = json.load(urlopen(url + "q=short+film&k=1"))
+    >>> [(x["id"], x["score"]) for x in response["results"]]
+    [(4, 2.176)]
+    >>> response = json.load(urlopen(url + "q=film+short&mode=phrase"))
+    >>> response["mode"], response["results"]
+    ('phrase', [])
+    >>> urlopen(url + "k=3")
+    Traceback (most recent call last):
+        ...
+    urllib.error.HTTPError: HTTP Error 400: Bad Request
+    >>> urlopen(url + "q=short+anim*&mode=phrase")
+    Traceback (most recent call last):
+        ...
+    urllib.error.HTTPError: HTTP Error 400: Bad Request
+    >>> server.shutdown()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, SearchHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def serve(server, workers):
+    """
+    Serve requests with the given server in the given number of worker
+    processes. The workers are forked after the server socket and the index
+    have been opened, so all workers accept connections on the same socket,
+    and the pages of a memory-mapped index are shared by all workers.
+    """
+    if workers <= 1:
+        server.serve_forever()
+        return
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # The worker process.
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    # Stop the workers on Ctrl-C and on SIGTERM (as sent by "docker stop").
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+
+def main(precomputed_file, host, port, workers, cache_size, verbose,
+         fuzzy=False):
+    # Open the index before forking the workers, so that they share it.
+    print("Reading from file '%s'." % precomputed_file)
+    ii = load_index(precomputed_file)
+    server = SearchServer((host, port), SearchService(ii, cache_size, fuzzy),
+                          verbose)
+    print("Serving the search API at 'http://%s:%d/search?q=...&k=...' with "
+          "%d worker(s)." % (host, port, workers))
+    try:
+        serve(server, workers)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("\nBye!")
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Serve a search API over
+            HTTP for a precomputed inverted index: /search?q=<query>&k=<number
+            of results>&mode=<or|and|phrase> returns the top-k results with
+            snippets as JSON.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            (preferred, since the workers share the memory-mapped file) or as
+            pickle. To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("-p", "--port", type=int, default=5000, help="""Port
+            for the API; should be the container port you published to the
+            docker host (default: %(default)s)""")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="""Address
+            to listen on (default: %(default)s)""")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="""Number of worker processes (default: the
+            number of CPUs, %(default)s)""")
+    parser.add_argument("-c", "--cache-size", type=int, default=1000,
+                        help="""Maximal number of query results kept in the
+            cache of each worker (default: %(default)s)""")
+    parser.add_argument("-v", "--verbose", action="store_true", help="""Log
+            each request""")
+    parser.add_argument("--fuzzy", action="store_true", help="""Expand the
+            keywords that are not in the index to the terms within a small
+            edit distance, like fuzzy keywords (<word>~), to find the docs
+            for misspelled keywords""")
+    args = parser.parse_args()
+    main(args.precomputed_file, args.host, args.port, args.workers,
+         args.cache_size, args.verbose, args.fuzzy)
@@ -0,0 +1,586 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import json
+import time
+import heapq
+import argparse
+import threading
+import multiprocessing
+from bisect import bisect_right
+from collections import Counter, deque
+from collections.abc import Sequence
+from itertools import accumulate, islice
+
+from analyzer import Analyzer
+from inverted_index import (InvertedIndex, MODES, DEFAULT_B, DEFAULT_K,
+                            bm25_scores, compute_score_bounds, read_shard,
+                            read_packed_shard, unpack_lists, split_file)
+from index_format import load_index, write_index
+from benchmark import read_queries
+
+
+# The number of queries sent to the shards in one request (see
+# ShardedIndex.process_queries).
+BATCH_SIZE = 64
+
+
+def build_shards(file_name, num_shards, b=None, k=None, analyzer=None,
+                 workers=1):
+    """
+    Build the index of the given file partitioned by doc id into (at most)
+    the given number of shards: the file is split into parts of about the
+    same size (see split_file), and the docs of each part form a shard, an
+    InvertedIndex with doc ids relative to the shard. The BM25 scores of the
+    shards are computed with the statistics of the whole file (see
+    score_shard), so each posting has the same score as in the index of the
+    whole file. With workers > 1, the parts are read in parallel. Return the
+    shards (without empty parts).
+
+    >>> shards = build_shards("example.tsv", 2, b=0.75, k=1.75)
+    >>> [len(shard.docs) for shard in shards]
+    [3, 1]
+    >>> [(i, "%.3f" % tf) for i, tf in shards[1].inverted_lists["short"]]
+    [(1, '1.313')]
+    """
+    analyzer = analyzer or Analyzer()
+    ranges = split_file(file_name, num_shards)
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            parts = pool.starmap(read_packed_shard, [
+                (file_name, start, end, analyzer) for start, end in ranges])
+        parts = [(unpack_lists(*packed_lists), docs, doc_lengths)
+                 for packed_lists, docs, doc_lengths, _ in parts]
+    else:
+        parts = [read_shard(file_name, start, end, analyzer=analyzer)
+                 for start, end in ranges]
+
+    shards = []
+    for inverted_lists, docs, doc_lengths in parts:
+        if docs:
+            shard = InvertedIndex()
+            shard.analyzer = analyzer
+            shard.add_shard(inverted_lists, docs, doc_lengths)
+            shards.append(shard)
+    if not shards:
+        raise ValueError("The file '%s' contains no documents." % file_name)
+
+    # Compute the statistics of the whole file: N, AVDL and the df of each
+    # word (the sum of the lengths of its inverted lists in the shards).
+    n = sum(len(shard.docs) for shard in shards)
+    avdl = sum(sum(shard.doc_lengths) for shard in shards) / n
+    dfs = Counter()
+    for shard in shards:
+        dfs.update({word: len(inverted_list) for word, inverted_list
+                    in shard.inverted_lists.items()})
+    for shard in shards:
+        score_shard(shard, n, avdl, dfs, b, k)
+    return shards
+
+
+def score_shard(shard, n, avdl, dfs, b=None, k=None):
+    """
+    Compute the BM25 scores of the given shard (with tf scores) with the
+    given statistics of the whole index (N, AVDL and a dictionary with the df
+    of each word) and the given b and k, together with the score bounds
+    needed for top-k queries (see InvertedIndex.get_score_bounds).
+
+    >>> shard = InvertedIndex()
+    >>> shard.add_shard(*read_shard("example.tsv", 51))
+    >>> score_shard(shard, 4, 3.75, {"short": 2, "film": 2, "movie": 4,
+    ...                              "animated": 3, "animation": 1},
+    ...             b=0, k=float("inf"))
+    >>> [(i, "%.3f" % tf) for i, tf in shard.inverted_lists["short"]]
+    [(1, '1.000'), (2, '2.000')]
+    """
+    shard.b = DEFAULT_B if b is None else b
+    shard.k = DEFAULT_K if k is None else k
+    words = list(shard.inverted_lists)
+    lists = [shard.inverted_lists[word] for word in words]
+    scores = bm25_scores(lists, shard.doc_lengths, n, avdl, shard.b,
+                         shard.k, [dfs[word] for word in words])
+    for inverted_list, list_scores in zip(lists, scores):
+        inverted_list.scores = list_scores
+    shard.score_bounds = {word: compute_score_bounds(list_scores)
+                          for word, list_scores in zip(words, scores)}
+    shard.version += 1
+
+
+def write_shards(shards, base_name, codec="raw"):
+    """
+    Write each of the given shards to a file in the binary index format
+    (with the posting blocks encoded by the given codec), named
+    <base_name>shard<i>.idx, and a manifest <base_name>shards.json with the
+    names of these files and the number of docs of each shard, in the order
+    of the doc ids (see ShardedIndex.open). Return the name of the manifest.
+    """
+    manifest = {"num_docs": sum(len(shard.docs) for shard in shards),
+                "shards": []}
+    for i, shard in enumerate(shards):
+        file_name = "%sshard%d.idx" % (base_name, i)
+        write_index(shard, file_name, codec)
+        manifest["shards"].append({"file": os.path.basename(file_name),
+                                   "num_docs": len(shard.docs)})
+    manifest_file = base_name + "shards.json"
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    return manifest_file
+
+
+def handle_request(ii, request):
+    """
+    Answer the given request with the given shard. The requests are tuples:
+    ("query", keywords, k, mode) is answered by the result of
+    InvertedIndex.process_query, ("batch", queries, k, mode) by the list of
+    the results of the queries, ("docs", doc_ids) by the list of the docs
+    with the given ids (relative to the shard) and ("info",) by the number of
+    docs, the flags of the analyzer (see Analyzer.flags), b and k.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> [(id, "%.3f" % tf) for id, tf
+    ...  in handle_request(ii, ("query", ["short"], 1, "or"))]
+    [(4, '1.313')]
+    >>> handle_request(ii, ("docs", [4]))
+    [('Movie   Short animated short film.',)]
+    >>> handle_request(ii, ("stats",))
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown request 'stats'.
+    """
+    kind, *args = request
+    if kind == "query":
+        return ii.process_query(*args)
+    if kind == "batch":
+        queries, k, mode = args
+        return [ii.process_query(keywords, k, mode) for keywords in queries]
+    if kind == "docs":
+        return [tuple(ii.docs[doc_id - 1]) for doc_id in args[0]]
+    if kind == "info":
+        return len(ii.docs), ii.analyzer.flags, ii.b, ii.k
+    raise ValueError("Unknown request '%s'." % kind)
+
+
+class LocalShard:
+    """
+    A shard in the current process, with the same interface as ProcessShard:
+    send passes a request to the index (see handle_request), and receive
+    returns the responses in order. It stands in for a shard in another
+    process (or on another machine) in tests, and serves as baseline for the
+    sharded query processing.
+    """
+
+    def __init__(self, ii):
+        self.ii = ii
+        self.responses = deque()
+
+    def send(self, request):
+        self.responses.append(handle_request(self.ii, request))
+
+    def receive(self):
+        return self.responses.popleft()
+
+    def close(self):
+        pass
+
+
+class ProcessShard:
+    """
+    A shard served by a worker process, which opens the index in the given
+    file (see serve_shard) and answers the requests sent over a pipe (see
+    handle_request). The requests and responses are pickled, so a transport
+    to a process on another machine only needs to send the same messages
+    over a socket.
+    """
+
+    def __init__(self, file_name):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_shard, args=(worker_connection, file_name),
+            daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def send(self, request):
+        self.connection.send(request)
+
+    def receive(self):
+        """
+        Return the next response of the worker. An exception raised by the
+        worker is raised again.
+        """
+        ok, response = self.connection.recv()
+        if not ok:
+            raise response
+        return response
+
+    def close(self):
+        """
+        Stop the worker process.
+        """
+        if self.process.is_alive():
+            self.connection.send(None)
+            self.process.join()
+        self.connection.close()
+
+
+def serve_shard(connection, file_name):
+    """
+    Open the index in the given file and answer the requests received on the
+    given connection (see handle_request), as pairs (True, response), or
+    (False, exception) if the request failed, until None is received or the
+    connection is closed. Run by the worker process of a ProcessShard.
+    """
+    ii = load_index(file_name)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            response = (True, handle_request(ii, request))
+        except Exception as e:
+            response = (False, e)
+        connection.send(response)
+
+
+class ShardedIndex:
+    """
+    The coordinator of an index that is partitioned by doc id into shards
+    (see build_shards), each served by a LocalShard or a ProcessShard: a
+    query is sent to all shards at once (scatter), each shard computes its
+    top-k, and the results are merged into the global top-k (gather). Since
+    the BM25 scores of the shards are computed with the statistics of the
+    whole index, the results are the same as for a single index. The doc ids
+    are global: the ids of a shard are shifted by the number of docs in the
+    shards before it.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> shards = build_shards("example.tsv", 2)
+    >>> sharded = ShardedIndex([LocalShard(shard) for shard in shards])
+    >>> result = sharded.process_query(["short", "film"], k=2)
+    >>> [(id, "%.3f" % tf) for id, tf in result]
+    [(4, '2.176'), (3, '1.106')]
+    >>> all(sharded.process_query(keywords, k, mode)
+    ...     == ii.process_query(keywords, k, mode)
+    ...     for keywords in [["short", "film"], ["animated", "movie"]]
+    ...     for k in [None, 1] for mode in MODES)
+    True
+    >>> results = sharded.process_queries([["film"], ["short", "film"]], k=1)
+    >>> [[(id, "%.3f" % tf) for id, tf in result] for result in results]
+    [[(2, '0.969')], [(4, '2.176')]]
+    >>> len(sharded.docs), sharded.docs[3]
+    (4, ('Movie   Short animated short film.',))
+    >>> sharded.process_query(["film"], mode="any")
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown query mode 'any', expected one of or, and, phrase.
+
+    Several threads can send queries at the same time (see exchange).
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> queries = [["short", "film"], ["animated"], ["movie"]] * 20
+    >>> with ThreadPoolExecutor(4) as executor:
+    ...     results = list(executor.map(sharded.process_query, queries))
+    >>> results == [ii.process_query(x) for x in queries]
+    True
+    """
+
+    def __init__(self, shards):
+        """
+        Creates a coordinator for the given shards, in the order of the doc
+        ids.
+        """
+        self.shards = shards
+        # The lock of each shard, held from sending a request to the shard
+        # until its response is received (see exchange).
+        self.locks = [threading.Lock() for _ in shards]
+        info = self.broadcast(("info",))
+        # The number of docs in the shards before each shard (and the total
+        # number of docs at the end).
+        self.offsets = [0, *accumulate(x[0] for x in info)]
+        _, flags, self.b, self.k = info[0]
+        self.analyzer = Analyzer.from_flags(flags)
+        self.docs = ShardedDocs(self)
+
+    @classmethod
+    def open(cls, manifest_file):
+        """
+        Open the shards in the given manifest (see write_shards), each served
+        by a worker process (see ProcessShard).
+
+        >>> import tempfile
+        >>> base_name = os.path.join(tempfile.mkdtemp(), "example_")
+        >>> manifest_file = write_shards(build_shards("example.tsv", 2),
+        ...                              base_name)
+        >>> with ShardedIndex.open(manifest_file) as sharded:
+        ...     result = sharded.process_query(["animated"], k=2, mode="and")
+        >>> [(id, "%.3f" % tf) for id, tf in result]
+        [(1, '0.459'), (2, '0.402')]
+        """
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        directory = os.path.dirname(manifest_file)
+        return cls([ProcessShard(os.path.join(directory, x["file"]))
+                    for x in manifest["shards"]])
+
+    def broadcast(self, request):
+        """
+        Send the given request to all shards, so that they process it at the
+        same time, and return the list of their responses.
+        """
+        return self.exchange([(i, request) for i in range(len(self.shards))])
+
+    def exchange(self, requests):
+        """
+        Send the given requests, as pairs (shard number, request) sorted by
+        shard number, and return the list of their responses. If a shard
+        raises an exception, it is raised again after all responses are
+        received.
+
+        Each shard answers one request at a time, so the lock of a shard is
+        held from sending the request until the response is received. The
+        locks are taken in the order of the shards, and each is released as
+        soon as its response is received. So the requests of several threads
+        are processed by different shards at the same time, like in a
+        pipeline.
+        """
+        sent = []
+        responses = []
+        error = None
+        try:
+            for i, request in requests:
+                self.locks[i].acquire()
+                try:
+                    self.shards[i].send(request)
+                except BaseException:
+                    self.locks[i].release()
+                    raise
+                sent.append(i)
+        finally:
+            # Receive the responses of all requests that were sent, so that
+            # no response is left for the next request.
+            for i in sent:
+                try:
+                    responses.append(self.shards[i].receive())
+                except Exception as e:
+                    error = error or e
+                finally:
+                    self.locks[i].release()
+        if error is not None:
+            raise error
+        return responses
+
+    def process_query(self, keywords, k=None, mode="or"):
+        """
+        Process the given keyword query in the given mode on all shards, see
+        InvertedIndex.process_query. Return the merged results (see merge).
+        """
+        check_mode(mode)
+        if not keywords:
+            return []
+        return self.merge(self.broadcast(("query", keywords, k, mode)), k)
+
+    def process_queries(self, queries, k=None, mode="or",
+                        batch_size=BATCH_SIZE):
+        """
+        Process the given queries (see process_query) and return the list of
+        their results. The queries are sent to the shards in batches of the
+        given size, so that there is one request per batch and shard, instead
+        of one per query and shard.
+        """
+        check_mode(mode)
+        results = []
+        for start in range(0, len(queries), batch_size):
+            responses = self.broadcast(
+                ("batch", queries[start:start + batch_size], k, mode))
+            results.extend(self.merge(shard_results, k)
+                           for shard_results in zip(*responses))
+        return results
+
+    def merge(self, results, k=None):
+        """
+        Merge the given results of the shards (each sorted by score, see
+        InvertedIndex.process_query, with doc ids relative to the shard) into
+        one result with global doc ids, sorted by score in descending order
+        (ties are broken by doc id). If k is given, only the top-k.
+        """
+        shifted = [[(doc_id + offset, score) for doc_id, score in result]
+                   for result, offset in zip(results, self.offsets)]
+        return list(islice(heapq.merge(*shifted,
+                                       key=lambda x: (-x[1], x[0])), k))
+
+    def get_docs(self, doc_ids):
+        """
+        Return the docs with the given (global) ids, each requested from its
+        shard.
+        """
+        requests = {}
+        for doc_id in doc_ids:
+            i = bisect_right(self.offsets, doc_id - 1) - 1
+            requests.setdefault(i, []).append(doc_id - self.offsets[i])
+        requests = sorted(requests.items())
+        responses = self.exchange([(i, ("docs", local_ids))
+                                   for i, local_ids in requests])
+        docs = {}
+        for (i, local_ids), shard_docs in zip(requests, responses):
+            for local_id, doc in zip(local_ids, shard_docs):
+                docs[local_id + self.offsets[i]] = doc
+        return [docs[doc_id] for doc_id in doc_ids]
+
+    def close(self):
+        """
+        Close all shards (stops the worker processes).
+        """
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardedDocs(Sequence):
+    """
+    The docs of a ShardedIndex, like InvertedIndex.docs (the doc with id i is
+    at index i - 1). Each doc is requested from its shard when it is
+    accessed.
+    """
+
+    def __init__(self, sharded_index):
+        self.sharded_index = sharded_index
+
+    def __len__(self):
+        return self.sharded_index.offsets[-1]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("doc index out of range")
+        return self.sharded_index.get_docs([i + 1])[0]
+
+
+def check_mode(mode):
+    """
+    Raise a ValueError if the given query mode is not one of MODES (like
+    InvertedIndex.process_query).
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown query mode '%s', expected one of %s."
+                         % (mode, ", ".join(MODES)))
+
+
+def benchmark(manifest_file, query_file, num_queries, k, mode):
+    """
+    Compare the throughput of the shards in the given manifest, served by
+    worker processes, with the throughput of the same shards in this process
+    (one after the other), on the given number of queries from the given
+    query file (repeated if the file has fewer queries). Check that both
+    return the same results.
+    """
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(manifest_file)
+    local = ShardedIndex([
+        LocalShard(load_index(os.path.join(directory, x["file"])))
+        for x in manifest["shards"]])
+    queries = read_queries(query_file, local.analyzer)
+    queries = list(islice((queries * (num_queries // len(queries) + 1)),
+                          num_queries))
+    print("Processing %d queries (top-%s, mode '%s') on %d shards.\n"
+          % (len(queries), k, mode, len(manifest["shards"])))
+
+    def throughput(name, process):
+        start = time.perf_counter()
+        results = process()
+        seconds = time.perf_counter() - start
+        print("%-40s %10.1f queries/s" % (name, len(queries) / seconds))
+        return results, len(queries) / seconds
+
+    expected, local_qps = throughput(
+        "one process", lambda: local.process_queries(queries, k, mode))
+    with ShardedIndex.open(manifest_file) as sharded:
+        results, sharded_qps = throughput(
+            "%d processes, batches of %d queries"
+            % (len(sharded.shards), BATCH_SIZE),
+            lambda: sharded.process_queries(queries, k, mode))
+        single_results, _ = throughput(
+            "%d processes, one query at a time" % len(sharded.shards),
+            lambda: [sharded.process_query(x, k, mode) for x in queries])
+    print("\nSpeedup of the batches: %.1fx" % (sharded_qps / local_qps))
+    if results != expected or single_results != expected:
+        print("WARNING: The results of the worker processes differ.")
+
+
+def main(file_name, num_shards, b, k, analyzer, workers, codec):
+    print("Creating %d shards with BM25 scores from file '%s'."
+          % (num_shards, file_name))
+    shards = build_shards(file_name, num_shards, b, k, analyzer, workers)
+    base_name = file_name.replace("input", "output").replace(".tsv", "_")
+    manifest_file = write_shards(shards, base_name, codec)
+    print("Saved %d shards with %s documents, see '%s'."
+          % (len(shards), "/".join(str(len(x.docs)) for x in shards),
+             manifest_file))
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Partition the inverted
+            index of the given file by doc id into shards, each saved in the
+            binary index format, with the BM25 scores of the index of the
+            whole file. With --queries, compare the throughput of the shards
+            served by worker processes (scatter-gather) with a single
+            process.""")
+    parser.add_argument("file", type=str, help="""File to read from, in the
+            format <title>TAB<description>. With --queries, the manifest of
+            the shards (<name>_shards.json), as written without
+            --queries.""")
+    parser.add_argument("-s", "--shards", type=int,
+                        default=os.cpu_count(), help="""Number of shards
+            (default: the number of CPUs, %(default)s)""")
+    parser.add_argument("-b", "--b", type=float, default=0.75, help="""b value
+            for the BM25 scores (default: %(default)s)""")
+    parser.add_argument("-k", "--k", type=float, default=1.75, help="""k value
+            for the BM25 scores (default: %(default)s)""")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="""Number
+            of processes that read the file in parallel (default:
+            %(default)s)""")
+    parser.add_argument("-c", "--codec", type=str, default="raw",
+                        choices=["raw", "varbyte", "bitpack"], help="""Encoding
+            of the posting blocks of the shards (default: %(default)s)""")
+    parser.add_argument("--stopwords", action="store_true", help="""Remove
+            frequent English words (see analyzer.py)""")
+    parser.add_argument("--stemming", action="store_true", help="""Reduce the
+            words to their stems (see analyzer.py)""")
+    parser.add_argument("-q", "--queries", type=str, default=None,
+                        metavar="QUERY_FILE", help="""Do not build shards,
+            but measure the throughput of the shards in the given manifest on
+            the queries in QUERY_FILE (one per line, a benchmark file can be
+            used as well)""")
+    parser.add_argument("-n", "--num-queries", type=int, default=2000,
+                        help="""Number of queries to process with --queries
+            (default: %(default)s)""")
+    parser.add_argument("-r", "--results", type=int, default=10, help="""Number
+            of results per query with --queries (default: %(default)s)""")
+    parser.add_argument("-m", "--mode", type=str, default="or", choices=MODES,
+                        help="""Query mode with --queries (default:
+            %(default)s)""")
+    args = parser.parse_args()
+    if args.queries is not None:
+        benchmark(args.file, args.queries, args.num_queries, args.results,
+                  args.mode)
+    else:
+        main(args.file, args.shards, args.b, args.k,
+             Analyzer(stopwords=args.stopwords, stemming=args.stemming),
+             args.workers, args.codec)
@@ -0,0 +1,219 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import re
+import html
+from collections import namedtuple
+from functools import lru_cache
+
+from analyzer import Analyzer, unstem  # NOQA
+
+
+# The maximal length of a snippet (in characters, without the "..." marks).
+SNIPPET_LENGTH = 200
+# The number of queries whose highlight patterns are cached.
+PATTERN_CACHE_SIZE = 1000
+
+# The ANSI escape codes used by to_ansi.
+BOLD = "\033[1m"
+RED = "\033[31m"
+BOLD_RED = "\033[1;31m"
+RESET = "\033[0m"
+
+# An excerpt of a text, with the spans (start, end) of the highlighted words
+# in the excerpt.
+Snippet = namedtuple("Snippet", ["text", "spans"])
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def highlight_pattern(terms, stemming=False):
+    """
+    Return a compiled pattern for the given terms (a frozenset) of a query,
+    which matches the words of a text whose term may be one of the terms
+    (see Analyzer.analyze): the words are matched case-insensitively and,
+    with stemming, in all forms that may be reduced to a term (see
+    analyzer.unstem). The patterns are cached, so they are compiled only once
+    per query. Return None if there are no terms.
+
+    >>> pattern = highlight_pattern(frozenset(["film", "c"]), stemming=True)
+    >>> [m.group() for m in pattern.finditer("FILMS, Film2, c++, cfilm")]
+    ['FILMS', 'Film', 'c']
+    >>> highlight_pattern(frozenset(["film", "c"]), stemming=True) is pattern
+    True
+    """
+    if not terms:
+        return None
+    words = set()
+    for term in terms:
+        words.update(unstem(term) if stemming else [term])
+    # Longer words first, so that the longest form matches.
+    alternatives = "|".join(sorted(map(re.escape, words), key=len,
+                                   reverse=True))
+    return re.compile("(?<![A-Za-z])(?:%s)(?![A-Za-z])" % alternatives,
+                      re.IGNORECASE | re.ASCII)
+
+
+def find_terms(text, terms, analyzer):
+    """
+    Return the positions of the words of the given text whose term (given by
+    the analyzer) is one of the given terms, as list of triples (start, end,
+    term).
+
+    >>> find_terms("Heroes of Stories: the hero's story.",
+    ...            {"heroe", "story"}, Analyzer(stemming=True))
+    [(0, 6, 'heroe'), (10, 17, 'story'), (30, 35, 'story')]
+    """
+    pattern = highlight_pattern(frozenset(terms), analyzer.stemming)
+    if pattern is None:
+        return []
+    matches = []
+    for match in pattern.finditer(text):
+        # The pattern may match other forms of a word (like "storys").
+        term = analyzer.terms[match.group().lower()]
+        if term in terms:
+            matches.append((match.start(), match.end(), term))
+    return matches
+
+
+def best_window(matches, length):
+    """
+    Return the range (first, last) of the given matches (see find_terms) that
+    fit into a window of the given length and contain the most distinct terms
+    (and among those, the most matches, and the first such range). The range
+    is empty if no match fits.
+
+    >>> best_window([(0, 4, "a"), (10, 14, "a"), (20, 24, "b"),
+    ...              (50, 54, "a"), (60, 64, "b")], 20)
+    (1, 3)
+    """
+    best_range = (0, 0)
+    best_score = (0, 0)
+    counts = {}  # The number of matches of each term in the window.
+    j = 0
+    for i, (start, _, term) in enumerate(matches):
+        j = max(i, j)
+        while j < len(matches) and matches[j][1] - start <= length:
+            counts[matches[j][2]] = counts.get(matches[j][2], 0) + 1
+            j += 1
+        score = (len(counts), j - i)
+        if score > best_score:
+            best_range, best_score = (i, j), score
+        if j > i:
+            counts[term] -= 1
+            if counts[term] == 0:
+                del counts[term]
+    return best_range
+
+
+def make_snippet(text, terms, analyzer, length=SNIPPET_LENGTH):
+    """
+    Return an excerpt of at most the given length of the given text (as a
+    Snippet), with the words highlighted whose term (given by the analyzer)
+    is one of the given terms. The excerpt is the window that contains the
+    most distinct terms (see best_window), with the rest of the length split
+    before and after the terms, or the start of the text if it contains no
+    terms. The excerpt starts and ends at word boundaries (if possible), cut
+    parts are marked by "...". Only the text and the compiled pattern of the
+    query are scanned, so a snippet takes time linear in the length of the
+    text.
+
+    >>> text = "A boy and his dog go on a short trip to the sea."
+    >>> make_snippet(text, {"dog", "sea"}, Analyzer(), length=20)
+    Snippet(text='... and his dog go on a ...', spans=[(12, 15)])
+    >>> make_snippet(text, {"trip", "sea"}, Analyzer(), length=24)
+    Snippet(text='... a short trip to the sea.', spans=[(12, 16), (24, 27)])
+    >>> make_snippet(text, {"cat"}, Analyzer(), length=20)
+    Snippet(text='A boy and his dog go ...', spans=[])
+    >>> make_snippet("Short film", {"short"}, Analyzer())
+    Snippet(text='Short film', spans=[(0, 5)])
+    """
+    matches = find_terms(text, terms, analyzer)
+    if len(text) <= length:
+        start, end = 0, len(text)
+    else:
+        first, last = best_window(matches, length)
+        if first < last:
+            left, right = matches[first][0], matches[last - 1][1]
+        else:
+            left = right = 0
+        # Split the rest of the length before and after the terms.
+        start = max(0, min(left - (length - (right - left)) // 2,
+                           len(text) - length))
+        end = start + length
+        # Move the start and the end to the next word boundary (within the
+        # rest of the length).
+        if start > 0:
+            space = text.find(" ", start - 1, left)
+            if space >= 0:
+                start = space + 1
+        if end < len(text):
+            space = text.rfind(" ", right, end + 1)
+            if space >= 0:
+                end = space
+    prefix = "... " if start > 0 else ""
+    suffix = " ..." if end < len(text) else ""
+    shift = len(prefix) - start
+    spans = [(s + shift, e + shift) for s, e, _ in matches
+             if s >= start and e <= end]
+    return Snippet(prefix + text[start:end] + suffix, spans)
+
+
+def highlight(snippet, before, after, escape=str):
+    """
+    Return the text of the given snippet with the given strings before and
+    after each highlighted span. The parts of the text are passed through
+    escape first.
+
+    >>> highlight(Snippet("a <b> c", [(2, 5)]), "[", "]", html.escape)
+    'a [&lt;b&gt;] c'
+    """
+    parts = []
+    position = 0
+    for start, end in snippet.spans:
+        parts.append(escape(snippet.text[position:start]))
+        parts.append(before + escape(snippet.text[start:end]) + after)
+        position = end
+    parts.append(escape(snippet.text[position:]))
+    return "".join(parts)
+
+
+def to_ansi(snippet, bold=False):
+    """
+    Render the given snippet for a terminal, using ANSI escape codes: the
+    highlighted words in red, and with bold=True, the whole text in bold.
+
+    >>> to_ansi(Snippet("Short film", [(0, 5)]))
+    '\\x1b[31mShort\\x1b[0m film'
+    >>> to_ansi(Snippet("Short film", [(0, 5)]), bold=True)
+    '\\x1b[1m\\x1b[0m\\x1b[1;31mShort\\x1b[0m\\x1b[1m film\\x1b[0m'
+    """
+    if not bold:
+        return highlight(snippet, RED, RESET)
+    return BOLD + highlight(snippet, RESET + BOLD_RED, RESET + BOLD) + RESET
+
+
+def to_html(snippet, tag="mark"):
+    """
+    Render the given snippet as HTML: the text is escaped, the highlighted
+    words are enclosed in the given tag.
+
+    >>> to_html(Snippet("Tom & Jerry", [(0, 3)]))
+    '<mark>Tom</mark> &amp; Jerry'
+    """
+    return highlight(snippet, "<%s>" % tag, "</%s>" % tag, html.escape)
+
+
+def to_json(snippet):
+    """
+    Render the given snippet as a dictionary, which can be sent as JSON: the
+    text and the highlighted spans, as pairs [start, end] of character
+    positions in the text.
+
+    >>> to_json(Snippet("Short film", [(0, 5)]))
+    {'text': 'Short film', 'highlights': [[0, 5]]}
+    """
+    return {"text": snippet.text,
+            "highlights": [list(span) for span in snippet.spans]}
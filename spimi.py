@@ -0,0 +1,286 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import os
+import struct
+import heapq
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
+from inverted_index import (InvertedIndex, PostingList, DEFAULT_B, DEFAULT_K,
+                            read_lines, add_doc)
+from analyzer import Analyzer
+from index_format import (HEADER, check_byteorder, write_postings,
+                          write_tables)
+from doc_store import DocStoreWriter
+from vocabulary import build_qgram_index
+
+
+# The estimated memory (in bytes) per posting and per word of the inverted
+# lists that are kept in memory while reading the docs, and per posting of
+# the inverted lists that are scored at once while merging the runs.
+POSTING_MEMORY = 12
+WORD_MEMORY = 500
+SCORE_MEMORY = 128
+
+# The header of an inverted list in a run: the length of the word (in bytes)
+# and the number of postings.
+RUN_LIST_HEADER = struct.Struct("<II")
+
+# The maximal number of runs that are merged at once, since each of them is
+# an open file while merging (see merge_runs).
+MAX_FAN_IN = 64
+
+
+def build_index(doc_file, file_name, b=None, k=None, buffer_size=2**28,
+                verbose=True, analyzer=None, codec="raw", doc_block_size=0):
+    """
+    Construct the inverted index with BM25 scores from the given file (see
+    InvertedIndex.read_from_file, the docs are split into words by the given
+    analyzer) and write it to the given file in the binary index format
+    (with the posting blocks encoded by the given codec and the docs
+    compressed in blocks of the given size, see index_format.write_index),
+    using only a bounded amount of memory. The index is built in the style of
+    SPIMI (single-pass in-memory indexing):
+
+    (1) Read the docs and write their texts to the doc store of the index
+        file right away. Compute the inverted lists with tf scores in memory,
+        until their estimated size exceeds the given buffer size (in bytes).
+        Then write them, sorted by word, as a run to a temporary file and
+        start with empty lists.
+    (2) Merge the runs (k-way): for each word in sorted order, concatenate the
+        inverted lists of the word in all runs (the doc ids of the runs are
+        increasing). Compute the BM25 scores of batches of inverted lists of
+        about the buffer size and write them to the index file.
+    (3) Build the q-gram index of the vocabulary from the sorted words (see
+        vocabulary.build_qgram_index) and write it after the other tables.
+
+    Apart from the buffer, the memory needed is about 12 bytes per doc and 90
+    bytes per word (70 of them while building the q-gram index). The written
+    file is the same as written by write_index for an index built by
+    InvertedIndex.read_from_file.
+
+    >>> import os, tempfile
+    >>> from index_format import write_index
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> build_index("example.tsv", os.path.join(tmp_dir, "spimi.idx"),
+    ...             buffer_size=1000, verbose=False)
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> write_index(ii, os.path.join(tmp_dir, "example.idx"))
+    >>> (open(os.path.join(tmp_dir, "spimi.idx"), "rb").read()
+    ...  == open(os.path.join(tmp_dir, "example.idx"), "rb").read())
+    True
+    """
+    check_byteorder()
+    b = DEFAULT_B if b is None else b
+    k = DEFAULT_K if k is None else k
+    analyzer = analyzer or Analyzer()
+
+    index_dir = os.path.dirname(os.path.abspath(file_name))
+    with tempfile.TemporaryDirectory(dir=index_dir) as tmp_dir, \
+            open(file_name, "wb") as f:
+        # The header is written at the end, when the offsets are known.
+        f.write(bytes(HEADER.size))
+
+        # (1) Read the docs, write the doc store and the runs.
+        doc_lengths = array("I")
+        doc_store = DocStoreWriter(f, doc_block_size)
+        run_names = []
+        inverted_lists = {}
+        num_postings = 0
+        for doc_id, line in enumerate(read_lines(doc_file), 1):
+            words = analyzer.analyze(line)
+            add_doc(inverted_lists, doc_id, words)
+            dl = len(words)
+            doc_lengths.append(dl)
+            doc_store.add(line)
+
+            # The doc length is an upper bound for the number of new postings.
+            num_postings += dl
+            if (num_postings * POSTING_MEMORY
+                    + len(inverted_lists) * WORD_MEMORY > buffer_size):
+                run_names.append(write_run(tmp_dir, len(run_names),
+                                           inverted_lists))
+                inverted_lists = {}
+                num_postings = 0
+
+            if verbose:
+                if doc_id % 1000 == 0:
+                    print(f"Progress: Read {doc_id:6} documents, wrote "
+                          f"{len(run_names)} runs.", end="\r")
+        doc_offsets = doc_store.finish()
+        if inverted_lists:
+            run_names.append(write_run(tmp_dir, len(run_names),
+                                       inverted_lists))
+            inverted_lists = {}
+            num_postings = 0
+
+        if verbose:
+            print(f"Progress: Read {len(doc_lengths):6} documents, wrote "
+                  f"{len(run_names)} runs.")
+            print("Merging the runs and computing the BM25 scores...")
+
+        # (2) Merge the runs and write the posting blocks. The words are
+        # written to a temporary file, to write the vocabulary at the end.
+        # The scores are computed by an index that has the document lengths
+        # of all docs, but only the inverted lists of the current batch.
+        batch = InvertedIndex()
+        batch.doc_lengths = doc_lengths
+        posting_offsets = array("Q")
+        dfs = array("I")
+        vocabulary_name = os.path.join(tmp_dir, "vocabulary")
+        with open(vocabulary_name, "w", encoding="utf-8") as vocabulary:
+            for word, inverted_list in merge_runs(run_names):
+                batch.inverted_lists[word] = inverted_list
+                num_postings += len(inverted_list)
+                if num_postings * SCORE_MEMORY > buffer_size:
+                    write_batch(f, vocabulary, batch, b, k, posting_offsets,
+                                dfs, codec)
+                    num_postings = 0
+            write_batch(f, vocabulary, batch, b, k, posting_offsets, dfs,
+                        codec)
+
+        # (3) to (8) and the header.
+        with open(vocabulary_name, "r", encoding="utf-8") as vocabulary:
+            qgram_index = build_qgram_index(
+                line.rstrip("\n") for line in vocabulary)
+        with open(vocabulary_name, "r", encoding="utf-8") as vocabulary:
+            words = (line.rstrip("\n") for line in vocabulary)
+            write_tables(f, doc_lengths, doc_offsets, words, posting_offsets,
+                         dfs, b, k, analyzer, codec, doc_block_size,
+                         qgram_index=qgram_index)
+
+
+def write_batch(f, vocabulary, batch, b, k, posting_offsets, dfs,
+                codec="raw"):
+    """
+    Compute the BM25 scores of the inverted lists of the given batch (an
+    index with the document lengths of all docs) and write them to the given
+    index file (encoded by the given codec) and their words to the given
+    vocabulary file. Append the positions of the posting blocks and the
+    number of postings to the given arrays. Remove the inverted lists from
+    the batch.
+    """
+    if not batch.inverted_lists:
+        return
+    batch.rescore(b, k)
+    for word, inverted_list in batch.inverted_lists.items():
+        posting_offsets.append(write_postings(
+            f, inverted_list, batch.get_score_bounds(word)[1], codec))
+        dfs.append(len(inverted_list))
+        vocabulary.write(word + "\n")
+    batch.inverted_lists = {}
+    batch.score_bounds = {}
+
+
+def write_run(tmp_dir, run_id, inverted_lists):
+    """
+    Write the given inverted lists (with tf scores), sorted by word, as a run
+    to a file in the given directory (see write_run_lists). Return the name
+    of the file.
+    """
+    run_name = os.path.join(tmp_dir, "run-%d" % run_id)
+    write_run_lists(run_name, ((word, inverted_lists[word])
+                               for word in sorted(inverted_lists)))
+    return run_name
+
+
+def write_run_lists(run_name, lists):
+    """
+    Write the given inverted lists, as pairs (word, inverted_list) sorted by
+    word, as a run to the given file. Each list is written as its header
+    (see RUN_LIST_HEADER), the word, the doc ids and the tf scores.
+    """
+    with open(run_name, "wb") as f:
+        for word, inverted_list in lists:
+            word_bytes = word.encode("utf-8")
+            f.write(RUN_LIST_HEADER.pack(len(word_bytes), len(inverted_list)))
+            f.write(word_bytes)
+            f.write(inverted_list.doc_ids.tobytes())
+            f.write(inverted_list.tfs.tobytes())
+
+
+def read_run(run_name):
+    """
+    Generate the inverted lists of the run in the given file, as pairs (word,
+    inverted_list), sorted by word.
+    """
+    with open(run_name, "rb") as f:
+        while True:
+            header = f.read(RUN_LIST_HEADER.size)
+            if not header:
+                break
+            word_length, length = RUN_LIST_HEADER.unpack(header)
+            word = f.read(word_length).decode("utf-8")
+            inverted_list = PostingList()
+            inverted_list.doc_ids.frombytes(f.read(4 * length))
+            inverted_list.tfs.frombytes(f.read(4 * length))
+            yield word, inverted_list
+
+
+def merge_runs(run_names, max_fan_in=MAX_FAN_IN):
+    """
+    Merge the runs in the given files (k-way). Generate the inverted lists of
+    all runs as pairs (word, inverted_list), sorted by word, where the list of
+    a word is the concatenation of the lists of the word in all runs (in the
+    given order of the runs).
+
+    At most max_fan_in (at least 2) runs are merged at once. With more runs,
+    each group of max_fan_in consecutive runs is merged into a new run first
+    (and the runs of the group are removed), in passes, until there are at
+    most max_fan_in runs left.
+
+    >>> import os, tempfile
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> runs = [{}, {}, {}]
+    >>> for doc_id, line in enumerate(read_lines("example.tsv"), 1):
+    ...     add_doc(runs[min(doc_id, 3) - 1], doc_id,
+    ...             Analyzer().analyze(line))
+    >>> run_names = [write_run(tmp_dir, i, x) for i, x in enumerate(runs)]
+    >>> [(w, list(l.doc_ids)) for w, l in merge_runs(run_names)]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('animated', [1, 2, 4]), ('animation', [3]), ('film', [2, 4]),
+     ('movie', [1, 2, 3, 4]), ('non', [2]), ('short', [3, 4])]
+    >>> [(w, list(l.doc_ids)) for w, l in merge_runs(run_names, 2)]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('animated', [1, 2, 4]), ('animation', [3]), ('film', [2, 4]),
+     ('movie', [1, 2, 3, 4]), ('non', [2]), ('short', [3, 4])]
+    >>> sorted(os.listdir(tmp_dir))
+    ['run-0-1', 'run-2']
+    """
+    num_passes = 0
+    while len(run_names) > max_fan_in:
+        num_passes += 1
+        merged_names = []
+        for i in range(0, len(run_names), max_fan_in):
+            group = run_names[i:i + max_fan_in]
+            if len(group) > 1:
+                merged_name = "%s-%d" % (group[0], num_passes)
+                write_run_lists(merged_name, merge_run_group(group))
+                for run_name in group:
+                    os.remove(run_name)
+                group = [merged_name]
+            merged_names.extend(group)
+        run_names = merged_names
+    yield from merge_run_group(run_names)
+
+
+def merge_run_group(run_names):
+    """
+    Merge the runs in the given files at once, see merge_runs.
+    """
+    # On equal words, heapq.merge yields the list of the earlier run first.
+    merged = heapq.merge(*[read_run(x) for x in run_names],
+                         key=itemgetter(0))
+    for word, lists in groupby(merged, key=itemgetter(0)):
+        _, inverted_list = next(lists)
+        for _, run_list in lists:
+            inverted_list.doc_ids.extend(run_list.doc_ids)
+            inverted_list.tfs.extend(run_list.tfs)
+        yield word, inverted_list
@@ -0,0 +1,432 @@
+"""
+Copyright 2020, University of Freiburg
+Chair of Algorithms and Data Structures.
+Theresa Klumpp <klumppt@cs.uni-freiburg.de>
+"""
+
+import re
+import time
+import zlib
+import heapq
+import random
+import argparse
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+
+from inverted_index import InvertedIndex, keyword_terms, np  # NOQA
+from load_test import percentile
+
+
+# The length of the q-grams of the fuzzy search (see qgram_keys).
+Q = 3
+# The maximal edit distance of fuzzy keywords (see VocabularyIndex.fuzzy).
+MAX_DISTANCE = 2
+# The maximal number of terms that a prefix or fuzzy keyword is expanded to.
+MAX_EXPANSIONS = 50
+# A prefix keyword (<word>*) or a fuzzy keyword (<word>~ or <word>~N) in a
+# query, see InvertedIndex.analyze_query.
+EXPANSION_PATTERN = re.compile(r"(.*?)(\*|~([0-9]?))$")
+
+
+def qgram_keys(word):
+    """
+    Return the keys of the distinct q-grams of the given word, padded with
+    Q - 1 '$' on both sides, in ascending order. The key of a q-gram is its
+    CRC-32. Different q-grams may have the same key, then the fuzzy search
+    only compares more words with the keyword (see VocabularyIndex.fuzzy).
+
+    >>> len(qgram_keys("film")), len(qgram_keys("aaaa"))
+    (6, 5)
+    >>> qgram_keys("film") == sorted(
+    ...     zlib.crc32(x.encode()) for x in ["$$f", "$fi", "fil", "ilm",
+    ...                                      "lm$", "m$$"])
+    True
+    """
+    padded = "$" * (Q - 1) + word + "$" * (Q - 1)
+    return sorted({zlib.crc32(padded[i:i + Q].encode("utf-8"))
+                   for i in range(len(padded) - Q + 1)})
+
+
+def build_qgram_index(words):
+    """
+    Build the q-gram index of the given words (in sorted order): for each
+    q-gram key (see qgram_keys), the positions of the words with the q-gram,
+    in ascending order. Return a triple (keys, offsets, positions) of arrays:
+    the keys in ascending order (uint32), the start of the positions of each
+    key (uint64, one per key plus one) and the positions (uint32).
+
+    >>> keys, offsets, positions = build_qgram_index(["film", "flim"])
+    >>> len(keys), list(offsets)[-1], sorted(set(positions))
+    (10, 12, [0, 1])
+    >>> i = bisect_left(keys, zlib.crc32(b"$$f"))
+    >>> list(positions[offsets[i]:offsets[i + 1]])
+    [0, 1]
+    """
+    lists = {}
+    for position, word in enumerate(words):
+        for key in qgram_keys(word):
+            positions = lists.get(key)
+            if positions is None:
+                positions = lists[key] = array("I")
+            positions.append(position)
+    keys = array("I", sorted(lists))
+    offsets = array("Q", [0])
+    positions = array("I")
+    for key in keys:
+        positions.extend(lists[key])
+        offsets.append(len(positions))
+    return keys, offsets, positions
+
+
+def edit_distance(a, b, max_distance=None):
+    """
+    Return the edit distance of the given words: the minimal number of
+    insertions, deletions and substitutions of a letter and transpositions
+    of two adjacent letters that turn a into b (the optimal string alignment
+    distance, so that a swapped pair of letters, the most common typo,
+    counts once). If the distance is larger than max_distance, return
+    max_distance + 1 as soon as this is clear.
+
+    >>> edit_distance("film", "flim"), edit_distance("film", "films")
+    (1, 1)
+    >>> edit_distance("movie", "film"), edit_distance("movie", "film", 2)
+    (5, 3)
+    """
+    if max_distance is None:
+        max_distance = max(len(a), len(b))
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            distance = min(row[j] + 1, current[j - 1] + 1,
+                           row[j - 1] + (a[i - 1] != b[j - 1]))
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                distance = min(distance, previous[j - 2] + 1)
+            current.append(distance)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous, row = row, current
+    return min(row[-1], max_distance + 1)
+
+
+def edit_distances(word, words, max_distance=None):
+    """
+    Return the edit distance (see edit_distance, also for max_distance) of
+    the given word to each of the given words, as NumPy array (a list,
+    without NumPy). The rows of the dynamic program are computed for all
+    words at once: the insertions are the only cells that depend on the cell
+    left of them, they are added by a running minimum. The words whose row
+    only has distances larger than max_distance are dropped after each row.
+
+    >>> words = ["flim", "films", "movie", "", "film"]
+    >>> list(map(int, edit_distances("film", words)))
+    [1, 1, 5, 4, 0]
+    >>> list(map(int, edit_distances("film", words, 1)))
+    [1, 1, 2, 2, 0]
+    """
+    if np is None:
+        return [edit_distance(word, x, max_distance) for x in words]
+    if max_distance is None:
+        max_distance = max(len(word), max(map(len, words), default=0))
+    lengths = np.fromiter(map(len, words), np.int64, len(words))
+    distances = np.full(len(words), max_distance + 1)
+    # Only the words whose length differs by at most max_distance.
+    alive = np.flatnonzero(np.abs(lengths - len(word)) <= max_distance)
+    if not len(alive):
+        return distances
+    # The letters of the words as code points, padded with 0.
+    letters = np.array([words[i] for i in alive],
+                       dtype="U%d" % max(1, lengths[alive].max()))
+    letters = letters.view(np.uint32).reshape(len(alive), -1)
+    lengths = lengths[alive]
+    word = [ord(x) for x in word]
+    columns = np.arange(letters.shape[1] + 1, dtype=np.int32)
+    row = np.tile(columns, (len(alive), 1))
+    previous = None
+    for i in range(1, len(word) + 1):
+        current = np.empty_like(row)
+        current[:, 0] = i
+        current[:, 1:] = np.minimum(row[:, 1:] + 1,
+                                    row[:, :-1] + (letters != word[i - 1]))
+        if i > 1:
+            swapped = ((letters[:, :-1] == word[i - 1])
+                       & (letters[:, 1:] == word[i - 2]))
+            current[:, 2:] = np.where(
+                swapped, np.minimum(current[:, 2:], previous[:, :-2] + 1),
+                current[:, 2:])
+        # current[j] = min(current[j], current[j - 1] + 1), from left to
+        # right.
+        current = np.minimum.accumulate(current - columns, axis=1) + columns
+        # Drop the words that are too far away already.
+        keep = current.min(axis=1) <= max_distance
+        if not keep.all():
+            alive, letters, lengths = alive[keep], letters[keep], lengths[keep]
+            current, row = current[keep], row[keep]
+            if not len(alive):
+                return distances
+        previous, row = row, current
+    distances[alive] = np.minimum(row[np.arange(len(alive)), lengths],
+                                  max_distance + 1)
+    return distances
+
+
+class VocabularyIndex:
+    """
+    An index of the vocabulary of an inverted index, which expands prefix
+    and fuzzy keywords to the terms of the index (see
+    InvertedIndex.analyze_query). The words are sorted, so the words with a
+    given prefix are a range of them, found by binary search (see prefix).
+    For the fuzzy search, a q-gram index maps each q-gram to the words that
+    contain it (see build_qgram_index): a word within a small edit distance
+    of a keyword has most of its q-grams, so only the words that share
+    enough q-grams with the keyword are compared with it (see fuzzy). The
+    q-gram index is built on the first fuzzy search, unless it is given (the
+    binary index format stores it, see index_format.py).
+
+    The words can be any sorted sequence of strings and the dfs any sequence
+    of the numbers of postings of the words, used to pick the most frequent
+    terms if there are too many.
+
+    >>> vocabulary = VocabularyIndex(
+    ...     ["animated", "film", "films", "movie", "short"],
+    ...     array("I", [2, 3, 1, 2, 2]))
+    >>> vocabulary.prefix("fil"), vocabulary.prefix("x")
+    (['film', 'films'], [])
+    >>> vocabulary.fuzzy("flim"), vocabulary.fuzzy("shrot")
+    (['film'], ['short'])
+    >>> vocabulary.find("movie"), vocabulary.find("movies")
+    (3, -1)
+    """
+
+    def __init__(self, words, dfs, qgram_index=None):
+        """
+        Creates the index of the given words (in sorted order), with the
+        given number of postings of each word and the given q-gram index (a
+        triple, see build_qgram_index).
+        """
+        self.words = words
+        self.dfs = dfs
+        self.qgram_index = qgram_index
+
+    def __len__(self):
+        return len(self.words)
+
+    def find(self, word):
+        """
+        Return the position of the given word in the vocabulary, or -1 if the
+        word is not in the vocabulary.
+        """
+        i = bisect_left(self.words, word)
+        if i < len(self.words) and self.words[i] == word:
+            return i
+        return -1
+
+    def prefix(self, prefix, max_expansions=MAX_EXPANSIONS):
+        """
+        Return the words that start with the given (non-empty) prefix, the
+        max_expansions words with the most postings if there are more, in
+        descending order of the number of postings.
+        """
+        if not prefix:
+            return []
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words,
+                          prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return [self.words[i] for i in
+                self.most_frequent(range(start, end), max_expansions)]
+
+    def fuzzy(self, word, max_distance=MAX_DISTANCE,
+              max_expansions=MAX_EXPANSIONS):
+        """
+        Return the words within the given edit distance of the given word
+        (see edit_distance), by ascending distance and then by descending
+        number of postings, at most max_expansions. The distance is at most
+        (length of the word + 1) // (Q + 1): 0 for words with one or two
+        letters, 1 for words with three to six and 2 for longer words. Then
+        each word within the distance shares a q-gram with the given word,
+        since an edit changes at most Q + 1 of its q-grams.
+        """
+        max_distance = min(max_distance, (len(word) + 1) // (Q + 1))
+        if max_distance == 0:
+            return [word] if self.find(word) >= 0 else []
+
+        candidates = self.candidates(word, max_distance)
+        distances = edit_distances(
+            word, [self.words[i] for i in candidates], max_distance)
+        if np is not None:
+            distances = distances.tolist()
+        matches = sorted((distance, -self.dfs[i], i)
+                         for i, distance in zip(candidates, distances)
+                         if distance <= max_distance)
+        return [self.words[i] for _, _, i in matches[:max_expansions]]
+
+    def candidates(self, word, max_distance):
+        """
+        Return the positions of the words that share enough q-grams with the
+        given word to be within the given edit distance of it: a word within
+        the distance has all q-grams of the given word, except for at most
+        Q + 1 per edit.
+        """
+        if self.qgram_index is None:
+            self.qgram_index = build_qgram_index(self.words)
+        keys, offsets, positions = self.qgram_index
+        word_keys = qgram_keys(word)
+        lists = []
+        for key in word_keys:
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                lists.append(positions[offsets[i]:offsets[i + 1]])
+        min_count = max(1, len(word_keys) - (Q + 1) * max_distance)
+        if np is not None:
+            if not lists:
+                return []
+            counts = np.bincount(np.concatenate(
+                [np.frombuffer(x, np.uint32) for x in lists]))
+            return np.flatnonzero(counts >= min_count).tolist()
+        counts = Counter(chain.from_iterable(lists))
+        return sorted(x for x, count in counts.items() if count >= min_count)
+
+    def most_frequent(self, positions, n):
+        """
+        Return the positions of the n words with the most postings among the
+        words at the given positions (a range), in descending order of the
+        number of postings (ties are broken by the position).
+        """
+        if np is not None and len(positions) > n:
+            dfs = np.frombuffer(self.dfs, np.uint32)[
+                positions.start:positions.stop].astype(np.int64)
+            # The n-th largest number of postings, and the words with more
+            # postings or with as many postings, from the left.
+            nth = np.partition(dfs, len(dfs) - n)[len(dfs) - n]
+            larger = np.flatnonzero(dfs > nth)
+            selected = np.concatenate([
+                larger, np.flatnonzero(dfs == nth)[:n - len(larger)]])
+            selected = selected[np.lexsort((selected, -dfs[selected]))]
+            return (selected + positions.start).tolist()
+        return heapq.nsmallest(n, positions,
+                               key=lambda i: (-self.dfs[i], i))
+
+
+def misspell(word, rng):
+    """
+    Return the given word with a random typo: a letter deleted, inserted,
+    substituted or swapped with the next one, by the given random number
+    generator (words with less than three letters are returned unchanged).
+
+    >>> misspell("film", random.Random(3))
+    'sfilm'
+    """
+    if len(word) < 3:
+        return word
+    i = rng.randrange(len(word) - 1)
+    letter = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    return rng.choice([word[:i] + word[i + 1:],
+                       word[:i] + letter + word[i:],
+                       word[:i] + letter + word[i + 1:],
+                       word[:i] + word[i + 1] + word[i] + word[i + 2:]])
+
+
+def benchmark_expansion(ii, num_queries, k=10, seed=0):
+    """
+    Measure the latency of expanding prefix and fuzzy keywords with the
+    vocabulary index of the given index (see InvertedIndex.analyze_query),
+    and of processing the expanded keywords (top-k, see process_query), for
+    the given number of random keywords of each kind: the first two to four
+    letters of random words of the vocabulary with a '*', and random words
+    with a typo (see misspell) with a '~'. Print the latencies (mean, median
+    and 99th percentile) and the number of terms per keyword. For the fuzzy
+    keywords, also print how often the original word is among the terms.
+    Return the mean expansion latencies in milliseconds.
+
+    >>> ii = InvertedIndex()
+    >>> ii.read_from_file("example.tsv", verbose=False)
+    >>> latencies = benchmark_expansion(ii, 10)  # doctest: +ELLIPSIS
+    Built the vocabulary index of 6 words in ...ms.
+    <BLANKLINE>
+    keywords ... expand (ms) ... query (ms) ... terms  found
+    ...
+    >>> sorted(latencies)
+    ['fuzzy', 'prefix']
+    """
+    start = time.perf_counter()
+    vocabulary = ii.get_vocabulary()
+    vocabulary.candidates("", 1)  # Builds the q-gram index, if needed.
+    print("Built the vocabulary index of %d words in %.1fms."
+          % (len(vocabulary), 1000 * (time.perf_counter() - start)))
+
+    rng = random.Random(seed)
+    words = [vocabulary.words[rng.randrange(len(vocabulary))]
+             for _ in range(num_queries)]
+    queries = {
+        "prefix": [(x[:rng.randint(2, 4)] + "*", x) for x in words],
+        "fuzzy": [(misspell(x, rng) + "~", x) for x in words]}
+
+    print("\n%-8s%s%s %9s %6s"
+          % ("keywords", "expand (ms)".center(27), "query (ms)".center(28),
+             "terms", "found"))
+    print("%-8s %8s %8s %8s  %8s %8s %8s"
+          % ("", "mean", "median", "p99", "mean", "median", "p99"))
+    mean_latencies = {}
+    for kind, kind_queries in queries.items():
+        expand_latencies, query_latencies = [], []
+        num_terms = found = 0
+        for query, word in kind_queries:
+            start = time.perf_counter()
+            keywords = ii.analyze_query(query)
+            expand_latencies.append(1000 * (time.perf_counter() - start))
+            start = time.perf_counter()
+            ii.process_query(keywords, k)
+            query_latencies.append(1000 * (time.perf_counter() - start))
+            terms = keyword_terms(keywords)
+            num_terms += len(terms)
+            found += word in terms
+        mean_latencies[kind] = sum(expand_latencies) / len(kind_queries)
+        print("%-8s %8.3f %8.3f %8.3f  %8.3f %8.3f %8.3f %9.1f %5.0f%%"
+              % (kind, mean_latencies[kind],
+                 percentile(expand_latencies, 50),
+                 percentile(expand_latencies, 99),
+                 sum(query_latencies) / len(kind_queries),
+                 percentile(query_latencies, 50),
+                 percentile(query_latencies, 99),
+                 num_terms / len(kind_queries),
+                 100 * found / len(kind_queries)))
+    return mean_latencies
+
+
+def main(precomputed_file, num_queries, k, seed):
+    # The binary index format needs this module, so import it here.
+    from index_format import load_index
+
+    print("Reading from file '%s'." % precomputed_file)
+    ii = load_index(precomputed_file)
+    print("Benchmarking %d prefix and %d fuzzy keywords (top-%d).\n"
+          % (num_queries, num_queries, k))
+    benchmark_expansion(ii, num_queries, k, seed)
+
+
+if __name__ == "__main__":
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser(description="""Benchmark the expansion
+            of prefix keywords (<word>*) and fuzzy keywords (<word>~) with the
+            vocabulary index of a precomputed inverted index: the time to
+            find the matching terms and to process the expanded keywords, for
+            random prefixes and misspelled words of the vocabulary.""")
+    parser.add_argument("precomputed_file", type=str, help="""File
+            containing a precomputed inverted index, in the binary index format
+            (which stores the q-gram index of the fuzzy search) or as pickle.
+            To generate such a file, use 'inverted_index.py'.""")
+    parser.add_argument("-n", "--num-queries", type=int, default=1000,
+                        help="""Number of random keywords of each kind
+            (default: %(default)s)""")
+    parser.add_argument("-k", "--k", type=int, default=10, help="""Number of
+            results of the queries (default: %(default)s)""")
+    parser.add_argument("--seed", type=int, default=0, help="""Seed of the
+            random keywords (default: %(default)s)""")
+    args = parser.parse_args()
+    main(args.precomputed_file, args.num_queries, args.k, args.seed)
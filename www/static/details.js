@@ -3,37 +3,59 @@ $(document).ready(function() {
   // Highlight the row of the query currently chosen.
   $("#" + query).addClass("selected");
 
-  // Insert the first 16 documents in the table containing the top results.
-  var n_max = result_ids.length;
-  var n = Math.min(16, n_max);
-  append_rows(0, n);
+  // Each table of docs shows one list of /details, which is fetched page by
+  // page: the first page right away, the next page when the table is
+  // scrolled to the bottom.
+  $("tbody[data-list]").each(function() {
+    var tbody = $(this);
+    var list = tbody.data("list");
+    var offset = 0;
+    var total = null;
+    var loading = false;
 
-  // Append more rows when scrolled to the bottom.
-  $("#topRes tbody").scroll(function() {
-    var scroll_top = Math.round($(this).scrollTop());
-    var body_height = parseInt($(this).css("height"));
-    var scroll_height = $(this).prop("scrollHeight");
-    var scroll_perc = Math.round(100 * scroll_top / (scroll_height - body_height));
-    if (scroll_perc == 100) {
-      var n_new = Math.min(2 * n, n_max);
-      append_rows(n, n_new);
-      n = n_new;
+    function load_page() {
+      if (loading || (total !== null && offset >= total)) {
+        return;
+      }
+      loading = true;
+      $.getJSON("details", {q: query_text, list: list, offset: offset,
+                            limit: page_size})
+        .done(function(page) {
+          total = page.total;
+          offset += page.docs.length;
+          $.each(page.docs, function(i, doc) {
+            append_row(tbody, list, doc);
+          });
+        })
+        .always(function() {
+          loading = false;
+        });
     }
-  });
 
-  function append_rows(k, n) {
-    for (i = k; i < n; i++) {
-      var id = result_ids[i];
-      var row = "<tr title=\"" + descriptions[id - 1] + "\">"
-        + "<td>" + (i + 1) + "</td>";
-      if (rel_in_res.includes(id)) {
-        row += "<td>" + docs[id - 1] + "</td>";
-      } else {
-        row += "<td style=\"color: red;\">" + docs[id - 1] + "</td>";
+    tbody.scroll(function() {
+      var scroll_bottom = $(this).scrollTop() + $(this).innerHeight();
+      if (scroll_bottom >= $(this).prop("scrollHeight") - 1) {
+        load_page();
       }
-      row += "</tr>";
-      $("#topRes tbody").append(row);
+    });
+
+    load_page();
+  });
+
+  // Append a row for the given doc (see /details) to the given table body.
+  // The title is HTML (with the keywords highlighted), the description is
+  // text, shown when hovering over the row.
+  function append_row(tbody, list, doc) {
+    var row = $("<tr>").attr("title", doc.description);
+    if (list != "missing") {
+      row.append($("<td>").text(doc.position));
+    }
+    var title = $("<td>").html(doc.title);
+    if (!doc.relevant) {
+      title.css("color", "red");
     }
+    row.append(title);
+    tbody.append(row);
   }
 
 });
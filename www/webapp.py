@@ -4,13 +4,108 @@ Chair of Algorithms and Data Structures.
 Theresa Klumpp <klumppt@cs.uni-freiburg.de>
 """
 
+import os
+import sys
 import pickle
 import argparse
-from flask import Flask, render_template, request, url_for  # NOQA
+from flask import (Flask, abort, jsonify, render_template,  # NOQA
+                   request, url_for)
+
+# The modules of the inverted index are in the parent directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from doc_store import open_tsv  # NOQA
+from analyzer import Analyzer  # NOQA
+from snippets import make_snippet, to_html  # NOQA
 
 
 app = Flask(__name__)
 
+# The lists of docs shown for a query (see make_view and details).
+DETAIL_LISTS = ["results", "relevant", "missing"]
+# The number of docs per page of a list, if not given, and the maximal number.
+DEFAULT_PAGE_SIZE = 32
+MAX_PAGE_SIZE = 100
+
+
+def make_view(entry):
+    """
+    Precompute the data shown for a query from the given entry of an
+    evaluation (see evaluate.py): the result ids, the relevant docs in the
+    result (with their position in the result) and the relevant docs not in
+    the result. Each of these lists is paginated by get_page. Done once per
+    query at startup, with a set of the relevant ids, so that the time is
+    linear in the number of results.
+
+    >>> view = make_view({"result_ids": [5, 2, 7, 1],
+    ...                   "relevant_ids": {1, 3, 5},
+    ...                   "precision": [0.33, 0.67, 0.58]})
+    >>> view["relevant"], view["missing"], view["num_rel"]
+    ([(1, 5), (4, 1)], [3], 3)
+    """
+    result_ids = entry["result_ids"]
+    relevant_ids = set(entry["relevant_ids"])
+    in_result = [(position, doc_id) for position, doc_id
+                 in enumerate(result_ids, 1) if doc_id in relevant_ids]
+    found = {doc_id for _, doc_id in in_result}
+    return {"result_ids": result_ids,
+            "relevant_ids": relevant_ids,
+            "relevant": in_result,
+            "missing": sorted(relevant_ids - found),
+            "num_rel": len(relevant_ids),
+            "precision": entry["precision"]}
+
+
+def get_page(view, name, offset, limit):
+    """
+    Return the entries at the given offset (at most limit) of the list with
+    the given name (one of DETAIL_LISTS) of the given view (see make_view),
+    as triples (position in the result or None, doc id, True if the doc is
+    relevant), together with the length of the list. Takes time linear in
+    the limit, not in the length of the list.
+
+    >>> view = make_view({"result_ids": [5, 2, 7, 1],
+    ...                   "relevant_ids": {1, 3, 5}, "precision": []})
+    >>> get_page(view, "results", 1, 2)
+    ([(2, 2, False), (3, 7, False)], 4)
+    >>> get_page(view, "relevant", 0, 10), get_page(view, "missing", 0, 10)
+    (([(1, 5, True), (4, 1, True)], 2), ([(None, 3, True)], 1))
+    """
+    if name == "results":
+        result_ids = view["result_ids"]
+        relevant_ids = view["relevant_ids"]
+        entries = [(position, doc_id, doc_id in relevant_ids)
+                   for position, doc_id in enumerate(
+                       result_ids[offset:offset + limit], offset + 1)]
+        return entries, len(result_ids)
+    if name == "relevant":
+        return ([(position, doc_id, True) for position, doc_id
+                 in view["relevant"][offset:offset + limit]],
+                len(view["relevant"]))
+    return ([(None, doc_id, True) for doc_id
+             in view["missing"][offset:offset + limit]],
+            len(view["missing"]))
+
+
+def get_titles(doc_ids, query):
+    """
+    Return the titles and the descriptions of the docs with the given ids,
+    as two dictionaries from doc id to text: the titles as HTML, with the
+    keywords of the given query highlighted, and snippets of the
+    descriptions around the keywords (see snippets.make_snippet).
+    """
+    analyzer = Analyzer()
+    terms = set(analyzer.analyze(query))
+    titles = {}
+    descriptions = {}
+    for doc_id in doc_ids:
+        title, *description = docs[doc_id - 1]  # doc_id is 1-based.
+        title = title.strip()
+        titles[doc_id] = to_html(make_snippet(title, terms, analyzer,
+                                              len(title)))
+        descriptions[doc_id] = make_snippet(" ".join(description).strip(),
+                                            terms, analyzer).text
+    return titles, descriptions
+
 
 @app.route("/")
 @app.route("/home")
@@ -18,32 +113,64 @@ def home():
     user_input = request.args
     params = {}
     if "details" in user_input:
-
         query = user_input["details"]
-
-        # Split the relevant documents into "in result" and "not in result".
-        relevant = {"in results": [], "not in res": []}
-        for i in evaluation[query]["relevant_ids"]:
-            if i in evaluation[query]["result_ids"]:
-                relevant["in results"].append(i)
-            else:
-                relevant["not in res"].append(i)
-
-        # Remove the entry, if there are no relevant titles not in the result.
-        if relevant["not in res"] == []:
-            relevant.pop("not in res")
-
+        if query not in views:
+            abort(404)
+        # Only the numbers of docs are rendered, the lists are fetched page
+        # by page from /details by details.js.
+        view = views[query]
         params["query"] = query
-        params["result_ids"] = evaluation[query]["result_ids"]
-        params["relevant"] = relevant
-        params["num_rel"] = len(evaluation[query]["relevant_ids"])
-        params["docs"] = docs
-        params["descriptions"] = descriptions
+        params["num_rel"] = view["num_rel"]
+        params["num_results"] = len(view["result_ids"])
+        params["num_in_results"] = len(view["relevant"])
+        params["num_missing"] = len(view["missing"])
     return render_template("index.html",
                            measures=measures,
+                           page_size=DEFAULT_PAGE_SIZE,
                            **params)
 
 
+@app.route("/details")
+def details():
+    """
+    Return a page of one of the lists shown for a query as JSON:
+    /details?q=<query>&list=<results|relevant|missing>&offset=<n>&limit=<n>
+    (see get_page). Each doc has its position in the result (null for the
+    relevant docs not in the result), id, title as HTML, snippet of the
+    description and if it is relevant. Only the docs of the page are read.
+    """
+    user_input = request.args
+    query = user_input.get("q", "")
+    name = user_input.get("list", "results")
+    try:
+        offset = int(user_input.get("offset", 0))
+        limit = int(user_input.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        offset = limit = -1
+    if query not in views:
+        return jsonify({"error": "Unknown query."}), 404
+    if name not in DETAIL_LISTS:
+        return jsonify({"error": "The parameter list must be one of %s."
+                                 % ", ".join(DETAIL_LISTS)}), 400
+    if offset < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": "The parameter offset must be a number "
+                                 ">= 0 and limit a number from 1 to %d."
+                                 % MAX_PAGE_SIZE}), 400
+
+    entries, total = get_page(views[query], name, offset, limit)
+    titles, descriptions = get_titles([x for _, x, _ in entries], query)
+    return jsonify({"query": query,
+                    "list": name,
+                    "offset": offset,
+                    "total": total,
+                    "docs": [{"position": position,
+                              "id": doc_id,
+                              "title": titles[doc_id],
+                              "description": descriptions[doc_id],
+                              "relevant": relevant}
+                             for position, doc_id, relevant in entries]})
+
+
 if __name__ == "__main__":
     # Parse the command line arguments.
     parser = argparse.ArgumentParser(description="""Build a webapp that nicely
@@ -65,14 +192,13 @@ if __name__ == "__main__":
     measures = dict()
     for query in evaluation:
         measures[query] = evaluation[query]["precision"]
+    # Precompute the data shown for each query (see make_view).
+    views = {query: make_view(entry) for query, entry in evaluation.items()
+             if query != "mean"}
 
-    docs = []
-    descriptions = []
-    with open(args.doc_file, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.split("\t")
-            docs.append(line[0].strip())
-            descriptions.append(line[1].strip())
+    # The docs are read from the file when they are shown, only the offsets
+    # of the lines are kept in memory.
+    docs = open_tsv(args.doc_file)
     print("\nThe webapp is available at '<host>:<port>', where <host> is the "
           "local computer address and <port> is the port you mapped to the "
           "container port.\n")